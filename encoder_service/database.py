@@ -1,100 +1,397 @@
 import psycopg2
-from psycopg2.extensions import adapt
+import psycopg2.extensions
+import psycopg2.pool
+import psycopg2.extras
 import logging
 import os
+import re
+import time
+import threading
+from contextlib import contextmanager
+from functools import lru_cache
+
+# one pool per process, created on first use
+_pool = None
+_pool_slots = None
+_pool_lock = threading.Lock()
+
+class PooledConnection(psycopg2.extensions.connection):
+    """A connection that carries its own pool state, so it goes away with the connection"""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # time it was last handed back to the pool
+        self.last_used = 0
+        # names of the statements PREPAREd on it
+        self.prepared = set()
 
 def setup_database(vector_name:str, verbose:bool=False):
     setup_supabase(vector_name, verbose)
 
-def setup_supabase(vector_name:str, verbose:bool=False):
+def index_params(**overrides):
+    """
+    Parameters for the approximate nearest neighbour index and match function.
+    Defaults come from VECTOR_INDEX (hnsw or ivfflat), VECTOR_INDEX_M, VECTOR_INDEX_EF_CONSTRUCTION, 
+    VECTOR_INDEX_EF_SEARCH, VECTOR_INDEX_LISTS and VECTOR_INDEX_PROBES.
+    VECTOR_TIME_WEIGHTED=true uses the time weighted match function, which reranks 
+    VECTOR_TIME_CANDIDATES (default 10) times match_count of the nearest latest documents
+    """
+    params = {
+        'index_type': os.getenv('VECTOR_INDEX', 'hnsw'),
+        'm': int(os.getenv('VECTOR_INDEX_M', 16)),
+        'ef_construction': int(os.getenv('VECTOR_INDEX_EF_CONSTRUCTION', 64)),
+        'ef_search': int(os.getenv('VECTOR_INDEX_EF_SEARCH', 40)),
+        'lists': int(os.getenv('VECTOR_INDEX_LISTS', 100)),
+        'probes': int(os.getenv('VECTOR_INDEX_PROBES', 10)),
+        'time_weighted': os.getenv('VECTOR_TIME_WEIGHTED', 'false').lower() in ('1', 'true'),
+        'time_candidates': int(os.getenv('VECTOR_TIME_CANDIDATES', 10)),
+    }
+    params.update({k: v for k, v in overrides.items() if v is not None})
+
+    if params['index_type'] not in ('hnsw', 'ivfflat'):
+        raise ValueError(f"index_type must be hnsw or ivfflat, got {params['index_type']}")
+
+    return params
+
+def _index_files(params):
+    """The embedding index and match function for the params: time weighted search only indexes the latest documents"""
+    if params['time_weighted']:
+        return (f"{params['vector_name']}_latest_embedding_idx",
+                f"sql/sb/create_index_latest_{params['index_type']}.sql",
+                "sql/sb/create_function_time.sql")
+    
+    return (f"{params['vector_name']}_embedding_idx",
+            f"sql/sb/create_index_{params['index_type']}.sql",
+            "sql/sb/create_function.sql")
+
+def setup_supabase(vector_name:str, verbose:bool=False, **index_overrides):
+    """
+    Creates the table, recency columns, sources catalog, embedding index and match function for vector_name.
+    Can be run again on an existing table to add the recency columns and catalog, it skips what already exists.
+    """
 
     hello = f"Setting up database: {vector_name}"
     logging.info(hello)
     if verbose:
         print(hello)
     
-    params = {'vector_name': vector_name}
+    params = {'vector_name': vector_name, 'concurrently': ''}
+    params.update(index_params(**index_overrides))
+    _, index_file, function_file = _index_files(params)
 
     execute_sql_from_file("sql/sb/setup.sql", params)
     execute_sql_from_file("sql/sb/create_table.sql", params)
-    execute_sql_from_file("sql/sb/create_function.sql", params)
+    execute_sql_from_file("sql/sb/create_time_columns.sql", params)
+    execute_sql_from_file("sql/sb/create_sources.sql", params)
+    execute_sql_from_file(index_file, params)
+    execute_sql_from_file(function_file, params)
 
     if verbose: print("Ran all setup SQL statements")
     
     return True
 
+def rebuild_index(vector_name:str, rebuild:bool=True, verbose:bool=False, **index_overrides):
+    """
+    Rebuilds the embedding index of an existing table without blocking writes.
+    rebuild=True drops and recreates it with the given parameters, e.g. to move from ivfflat to hnsw or change m.
+    rebuild=False runs REINDEX, e.g. to rebalance an ivfflat index after the table has grown.
+    The match function is recreated too so it picks up ef_search and probes.
+    """
+    params = {'vector_name': vector_name, 'concurrently': 'CONCURRENTLY'}
+    params.update(index_params(**index_overrides))
+    index_name, index_file, function_file = _index_files(params)
+    params['index_name'] = index_name
+
+    hello = f"Rebuilding {params['index_type']} index for {vector_name}: {params}"
+    logging.info(hello)
+    if verbose:
+        print(hello)
+
+    # CONCURRENTLY can't run inside a transaction
+    if rebuild:
+        execute_sql_from_file("sql/sb/drop_index.sql", params, autocommit=True)
+        execute_sql_from_file(index_file, params, autocommit=True)
+    else:
+        execute_sql_from_file("sql/sb/reindex_index.sql", params, autocommit=True)
+    execute_sql_from_file(function_file, params)
+
+    if verbose: print(f"Rebuilt index {index_name}")
+
+    return True
+
 def return_sources_last24(vector_name:str):
-    params = {'vector_name': vector_name, 'time_period':'1 day'}
-    return execute_sql_from_file("sql/sb/return_sources.sql", params, return_rows=True)
+    return execute_prepared_from_file("sql/sb/return_sources.sql", vector_name, ('1 day',), return_rows=True)
 
-def delete_row_from_source(source: str, vector_name:str):
-    # adapt the user input and decode from bytes to string to protect against sql injection
-    source = adapt(source).getquoted().decode()
-    sql_params = {'source_delete': source}
-    sql = f"""
-        DELETE FROM {vector_name}
-        WHERE metadata->>'source' = %(source_delete)s
+def upsert_sources(vector_name:str, rows:list):
     """
+    Records ingested chunks in the {vector_name}_sources catalog, in one round trip.
+        rows: list of (source, type, chunk_count, content_sha1, etag, last_modified)
+    """
+    sql = _format_sql_file("sql/sb/upsert_sources.sql", (('vector_name', vector_name),))
+    do_sql_many(sql, rows)
 
-    do_sql(sql, sql_params=sql_params)
+def source_validators(vector_name:str, sources:list):
+    """
+    What the catalog knows about sources, to tell if they changed since they were ingested.
+    Returns a dict of source: {"etag", "last_modified", "content_sha1", "last_ingested"} for sources in the catalog
+    """
+    if not sources:
+        return {}
+    rows = execute_prepared_from_file("sql/sb/source_validators.sql", vector_name, (list(sources),), return_rows=True)
+    return {source: {"etag": etag, "last_modified": last_modified, 
+                     "content_sha1": content_sha1, "last_ingested": last_ingested}
+            for source, etag, last_modified, content_sha1, last_ingested in rows or []}
 
-def do_sql(sql, sql_params=None, return_rows=False):
-    rows = []
-    connection_string = os.getenv('DB_CONNECTION_STRING', None)
-    if connection_string is None:
-        raise ValueError("No connection string")
+def merge_duplicate_sources(vector_name:str, rows:list):
+    """
+    Adds the sources of duplicate chunks to metadata['duplicate_sources'] of the rows they duplicate, in one round trip.
+        rows: list of (id, JSON list of sources)
+    """
+    sql = _format_sql_file("sql/sb/merge_duplicate_sources.sql", (('vector_name', vector_name),))
+    do_sql_many(sql, rows)
 
-    try:
-        connection = psycopg2.connect(connection_string)
-        cursor = connection.cursor()
+def existing_ids(vector_name:str, ids:list):
+    """The set of ids that are still rows of {vector_name}, in one query. Raises if the query fails."""
+    if not ids:
+        return set()
+    rows = do_sql(f"SELECT id FROM {vector_name} WHERE id = ANY(%s)",
+                  sql_params=([int(i) for i in ids],), return_rows=True, raise_errors=True)
+    return {row[0] for row in rows or []}
 
-        # execute the SQL - raise the error if already found
-        cursor.execute(sql, sql_params)
+def delete_row_from_source(source: str, vector_name:str):
+    # source is sent as a bound parameter so is safe from sql injection
+    execute_prepared_from_file("sql/sb/delete_source_row.sql", vector_name, (source,))
 
-        # commit the transaction to save changes to the database
-        connection.commit()
+def get_pool():
+    """
+    Returns the process wide ThreadedConnectionPool to DB_CONNECTION_STRING.
+    Its size is set via DB_POOL_MAX, and DB_POOL_MIN which defaults to the same.
+    psycopg2 closes connections handed back while DB_POOL_MIN are already idle, so a smaller
+    DB_POOL_MIN means connections above it are opened again for every query.
+    """
+    global _pool, _pool_slots
+    if _pool is not None and not _pool.closed:
+        return _pool
+    
+    with _pool_lock:
+        if _pool is None or _pool.closed:
+            connection_string = os.getenv('DB_CONNECTION_STRING', None)
+            if connection_string is None:
+                raise ValueError("No connection string")
+            
+            maxconn = int(os.getenv('DB_POOL_MAX', 10))
+            minconn = min(int(os.getenv('DB_POOL_MIN', maxconn)), maxconn)
+            logging.info(f"Creating PostgreSQL connection pool of {minconn}-{maxconn} connections")
+            _pool = psycopg2.pool.ThreadedConnectionPool(minconn, maxconn, connection_string,
+                                                         connection_factory=PooledConnection,
+                                                         keepalives=1, 
+                                                         keepalives_idle=30)
+            # getconn() raises when the pool is exhausted, so callers wait on this instead
+            _pool_slots = threading.BoundedSemaphore(maxconn)
+    
+    return _pool
+
+def close_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None and not _pool.closed:
+            _pool.closeall()
+            logging.info("PostgreSQL connection pool is closed")
+        _pool = None
 
-        if return_rows:
-            rows = cursor.fetchall()
+def _is_healthy(connection):
+    if connection.closed:
+        return False
     
-    except (psycopg2.errors.DuplicateObject, 
-            psycopg2.errors.DuplicateTable, 
-            psycopg2.errors.DuplicateFunction) as e:
-        logging.info(str(e))
-        print(str(e))
+    # only ping connections that have been idle long enough for the server or a proxy to drop them
+    idle = time.monotonic() - connection.last_used
+    if idle < float(os.getenv('DB_POOL_PING_AFTER', 60)):
+        return True
+    
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1")
+        connection.rollback()
+        return True
+    except psycopg2.Error:
+        return False
 
-    except (Exception, psycopg2.Error) as error:
-        logging.error("Error while connecting to PostgreSQL", exc_info=True)
+def _discard(pool, connection):
+    pool.putconn(connection, close=True)
 
-    finally:
-        if (connection):
-            cursor.close()
-            connection.close()
-            logging.info("PostgreSQL connection is closed")
+@contextmanager
+def get_connection():
+    """
+    Checks out a healthy connection from the pool, returning it afterwards.
+    Connections that error at the connection level are closed rather than reused.
+    """
+    pool = get_pool()
+    slots = _pool_slots
+    slots.acquire()
+    connection = None
+    try:
+        connection = pool.getconn()
+        if not _is_healthy(connection):
+            logging.info("Replacing stale PostgreSQL connection")
+            _discard(pool, connection)
+            connection = pool.getconn()
+
+        yield connection
+
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        if connection is not None:
+            _discard(pool, connection)
+            connection = None
+        raise
     
+    finally:
+        if connection is not None:
+            if connection.closed:
+                _discard(pool, connection)
+            else:
+                if connection.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    connection.rollback()
+                connection.last_used = time.monotonic()
+                pool.putconn(connection)
+        slots.release()
+
+def _run_sql(run, return_rows=False, retries=1, autocommit=False, raise_errors=False):
+    """
+    Calls run(connection, cursor) in a transaction, retrying on a fresh connection if the connection dropped.
+    autocommit=True runs outside a transaction, e.g. for CREATE INDEX CONCURRENTLY
+    raise_errors=True raises database errors rather than logging them and returning None,
+    for callers that need to tell a failure from no rows
+    """
+    # configuration errors e.g. no DB_CONNECTION_STRING are raised, not logged as a failed query
+    get_pool()
+
+    rows = []
+    attempt = 0
+    while True:
+        try:
+            with get_connection() as connection:
+                connection.autocommit = autocommit
+                try:
+                    with connection.cursor() as cursor:
+                        # execute the SQL - raise the error if already found
+                        run(connection, cursor)
+
+                        # commit the transaction to save changes to the database
+                        connection.commit()
+
+                        if return_rows:
+                            rows = cursor.fetchall()
+                finally:
+                    if autocommit and not connection.closed:
+                        connection.autocommit = False
+            break
+
+        except (psycopg2.OperationalError, psycopg2.InterfaceError) as error:
+            if attempt >= retries:
+                logging.error("Error while connecting to PostgreSQL", exc_info=True)
+                if raise_errors:
+                    raise
+                break
+            attempt += 1
+            logging.info(f"PostgreSQL connection error, retrying: {error}")
+        
+        except (psycopg2.errors.DuplicateObject, 
+                psycopg2.errors.DuplicateTable, 
+                psycopg2.errors.DuplicateFunction) as e:
+            logging.info(str(e))
+            print(str(e))
+            break
+
+        except (Exception, psycopg2.Error) as error:
+            logging.error("Error while running PostgreSQL", exc_info=True)
+            if raise_errors:
+                raise
+            break
+
     if rows:
         return rows
     
     return None
 
+def do_sql(sql, sql_params=None, return_rows=False, autocommit=False, raise_errors=False):
+
+    def run(connection, cursor):
+        cursor.execute(sql, sql_params)
+
+    return _run_sql(run, return_rows=return_rows, autocommit=autocommit, raise_errors=raise_errors)
+
+def do_sql_many(sql, rows, template=None, page_size:int=500, return_rows=False):
+    """
+    Bulk insert or update many rows in one round trip per page via execute_values.
+    sql must contain a single VALUES %s placeholder e.g. "INSERT INTO t (a, b) VALUES %s"
+    """
 
-def execute_sql_from_file(filename, params, return_rows=False):
-    return execute_supabase_from_file(filename, params, return_rows)
+    def run(connection, cursor):
+        psycopg2.extras.execute_values(cursor, sql, rows, template=template, page_size=page_size)
 
-def execute_supabase_from_file(filepath, params, return_rows=False):
+    return _run_sql(run, return_rows=return_rows)
 
-     # Get the directory of this Python script
+def _prepared_statements_enabled():
+    # server side prepared statements do not work through a transaction mode pooler e.g. pgbouncer
+    return os.getenv('DB_PREPARED_STATEMENTS', 'true').lower() in ('1', 'true', 'yes')
+
+@lru_cache(maxsize=None)
+def read_sql_file(filepath):
+    """Reads a SQL file relative to this directory once per process"""
+    # Get the directory of this Python script
     dir_path = os.path.dirname(os.path.realpath(__file__))
     # Build the full filepath by joining the directory with the filename
-    filepath = os.path.join(dir_path, filepath)
+    with open(os.path.join(dir_path, filepath), 'r') as file:
+        return file.read()
 
-    # read the SQL file
-    with open(filepath, 'r') as file:
-        sql = file.read()
+@lru_cache(maxsize=1024)
+def _prepared_sql(filepath, vector_name):
+    """
+    The statement name and SQL for a file with $1, $2... parameters, for one vector_name.
+    Also returns the same SQL with %s placeholders for when prepared statements are disabled.
+    """
+    sql = read_sql_file(filepath).format(vector_name=vector_name)
+    name = re.sub(r'\W', '_', f"{os.path.splitext(os.path.basename(filepath))[0]}_{vector_name}")
+    plain_sql = re.sub(r'\$\d+', '%s', sql.replace('%', '%%'))
+    return name, sql, plain_sql
 
-    # substitute placeholders in the SQL
-    sql = sql.format(**params)
-    rows = do_sql(sql, return_rows=return_rows)
+def execute_prepared_from_file(filepath, vector_name:str, args:tuple=(), return_rows=False):
+    """
+    Runs a SQL file that uses $1, $2... parameters as a prepared statement keyed by (file, vector_name).
+    Each pooled connection prepares it once and afterwards only sends EXECUTE with the arguments.
+    """
+    name, sql, plain_sql = _prepared_sql(filepath, vector_name)
+
+    if not _prepared_statements_enabled():
+        return do_sql(plain_sql, sql_params=args, return_rows=return_rows)
+
+    def run(connection, cursor):
+        prepared = connection.prepared
+        try:
+            if name not in prepared:
+                cursor.execute(f"PREPARE {name} AS {sql}")
+                prepared.add(name)
+            placeholders = ", ".join(["%s"] * len(args))
+            execute = f"EXECUTE {name} ({placeholders})" if args else f"EXECUTE {name}"
+            cursor.execute(execute, args)
+        except psycopg2.Error:
+            # we can't tell which statements survived, so don't reuse this connection
+            connection.close()
+            raise
+
+    return _run_sql(run, return_rows=return_rows)
+
+def execute_sql_from_file(filename, params, return_rows=False, autocommit=False):
+    return execute_supabase_from_file(filename, params, return_rows, autocommit=autocommit)
+
+@lru_cache(maxsize=1024)
+def _format_sql_file(filepath, params_items):
+    return read_sql_file(filepath).format(**dict(params_items))
+
+def execute_supabase_from_file(filepath, params, return_rows=False, autocommit=False):
+
+    # substitute placeholders in the SQL, cached per file and params
+    sql = _format_sql_file(filepath, tuple(sorted(params.items())))
+    rows = do_sql(sql, return_rows=return_rows, autocommit=autocommit)
     
     if return_rows:
         if rows is None: return None
@@ -107,6 +404,19 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Setup a supabase database",
                                      formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument("vectorname", help="The namespace for Supabase vectorstore")
+    parser.add_argument("--rebuild-index", action="store_true", 
+                        help="Drop and recreate the embedding index of an existing table with the index parameters below")
+    parser.add_argument("--reindex", action="store_true", 
+                        help="REINDEX the existing embedding index e.g. after an ivfflat table has grown a lot")
+    parser.add_argument("--index", choices=["hnsw", "ivfflat"], help="Index type. Defaults to VECTOR_INDEX or hnsw")
+    parser.add_argument("--m", type=int, help="hnsw: max connections per layer")
+    parser.add_argument("--ef-construction", type=int, help="hnsw: candidate list size when building")
+    parser.add_argument("--ef-search", type=int, help="hnsw: candidate list size when querying")
+    parser.add_argument("--lists", type=int, help="ivfflat: number of lists, around rows/1000")
+    parser.add_argument("--probes", type=int, help="ivfflat: lists searched when querying")
+    parser.add_argument("--time-weighted", action="store_true", default=None,
+                        help="Rank the latest version of each document by similarity and age. Defaults to VECTOR_TIME_WEIGHTED")
+    parser.add_argument("--time-candidates", type=int, help="Time weighted: nearest documents reranked per match, as a multiple of match_count")
 
     args = parser.parse_args()
     config = vars(args)
@@ -115,4 +425,18 @@ if __name__ == "__main__":
     if vector_name is None:
         raise ValueError("Must provide a vectorname")
     
-    setup_supabase(vector_name, verbose=True)
+    index_overrides = {
+        'index_type': config['index'],
+        'm': config['m'],
+        'ef_construction': config['ef_construction'],
+        'ef_search': config['ef_search'],
+        'lists': config['lists'],
+        'probes': config['probes'],
+        'time_weighted': config['time_weighted'],
+        'time_candidates': config['time_candidates'],
+    }
+    
+    if config['rebuild_index'] or config['reindex']:
+        rebuild_index(vector_name, rebuild=config['rebuild_index'], verbose=True, **index_overrides)
+    else:
+        setup_supabase(vector_name, verbose=True, **index_overrides)
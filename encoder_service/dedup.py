@@ -0,0 +1,316 @@
+import os
+import re
+import json
+import zlib
+import struct
+import sqlite3
+import hashlib
+import logging
+import threading
+
+import numpy as np
+
+# MinHash uses (a * x + b) mod a Mersenne prime. a and b are below 2**29 so a * x stays below 2**61 for 32 bit x.
+_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+_WORDS = re.compile(r"\w+")
+
+def dedup_mode():
+    """DEDUP_MODE: off (default), skip drops duplicate chunks, merge also adds their source to the existing row"""
+    return os.getenv('DEDUP_MODE', 'off').lower()
+
+def default_index_path(vector_name: str):
+    """DEDUP_INDEX directory if set, else dedup/ under MESSAGE_HISTORY, one SQLite file per vector_name"""
+    directory = os.getenv('DEDUP_INDEX') or os.path.join(os.getenv('MESSAGE_HISTORY', "."), "dedup")
+    return os.path.join(directory, f"{vector_name}.sqlite")
+
+def normalise_text(text: str):
+    """Lowercase words only, so whitespace, punctuation and case changes still match"""
+    return " ".join(_WORDS.findall(text.lower()))
+
+def _lsh_bands(num_perm: int, threshold: float):
+    """The (bands, rows) splitting num_perm whose LSH threshold (1/bands)**(1/rows) is the highest below threshold"""
+    best = (num_perm, 1)
+    for rows in range(1, num_perm + 1):
+        if num_perm % rows:
+            continue
+        bands = num_perm // rows
+        if (1 / bands) ** (1 / rows) <= threshold:
+            best = (bands, rows)
+    return best
+
+class DedupIndex:
+    """
+    Exact and near duplicate detection for the chunks of one vector_name, persisted in SQLite.
+    Exact duplicates have the same sha1 of normalise_text. Near duplicates have a MinHash estimated Jaccard
+    similarity of word shingles of at least threshold, with candidates found by LSH bands.
+    Each instance has its own index, so matches are confirmed against the Supabase table before a chunk is dropped.
+        vector_name: the Supabase table the chunks go into
+        path: the SQLite file, default default_index_path
+        threshold: DEDUP_THRESHOLD or 0.85
+        num_perm: DEDUP_NUM_PERM or 128 MinHash permutations, changing it needs a fresh index
+        shingle: DEDUP_SHINGLE or 5 words per shingle
+        scope: DEDUP_SCOPE, source (default) only matches chunks of the same source,
+               all matches across sources, so deleting the source that was kept loses the duplicates' text
+    """
+    def __init__(self, vector_name: str, path: str=None, threshold: float=None, num_perm: int=None, shingle: int=None,
+                 scope: str=None):
+        self.vector_name = vector_name
+        self.path = path or default_index_path(vector_name)
+        self.threshold = threshold if threshold is not None else float(os.getenv('DEDUP_THRESHOLD', 0.85))
+        self.num_perm = num_perm or int(os.getenv('DEDUP_NUM_PERM', 128))
+        self.shingle = shingle or int(os.getenv('DEDUP_SHINGLE', 5))
+        self.scope = (scope or os.getenv('DEDUP_SCOPE', 'source')).lower()
+        self.bands, self.rows = _lsh_bands(self.num_perm, self.threshold)
+
+        # fixed seed, so signatures stay comparable between runs
+        generator = np.random.RandomState(1)
+        self._a = generator.randint(1, 1 << 29, size=(self.num_perm, 1)).astype(np.uint64)
+        self._b = generator.randint(0, 1 << 29, size=(self.num_perm, 1)).astype(np.uint64)
+
+        self._lock = threading.Lock()
+        self._backfill_lock = threading.Lock()
+        self._db = self._open_db(self.path)
+
+    @staticmethod
+    def _open_db(path):
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("""CREATE TABLE IF NOT EXISTS chunks (
+                        id INTEGER PRIMARY KEY,
+                        sha1 TEXT NOT NULL,
+                        source TEXT,
+                        signature BLOB)""")
+        db.execute("CREATE INDEX IF NOT EXISTS chunks_sha1 ON chunks (sha1)")
+        db.execute("CREATE INDEX IF NOT EXISTS chunks_source ON chunks (source)")
+        db.execute("""CREATE TABLE IF NOT EXISTS bands (
+                        key BLOB NOT NULL,
+                        chunk_id INTEGER NOT NULL)""")
+        db.execute("CREATE UNIQUE INDEX IF NOT EXISTS bands_key_chunk_id ON bands (key, chunk_id)")
+        db.execute("CREATE INDEX IF NOT EXISTS bands_chunk_id ON bands (chunk_id)")
+        db.execute("""CREATE TABLE IF NOT EXISTS state (
+                        key TEXT PRIMARY KEY,
+                        value TEXT)""")
+        db.commit()
+        logging.info(f"Using dedup index at {path}")
+        return db
+
+    def fingerprint(self, text: str):
+        """The sha1 and MinHash signature of text. The signature is None for text without words."""
+        normalised = normalise_text(text)
+        sha1 = hashlib.sha1(normalised.encode('utf-8')).hexdigest()
+        words = normalised.split(" ") if normalised else []
+        if not words:
+            return sha1, None
+
+        # short chunks are one shingle
+        shingles = {" ".join(words[i:i + self.shingle]) for i in range(max(1, len(words) - self.shingle + 1))}
+        hashes = np.fromiter((zlib.crc32(s.encode('utf-8')) for s in shingles), dtype=np.uint64, count=len(shingles))
+        signature = ((self._a * hashes + self._b) % _PRIME) & _MAX_HASH
+        return sha1, signature.min(axis=1).astype(np.uint32)
+
+    def _band_keys(self, signature):
+        data = signature.tobytes()
+        width = self.rows * 4
+        return [struct.pack(">H", band) + data[band * width:(band + 1) * width] for band in range(self.bands)]
+
+    def _similarity(self, signature, other):
+        return float(np.mean(signature == other))
+
+    def _same_scope(self, source, other_source):
+        return self.scope == "all" or source == other_source
+
+    def candidates(self, sha1: str, signature, source: str=None):
+        """Ids of indexed chunks that are exact or near duplicates, the closest first"""
+        scope_sql = "" if self.scope == "all" else " AND source IS ?"
+        scope_args = [] if self.scope == "all" else [source]
+
+        found = [row[0] for row in self._db.execute(
+            f"SELECT id FROM chunks WHERE sha1 = ?{scope_sql}", [sha1, *scope_args]).fetchall()]
+        if signature is None:
+            return found
+
+        keys = self._band_keys(signature)
+        placeholders = ",".join("?" * len(keys))
+        rows = self._db.execute(
+            f"""SELECT id, signature FROM chunks WHERE id IN
+                    (SELECT DISTINCT chunk_id FROM bands WHERE key IN ({placeholders})){scope_sql}""",
+            [*keys, *scope_args]).fetchall()
+
+        near = []
+        for chunk_id, blob in rows:
+            if blob is None or chunk_id in found:
+                continue
+            similarity = self._similarity(signature, np.frombuffer(blob, dtype=np.uint32))
+            if similarity >= self.threshold:
+                near.append((similarity, chunk_id))
+        return found + [chunk_id for _, chunk_id in sorted(near, reverse=True)]
+
+    def filter(self, docs):
+        """
+        Splits docs into new chunks and duplicates, of a row still in Supabase or of an earlier chunk in docs.
+        Returns (new_docs, fingerprints of new_docs, duplicates) where duplicates is a list of
+        (doc, id of the row, or ("batch", position in new_docs) of the chunk it duplicates)
+        Indexed chunks whose rows were deleted, e.g. via another instance, are dropped from the index.
+        """
+        from .database import existing_ids
+
+        with self._lock:
+            fingerprints = [self.fingerprint(doc.page_content) for doc in docs]
+            candidates = [self.candidates(sha1, signature, doc.metadata.get("source"))
+                          for doc, (sha1, signature) in zip(docs, fingerprints)]
+
+        all_candidates = {chunk_id for ids in candidates for chunk_id in ids}
+        alive = existing_ids(self.vector_name, list(all_candidates))
+        stale = all_candidates - alive
+        if stale:
+            logging.info(f"Dropping {len(stale)} deleted chunks from the dedup index for {self.vector_name}")
+            self._remove_ids(stale)
+
+        new_docs, new_fingerprints, duplicates = [], [], []
+        for doc, (sha1, signature), ids in zip(docs, fingerprints, candidates):
+            match = next((chunk_id for chunk_id in ids if chunk_id in alive), None)
+            if match is not None:
+                duplicates.append((doc, match))
+                continue
+
+            source = doc.metadata.get("source")
+            position = None
+            for i, (new_doc, (other_sha1, other)) in enumerate(zip(new_docs, new_fingerprints)):
+                if not self._same_scope(source, new_doc.metadata.get("source")):
+                    continue
+                if other_sha1 == sha1 or (signature is not None and other is not None
+                                          and self._similarity(signature, other) >= self.threshold):
+                    position = i
+                    break
+            if position is not None:
+                duplicates.append((doc, ("batch", position)))
+                continue
+
+            new_docs.append(doc)
+            new_fingerprints.append((sha1, signature))
+
+        if duplicates:
+            logging.info(f"Dedup found {len(duplicates)} duplicate chunks of {len(docs)} for {self.vector_name}")
+        return new_docs, new_fingerprints, duplicates
+
+    def add(self, ids, docs, fingerprints):
+        """Indexes chunks just inserted into Supabase with the row ids it returned"""
+        chunk_rows, band_rows = [], []
+        for chunk_id, doc, (sha1, signature) in zip(ids, docs, fingerprints):
+            if chunk_id is None:
+                continue
+            chunk_id = int(chunk_id)
+            chunk_rows.append((chunk_id, sha1, doc.metadata.get("source"),
+                               signature.tobytes() if signature is not None else None))
+            if signature is not None:
+                band_rows.extend((key, chunk_id) for key in self._band_keys(signature))
+
+        with self._lock:
+            self._db.executemany("INSERT OR REPLACE INTO chunks (id, sha1, source, signature) VALUES (?, ?, ?, ?)",
+                                 chunk_rows)
+            self._db.executemany("INSERT OR IGNORE INTO bands (key, chunk_id) VALUES (?, ?)", band_rows)
+            self._db.commit()
+
+    def _remove_ids(self, ids):
+        ids = list(ids)
+        with self._lock:
+            # sqlite has a limit on host parameters so delete in slices
+            for i in range(0, len(ids), 500):
+                part = ids[i:i+500]
+                placeholders = ",".join("?" * len(part))
+                self._db.execute(f"DELETE FROM bands WHERE chunk_id IN ({placeholders})", part)
+                self._db.execute(f"DELETE FROM chunks WHERE id IN ({placeholders})", part)
+            self._db.commit()
+
+    def remove_source(self, source: str):
+        """Forgets the chunks of a deleted source. Other instances find out when their matches aren't in Supabase."""
+        with self._lock:
+            self._db.execute("DELETE FROM bands WHERE chunk_id IN (SELECT id FROM chunks WHERE source = ?)", (source,))
+            self._db.execute("DELETE FROM chunks WHERE source = ?", (source,))
+            self._db.commit()
+
+    def _state(self, key: str):
+        row = self._db.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+        return row[0] if row is not None else None
+
+    def ensure_backfilled(self):
+        """Backfills the index once, unless DEDUP_BACKFILL=false. A backfill that failed part way is run again."""
+        if os.getenv('DEDUP_BACKFILL', 'true').lower() not in ('1', 'true'):
+            return
+        with self._backfill_lock:
+            if self._state("backfilled"):
+                return
+            self.backfill()
+            with self._lock:
+                self._db.execute("INSERT OR REPLACE INTO state (key, value) VALUES ('backfilled', '1')")
+                self._db.commit()
+
+    def backfill(self, page_size: int=1000):
+        """Indexes the chunks already in the Supabase table. Raises if a page can't be read."""
+        from .database import do_sql
+
+        logging.info(f"Backfilling dedup index for {self.vector_name}")
+        last_id, total = 0, 0
+        while True:
+            # vector_name is our own table name, the values are bound parameters
+            rows = do_sql(f"SELECT id, content, metadata->>'source' FROM {self.vector_name} "
+                          "WHERE id > %s ORDER BY id LIMIT %s",
+                          sql_params=(last_id, page_size), return_rows=True, raise_errors=True)
+            if not rows:
+                break
+            ids, docs, fingerprints = [], [], []
+            for chunk_id, content, source in rows:
+                ids.append(chunk_id)
+                docs.append(_Chunk(source))
+                fingerprints.append(self.fingerprint(content or ""))
+            self.add(ids, docs, fingerprints)
+            last_id = rows[-1][0]
+            total += len(rows)
+        logging.info(f"Backfilled dedup index for {self.vector_name} with {total} chunks")
+
+class _Chunk:
+    """Just the metadata of a chunk, for backfill"""
+    def __init__(self, source):
+        self.metadata = {"source": source}
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+def get_dedup_index(vector_name: str):
+    """The DedupIndex for vector_name, opened once per process and backfilled on first use"""
+    with _indexes_lock:
+        index = _indexes.get(vector_name)
+        if index is None:
+            index = _indexes[vector_name] = DedupIndex(vector_name)
+
+    # outside the global lock, so other vector_names aren't held up by a backfill
+    index.ensure_backfilled()
+    return index
+
+def merge_targets(duplicates, ids):
+    """
+    The sources to merge into existing rows, as a dict of row id: sources.
+        duplicates: from DedupIndex.filter
+        ids: the ids Supabase returned for the new docs
+    """
+    targets = {}
+    for doc, match in duplicates:
+        source = doc.metadata.get("source")
+        if source is None:
+            continue
+        if isinstance(match, tuple):
+            position = match[1]
+            match = ids[position] if position < len(ids) else None
+            if match is None:
+                continue
+        targets.setdefault(int(match), set()).add(source)
+
+    return {row_id: sorted(sources) for row_id, sources in targets.items()}
+
+def merge_rows(targets: dict):
+    """Turns merge_targets into rows for database.merge_duplicate_sources"""
+    return [(row_id, json.dumps(sources)) for row_id, sources in targets.items()]
@@ -0,0 +1,70 @@
+import os
+import time
+import logging
+import threading
+
+# don't walk the cache directory on every write
+PRUNE_INTERVAL = 30
+
+_last_pruned = {}
+_prune_lock = threading.Lock()
+
+def touch(path):
+    """Marks a cache file as recently used, so it is pruned last"""
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+def prune(cache_dir: str, max_bytes: int, force: bool=False):
+    """
+    Deletes the least recently used files in cache_dir (by mtime) until it is under max_bytes.
+    On Cloud Run the temp directory is in memory, so the caches in it need a cap.
+        cache_dir: the directory to prune, including subdirectories
+        max_bytes: the size to prune down to, 0 or less for no cap
+        force: prune even if it was pruned less than PRUNE_INTERVAL seconds ago
+    """
+    if max_bytes <= 0:
+        return
+    now = time.time()
+    with _prune_lock:
+        if not force and now - _last_pruned.get(cache_dir, 0) < PRUNE_INTERVAL:
+            return
+        _last_pruned[cache_dir] = now
+
+    files = []
+    total = 0
+    for root, _, names in os.walk(cache_dir):
+        for name in names:
+            if name.endswith(".tmp"):
+                # being written by another thread
+                continue
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+
+    if total <= max_bytes:
+        return
+
+    removed = 0
+    for _, size, path in sorted(files):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        removed += 1
+        parent = os.path.dirname(path)
+        if parent != cache_dir:
+            # only removes it if it is now empty
+            try:
+                os.rmdir(parent)
+            except OSError:
+                pass
+    logging.info(f"Pruned {removed} files from {cache_dir}, {total} bytes left")
@@ -0,0 +1,101 @@
+import os
+import logging
+import tempfile
+import importlib.util
+
+from . import disk_cache
+
+def ocr_dpi():
+    return int(os.getenv('OCR_DPI', 300))
+
+def ocr_languages():
+    """Tesseract languages joined with +, e.g. OCR_LANGUAGES=eng+deu"""
+    return os.getenv('OCR_LANGUAGES', 'eng')
+
+def ocr_available():
+    """OCR needs pdf2image and pytesseract (and the poppler and tesseract binaries they call)"""
+    if os.getenv('OCR_ENABLED', 'true').lower() in ('0', 'false'):
+        return False
+    return importlib.util.find_spec("pdf2image") is not None and importlib.util.find_spec("pytesseract") is not None
+
+def ocr_page(pdf_file: str, page_number: int, dpi: int, languages: str):
+    """
+    OCRs one page of a PDF, in a worker process.
+    Only that page is rasterised, so the page image never leaves the worker.
+    """
+    from pdf2image import convert_from_path
+    import pytesseract
+
+    images = convert_from_path(pdf_file, dpi=dpi, first_page=page_number, last_page=page_number)
+    if not images:
+        return ""
+    text = pytesseract.image_to_string(images[0], lang=languages)
+    images[0].close()
+    return text
+
+class OcrCache:
+    """
+    OCR text saved per (file content hash, page number, dpi, languages), written as each page finishes,
+    so a redelivered message only OCRs the pages that weren't done last time.
+        cache_dir: defaults to OCR_CACHE_DIR or ocr_cache in the temp directory
+        max_bytes: the least recently used pages are deleted past this, defaults to OCR_CACHE_MAX_BYTES or 64MB
+    """
+    def __init__(self, cache_dir: str=None, max_bytes: int=None):
+        self.cache_dir = cache_dir or os.getenv('OCR_CACHE_DIR',
+                                                os.path.join(tempfile.gettempdir(), "ocr_cache"))
+        self.max_bytes = max_bytes if max_bytes is not None else int(os.getenv('OCR_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+
+    def _path(self, content_sha1: str, page_number: int, dpi: int, languages: str):
+        return os.path.join(self.cache_dir, content_sha1, f"{page_number}-{dpi}-{languages}.txt")
+
+    def get(self, content_sha1: str, page_number: int, dpi: int, languages: str):
+        """The cached text of the page, or None"""
+        path = self._path(content_sha1, page_number, dpi, languages)
+        try:
+            # the page may be pruned by another thread at any time
+            with open(path, "r", encoding="utf-8") as f:
+                text = f.read()
+        except FileNotFoundError:
+            return None
+        disk_cache.touch(path)
+        return text
+
+    def set(self, content_sha1: str, page_number: int, dpi: int, languages: str, text: str):
+        path = self._path(content_sha1, page_number, dpi, languages)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # a temp file of its own, as a redelivery may OCR the same page at the same time
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(text)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        disk_cache.prune(self.cache_dir, self.max_bytes)
+
+ocr_cache = OcrCache()
+
+def submit_ocr_page(submit, pdf_file: str, page_number: int, content_sha1: str=None):
+    """
+    OCRs a page with submit (e.g. partition.submit, running it in the process pool).
+    Returns the cached text if there is one, else a Future of the text that saves it to the cache when done.
+    """
+    dpi = ocr_dpi()
+    languages = ocr_languages()
+
+    if content_sha1:
+        text = ocr_cache.get(content_sha1, page_number, dpi, languages)
+        if text is not None:
+            logging.info(f"Using cached OCR for page {page_number} of {pdf_file}")
+            return text
+
+    future = submit(ocr_page, pdf_file, page_number, dpi, languages)
+
+    if content_sha1:
+        def save(done):
+            if done.exception() is None:
+                ocr_cache.set(content_sha1, page_number, dpi, languages, done.result())
+        future.add_done_callback(save)
+
+    return future
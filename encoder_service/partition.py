@@ -0,0 +1,280 @@
+import os
+import json
+import shutil
+import hashlib
+import logging
+import tempfile
+import importlib.util
+import multiprocessing
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, Future
+
+from langchain.schema import Document
+
+from . import disk_cache
+from .ocr import ocr_available, submit_ocr_page
+
+# read as plain text, without unstructured
+TEXT_EXTENSIONS = {
+    ".txt", ".md", ".markdown", ".rst", ".py", ".r", ".js", ".ts", ".jsx", ".tsx", ".java", ".go", ".rs",
+    ".c", ".h", ".cpp", ".hpp", ".cs", ".rb", ".php", ".sh", ".sql", ".css", ".scss", ".json", ".yaml", ".yml",
+    ".toml", ".ini", ".cfg", ".csv", ".tsv", ".log", ".tex", ".ipynb",
+}
+
+# bump when partitioning changes so old cached results aren't used
+PARTITION_VERSION = "2"
+
+def convert_to_txt(file_path):
+    file_dir, file_name = os.path.split(file_path)
+    file_base, file_ext = os.path.splitext(file_name)
+    txt_file = os.path.join(file_dir, f"{file_base}.txt")
+    shutil.copyfile(file_path, txt_file)
+    return txt_file
+
+def _simple_metadata(metadata: dict):
+    """Keeps the element metadata that can go into JSON and Supabase"""
+    simple = {}
+    for key, value in metadata.items():
+        if isinstance(value, (str, int, float, bool)):
+            simple[key] = value
+        elif isinstance(value, list) and all(isinstance(v, str) for v in value):
+            simple[key] = value
+    return simple
+
+def _partition_file(file_path: str):
+    """
+    Partitions a file with unstructured, in a worker process.
+    Returns a list of (text, metadata) for each element, reading it as .txt if the file type is not supported.
+    """
+    from unstructured.partition.auto import partition
+
+    try:
+        elements = partition(filename=file_path)
+    except ValueError as e:
+        if "file type is not supported in partition" not in str(e):
+            raise
+        logging.info(f"{file_path} not supported by unstructured, reading as .txt")
+        txt_file = convert_to_txt(file_path)
+        try:
+            elements = partition(filename=txt_file)
+        finally:
+            os.remove(txt_file)
+
+    results = []
+    for element in elements:
+        text = str(element)
+        if not text.strip():
+            continue
+        metadata = element.metadata.to_dict() if getattr(element, "metadata", None) is not None else {}
+        metadata["category"] = getattr(element, "category", type(element).__name__)
+        results.append((text, _simple_metadata(metadata)))
+    return results
+
+_executor = None
+
+def partition_workers():
+    """PARTITION_WORKERS, default the CPU count. 0 partitions in the calling thread."""
+    return int(os.getenv('PARTITION_WORKERS', os.cpu_count() or 1))
+
+def get_executor():
+    """The process pool shared by every partition in this process, created on first use"""
+    global _executor
+    if _executor is None:
+        # spawn rather than fork, as the web server has threads running
+        context = multiprocessing.get_context(os.getenv('PARTITION_MP_CONTEXT', 'spawn'))
+        _executor = ProcessPoolExecutor(max_workers=partition_workers(), mp_context=context)
+    return _executor
+
+def submit(func, *args):
+    """Runs func in the process pool, or here if PARTITION_WORKERS=0. Returns a Future."""
+    if partition_workers() > 0:
+        return get_executor().submit(func, *args)
+
+    future = Future()
+    try:
+        future.set_result(func(*args))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+class PartitionCache:
+    """
+    Partitioned elements saved per file content hash, so a redelivered or re-uploaded file isn't partitioned again.
+        cache_dir: defaults to PARTITION_CACHE_DIR or partition_cache in the temp directory
+        max_bytes: the least recently used entries are deleted past this, defaults to PARTITION_CACHE_MAX_BYTES or 256MB
+    """
+    def __init__(self, cache_dir: str=None, max_bytes: int=None):
+        self.cache_dir = cache_dir or os.getenv('PARTITION_CACHE_DIR',
+                                                os.path.join(tempfile.gettempdir(), "partition_cache"))
+        self.max_bytes = max_bytes if max_bytes is not None else int(os.getenv('PARTITION_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+
+    def _path(self, content_sha1: str, extension: str):
+        # the extension picks how the file is read e.g. the text fast path, so it is part of the key
+        extension = extension.lower().lstrip(".") or "none"
+        return os.path.join(self.cache_dir, f"{content_sha1}-{extension}-v{PARTITION_VERSION}.jsonl")
+
+    def get(self, content_sha1: str, extension: str):
+        """Yields the cached (text, metadata) elements, or returns None if not cached"""
+        path = self._path(content_sha1, extension)
+        try:
+            # opened here, as the entry may be pruned by another thread at any time
+            f = open(path, "r")
+        except FileNotFoundError:
+            return None
+        logging.info(f"Using cached partition {path}")
+        disk_cache.touch(path)
+        return self._read(f)
+
+    @staticmethod
+    def _read(f):
+        with f:
+            for line in f:
+                text, metadata = json.loads(line)
+                yield text, metadata
+
+    @contextmanager
+    def writer(self, content_sha1: str, extension: str):
+        """Yields a write(text, metadata) function. The entry is only saved if the block completes."""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self._path(content_sha1, extension)
+        # a temp file of its own, as another thread may be partitioning the same content e.g. a redelivery
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        f = os.fdopen(fd, "w")
+        try:
+            yield lambda text, metadata: f.write(json.dumps([text, metadata]) + "\n")
+            f.close()
+            os.replace(tmp_path, path)
+        finally:
+            if not f.closed:
+                f.close()
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        disk_cache.prune(self.cache_dir, self.max_bytes)
+
+partition_cache = PartitionCache()
+
+def compute_sha1(file_path):
+    sha1 = hashlib.sha1()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+def _read_text_file(file_path):
+    with open(file_path, "r", encoding="utf-8", errors="replace") as f:
+        text = f.read()
+    if text.strip():
+        yield text, {"filename": os.path.basename(file_path), "category": "Text"}
+
+def _page_to_pdf(page, directory: str, page_number: int):
+    """Writes one pypdf page to its own PDF file, so unstructured only loads that page"""
+    from pypdf import PdfWriter
+    writer = PdfWriter()
+    writer.add_page(page)
+    page_file = os.path.join(directory, f"page_{page_number}.pdf")
+    with open(page_file, "wb") as f:
+        writer.write(f)
+    return page_file
+
+def _ready(result):
+    return not isinstance(result, Future) or result.done()
+
+def _iter_pdf_pages(pdf_file, content_sha1: str = None):
+    """
+    Yields (text, metadata) per PDF page in page order, reading one page at a time so memory doesn't grow with the file.
+    Page text comes from pypdf. Pages without any (e.g. scans) are OCRed, or partitioned on their own by unstructured
+    if OCR isn't available, in the process pool with up to twice the workers in flight at once.
+    OCR results are cached per page by content_sha1.
+    """
+    from pypdf import PdfReader
+
+    use_ocr = ocr_available()
+    window = max(1, partition_workers()) * 2
+    # (page_number, text or list of elements or a Future of either, metadata, page file to remove)
+    pending = deque()
+
+    def next_page():
+        page_number, result, metadata, page_file = pending.popleft()
+        try:
+            if isinstance(result, Future):
+                result = result.result()
+            if isinstance(result, str):
+                if result.strip():
+                    yield result, {**metadata, "page_number": page_number}
+                return
+            for text, element_metadata in result:
+                yield text, {**element_metadata, **metadata, "page_number": page_number}
+        finally:
+            if page_file:
+                os.remove(page_file)
+
+    # a file object rather than a path, else pypdf reads the whole file into memory
+    with open(pdf_file, "rb") as f, tempfile.TemporaryDirectory() as page_dir:
+        reader = PdfReader(f)
+        logging.info(f"Streaming {len(reader.pages)} pages from {pdf_file}")
+        for i, page in enumerate(reader.pages):
+            page_number = i + 1
+            text = page.extract_text() or ""
+            if text.strip():
+                pending.append((page_number, text, {}, None))
+            elif use_ocr:
+                # the worker rasterises the page itself from the original file
+                result = submit_ocr_page(submit, str(pdf_file), page_number, content_sha1=content_sha1)
+                pending.append((page_number, result, {"category": "OCR"}, None))
+            else:
+                page_file = _page_to_pdf(page, page_dir, page_number)
+                pending.append((page_number, submit(_partition_file, page_file), {}, page_file))
+
+            # pypdf keeps every object it has read, drop them so memory stays at about one page
+            if hasattr(reader, "resolved_objects"):
+                reader.resolved_objects.clear()
+
+            # pages come out in order, as soon as they are ready or the window is full
+            while pending and (len(pending) >= window or _ready(pending[0][1])):
+                yield from next_page()
+
+        while pending:
+            yield from next_page()
+
+def iter_elements(file_path, content_sha1: str = None):
+    """Yields (text, metadata) for the elements of a local file, choosing the cheapest way to read it"""
+    extension = os.path.splitext(str(file_path))[1].lower()
+    if extension in TEXT_EXTENSIONS:
+        yield from _read_text_file(file_path)
+        return
+
+    if extension == ".pdf":
+        if importlib.util.find_spec("pypdf") is not None:
+            yield from _iter_pdf_pages(file_path, content_sha1=content_sha1)
+            return
+        logging.info("pypdf not installed, partitioning the whole PDF with unstructured")
+
+    yield from submit(_partition_file, str(file_path)).result()
+
+def iter_file_documents(file_path, metadata: dict = None, content_sha1: str = None):
+    """
+    Yields the Documents of a local file as they are read, PDFs page by page.
+    Results are cached by content_sha1 (computed if not given), and metadata is added to each Document.
+    """
+    metadata = metadata or {}
+    content_sha1 = content_sha1 or compute_sha1(file_path)
+
+    extension = os.path.splitext(str(file_path))[1]
+
+    cached = partition_cache.get(content_sha1, extension)
+    if cached is not None:
+        for text, element_metadata in cached:
+            yield Document(page_content=text, metadata={**element_metadata, **metadata})
+        return
+
+    with partition_cache.writer(content_sha1, extension) as write:
+        for text, element_metadata in iter_elements(file_path, content_sha1=content_sha1):
+            write(text, element_metadata)
+            yield Document(page_content=text, metadata={**element_metadata, **metadata})
+
+def partition_documents(file_path, metadata: dict = None):
+    """All the Documents of a local file as a list"""
+    docs = list(iter_file_documents(file_path, metadata=metadata))
+    logging.info(f"{file_path} turned into {len(docs)} documents")
+    return docs
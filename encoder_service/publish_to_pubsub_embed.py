@@ -1,53 +1,38 @@
 # imports
 import os, shutil, json, re
 import pathlib
-from langchain.document_loaders.unstructured import UnstructuredFileLoader
-from langchain.document_loaders.unstructured import UnstructuredAPIFileLoader
-from langchain.document_loaders import UnstructuredURLLoader
 
 from langchain.docstore.document import Document
-from google.cloud import storage
 import base64
-import langchain.text_splitter as text_splitter
 
 from dotenv import load_dotenv
 import tempfile
 import hashlib
+from contextlib import ExitStack
 from langchain.schema import Document
 import logging
-from my_llm.pubsub_manager import PubSubManager
+from my_llm.client_registry import get_pubsub_manager, get_storage_client
+from my_llm.answer_cache import invalidate_answers
+from my_llm.chunking import iter_chunks
 import datetime
 from .database import setup_database
 from .database import delete_row_from_source
 from .database import return_sources_last24
+from .database import source_validators
+from .dedup import dedup_mode, get_dedup_index
+from .partition import convert_to_txt, partition_documents, iter_file_documents
+from .url_fetch import contains_url, extract_urls, fetch_url, fetch_urls
 
 load_dotenv()
 
-def contains_url(message_data):
-    url_pattern = re.compile(r'http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\\(\\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+')
-    if url_pattern.search(message_data):
-        return True
-    else:
-        return False
-
-def extract_urls(text):
-    url_pattern = re.compile(r'http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\\(\\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+')
-    urls = url_pattern.findall(text)
-    return urls
-
 # utility functions
-def convert_to_txt(file_path):
-    file_dir, file_name = os.path.split(file_path)
-    file_base, file_ext = os.path.splitext(file_name)
-    txt_file = os.path.join(file_dir, f"{file_base}.txt")
-    shutil.copyfile(file_path, txt_file)
-    return txt_file
-
 def compute_sha1_from_file(file_path):
+    sha1 = hashlib.sha1()
     with open(file_path, "rb") as file:
-        bytes = file.read() 
-        readable_hash = hashlib.sha1(bytes).hexdigest()
-    return readable_hash
+        # in blocks so big files aren't read into memory
+        for block in iter(lambda: file.read(1024 * 1024), b""):
+            sha1.update(block)
+    return sha1.hexdigest()
 
 def compute_sha1_from_content(content):
     readable_hash = hashlib.sha1(content).hexdigest()
@@ -55,7 +40,7 @@ def compute_sha1_from_content(content):
 
 def add_file_to_gcs(filename: str, vector_name:str, bucket_name: str=None, metadata:dict=None):
 
-    storage_client = storage.Client()
+    storage_client = get_storage_client()
 
     bucket_name = bucket_name if bucket_name is not None else os.getenv('GCS_BUCKET', None)
     if bucket_name is None:
@@ -65,7 +50,7 @@ def add_file_to_gcs(filename: str, vector_name:str, bucket_name: str=None, metad
         bucket_name = bucket_name.removeprefix("gs://")
     
     logging.info(f"Bucket_name: {bucket_name}")
-    bucket = storage_client.get_bucket(bucket_name)
+    bucket = storage_client.bucket(bucket_name)
     now = datetime.datetime.now()
     year = now.strftime("%Y")
     month = now.strftime("%m")
@@ -90,7 +75,7 @@ def add_file_to_gcs(filename: str, vector_name:str, bucket_name: str=None, metad
     logging.info(f"File {filename} uploaded to gs://{bucket_name}/{bucket_filepath}")
 
     # create pubsub topic and subscription if necessary to receive notifications from cloud storage 
-    pubsub_manager = PubSubManager(vector_name, pubsub_topic=f"app_to_pubsub_{vector_name}")
+    pubsub_manager = get_pubsub_manager(vector_name, f"app_to_pubsub_{vector_name}")
     sub_name = f"pubsub_to_store_{vector_name}"
     sub_exists = pubsub_manager.subscription_exists(sub_name)
     if not sub_exists:
@@ -102,94 +87,72 @@ def add_file_to_gcs(filename: str, vector_name:str, bucket_name: str=None, metad
     return f"gs://{bucket_name}/{bucket_filepath}"
 
 
+def url_metadata(result, metadata: dict = None):
+    """The metadata of a fetched URL's Documents, including the validators used to skip it next time it is unchanged"""
+    the_metadata = dict(metadata or {})
+    the_metadata.update({"source": result.url, "url": result.url, "type": "url_load", "content_sha1": result.content_sha1})
+    if result.etag:
+        the_metadata["etag"] = result.etag
+    if result.last_modified:
+        the_metadata["last_modified"] = result.last_modified
+    return the_metadata
+
 def read_url_to_document(url: str, metadata: dict = None):
     
-    loader = UnstructuredURLLoader(urls=[url])
-    docs = loader.load()
-    if metadata is not None:
-        for doc in docs:
-            doc.metadata.update(metadata)
-    
-    logging.info(f"UnstructuredURLLoader docs: {docs}")
+    with tempfile.TemporaryDirectory() as temp_dir:
+        result = fetch_url(url, temp_dir)
+        if result.status != "fetched":
+            return []
+        docs = partition_documents(result.path, metadata=url_metadata(result, metadata))
     
     return docs
 
+def iter_url_documents(urls, directory: str, vector_name: str, metadata: dict = None):
+    """
+    Yields the Documents of urls as each one is fetched and partitioned.
+    Pages unchanged since they were last ingested into vector_name are skipped, changed ones replace their old chunks.
+    """
+    known = source_validators(vector_name, urls)
+    skipped = 0
+    for result in fetch_urls(urls, directory, validators=known):
+        if result.status != "fetched":
+            logging.info(f"Skipping {result.url}: {result.status}")
+            skipped += 1
+            continue
+
+        docs = iter_file_documents(result.path, metadata=url_metadata(result, metadata),
+                                   content_sha1=result.content_sha1)
+
+        if result.url in known:
+            # the old chunks are only deleted once the new page has partitioned into something to replace them,
+            # the page is at most URL_FETCH_MAX_BYTES so it is held in memory. If publishing then fails
+            # the message is redelivered, and with no catalog entry the page is fetched and published again.
+            docs = list(docs)
+            if not docs:
+                logging.info(f"{result.url} has changed but has no content now, keeping the old chunks")
+                continue
+            logging.info(f"{result.url} has changed since it was ingested, replacing it")
+            delete_source(result.url, vector_name)
+
+        yield from docs
+
+    logging.info(f"Fetched {len(urls) - skipped} of {len(urls)} urls for {vector_name}")
 
 def read_file_to_document(gs_file: pathlib.Path, split=False, metadata: dict = None):
     
-    #file_sha1 = compute_sha1_from_file(gs_file.name)
-    
-    try:
-        #TODO: Use UnstructuredAPIFileLoader instead?
-        logging.info(f"Sending {gs_file} to UnstructuredAPIFileLoader")
-        loader = UnstructuredAPIFileLoader(gs_file, mode="elements", api_key="FAKE_API_KEY")
-        
-        if split:
-            # only supported for some file types
-            docs = loader.load_and_split()
-        else:
-            docs = loader.load()
-            logging.info(f"Loaded docs for {gs_file} from UnstructuredAPIFileLoader")
-    except ValueError as e:
-        logging.info(f"Error for {gs_file} from UnstructuredAPIFileLoader: {str(e)}")
-        if "file type is not supported in partition" in str(e):
-            logging.info("trying locally via .txt conversion")
-            txt_file = None
-            try:
-                # Convert the file to .txt and try again
-                txt_file = convert_to_txt(gs_file)
-                loader = UnstructuredFileLoader(txt_file, mode="elements")
-                if split:
-                    docs = loader.load_and_split()
-                else:
-                    docs = loader.load()
-
-            except Exception as inner_e:
-                raise Exception("An error occurred during txt conversion or loading.") from inner_e
-
-            finally:
-                # Ensure cleanup happens if txt_file was created
-                if txt_file is not None and os.path.exists(txt_file):
-                    os.remove(txt_file)
-
-        else:
-            raise
-
-    except Exception as e:
-        logging.error(f"An unexpected error occurred for {gs_file}: {str(e)}")
-        raise
-
-    for doc in docs:
-        #doc.metadata["file_sha1"] = file_sha1
-        logging.info(f"doc_content: {doc.page_content[:30]}")
-        if metadata is not None:
-            doc.metadata.update(metadata)
-
-    logging.info(f"gs_file: {gs_file} turned into {len(docs)} documents")
+    docs = partition_documents(gs_file, metadata=metadata)
+    if split:
+        docs = chunk_doc_to_docs(docs, pathlib.Path(gs_file).suffix)
 
     return docs
 
-def choose_splitter(extension: str, chunk_size: int=1024, chunk_overlap:int=0):
-    if extension == ".py":
-        return text_splitter.PythonCodeTextSplitter()
-    elif extension == ".md":
-        return text_splitter.MarkdownTextSplitter()
-    
-    return text_splitter.RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
-
-def remove_whitespace(page_content: str):
-    return page_content.replace("\n", " ").replace("\r", " ").replace("\t", " ").replace("  ", " ")
-
+def iter_chunk_docs(documents, extension: str = ".md"):
+    """Yields Document chunks as each Document is read, so they can be published before the whole file is split"""
+    return iter_chunks(documents, extension=extension, normalise=True)
 
 def chunk_doc_to_docs(documents: list, extension: str = ".md"):
     """Turns a Document object into a list of many Document chunks"""
-    source_chunks = []
-    for document in documents:
-        splitter = choose_splitter(extension)
-        for chunk in splitter.split_text(remove_whitespace(document.page_content)):
-            source_chunks.append(Document(page_content=chunk, metadata=document.metadata))
-
-    return source_chunks  
+    return list(iter_chunk_docs(documents, extension))
 
 def data_to_embed_pubsub(data: dict, vector_name:str="documents"):
     """Triggered from a message on a Cloud Pub/Sub topic.
@@ -238,104 +201,148 @@ def data_to_embed_pubsub(data: dict, vector_name:str="documents"):
 
     logging.info(f"Found metadata in pubsub: {metadata}")
 
-    chunks = []
-
     if message_data.startswith('"gs://'):
         message_data = message_data.strip('\"')
 
-    if message_data.startswith("gs://"):
-        logging.info("Detected gs://")
-        bucket_name, file_name = message_data[5:].split("/", 1)
+    with ExitStack() as stack:
+        if message_data.startswith("gs://"):
+            logging.info("Detected gs://")
+            bucket_name, file_name = message_data[5:].split("/", 1)
 
-        # Create a client
-        storage_client = storage.Client()
+            # Reuse the process wide client
+            storage_client = get_storage_client()
 
-        # Download the file from GCS
-        bucket = storage_client.get_bucket(bucket_name)
-        blob = bucket.blob(file_name)
+            # Download the file from GCS
+            bucket = storage_client.bucket(bucket_name)
+            blob = bucket.blob(file_name)
 
-        file_name=pathlib.Path(file_name)
+            file_name=pathlib.Path(file_name)
 
-        with tempfile.TemporaryDirectory() as temp_dir:
+            # the file is kept until its chunks are published below
+            temp_dir = stack.enter_context(tempfile.TemporaryDirectory())
             tmp_file_path = os.path.join(temp_dir, file_name.name)
+            # downloads in chunks straight to disk
             blob.download_to_filename(tmp_file_path)
 
             the_metadata = {
                 "source": message_data,
                 "type": "file_load_gcs",
-                "bucket_name": bucket_name
+                "bucket_name": bucket_name,
+                "content_sha1": compute_sha1_from_file(tmp_file_path)
             }
             metadata.update(the_metadata)
 
-            docs = read_file_to_document(tmp_file_path, metadata=metadata)
-            chunks = chunk_doc_to_docs(docs, file_name.suffix)
-            logging.info(f"Split {file_name} into {len(chunks)} chunks")
+            # documents are read (PDFs page by page) and chunked as they are published
+            docs = iter_file_documents(tmp_file_path, metadata=metadata, content_sha1=metadata["content_sha1"])
+            chunks = iter_chunk_docs(docs, file_name.suffix)
 
-    elif message_data.startswith("http"):
-        logging.info(f"Got http message: {message_data}")
+        elif message_data.startswith("http"):
+            logging.info(f"Got http message: {message_data}")
 
-        # just in case, extract the URL again
-        urls = extract_urls(message_data)
+            # just in case, extract the URL again
+            urls = extract_urls(message_data)
 
-        docs = []
-        for url in urls:
-            metadata["source"] = url
-            metadata["url"] = url
-            metadata["type"] = "url_load"
-            doc = read_url_to_document(url, metadata=metadata)
-            docs.extend(doc)
+            # pages are kept until their chunks are published below
+            temp_dir = stack.enter_context(tempfile.TemporaryDirectory())
+            docs = iter_url_documents(urls, temp_dir, vector_name, metadata=metadata)
 
-        chunks = chunk_doc_to_docs(docs)
-        logging.info(f"Split {url} into {len(chunks)} chunks")
+            chunks = iter_chunk_docs(docs)
 
-    else:
-        logging.info("No gs:// detected")
+        else:
+            logging.info("No gs:// detected")
         
-        the_json = json.loads(message_data)
-        the_metadata = the_json.get("metadata", {})
-        metadata.update(the_metadata)
-        the_content = the_json.get("page_content", None)
+            the_json = json.loads(message_data)
+            the_metadata = the_json.get("metadata", {})
+            metadata.update(the_metadata)
+            the_content = the_json.get("page_content", None)
 
-        if metadata.get("source", None) is not None:
-            metadata["source"] = "No source embedded"
+            if metadata.get("source", None) is not None:
+                metadata["source"] = "No source embedded"
 
-        if the_content is None:
-            logging.info("No content found")
-            return {"metadata": "No content found"}
+            if the_content is None:
+                logging.info("No content found")
+                return {"metadata": "No content found"}
         
-        docs = [Document(page_content=the_content, metadata=metadata)]
+            metadata["content_sha1"] = compute_sha1_from_content(the_content.encode('utf-8'))
+            docs = [Document(page_content=the_content, metadata=metadata)]
 
-        publish_if_urls(the_content, vector_name)
+            publish_if_urls(the_content, vector_name)
 
-        chunks = chunk_doc_to_docs(docs)
-        logging.info(f"Split content into {len(chunks)} chunks")
+            chunks = iter_chunk_docs(docs)
         
-    publish_chunks(chunks, vector_name=vector_name)
+        num_messages = publish_chunks(chunks, vector_name=vector_name)
+        logging.info(f"Published {num_messages} chunk messages for {message_data[:100]}")
 
     logging.info(f"data_to_embed_pubsub published chunks with metadata: {metadata}")
-    pubsub_manager = PubSubManager(vector_name, pubsub_topic=f"pubsub_state_messages")
+    pubsub_manager = get_pubsub_manager(vector_name, f"pubsub_state_messages")
     pubsub_manager.publish_message(f"pubsub_chunk - Added doc with metadata: {metadata} to {vector_name}")
+    # the chunks are sent in batches in the background, make sure they are out before acking the push
+    pubsub_manager.flush()
 
 
     return metadata
 
 def publish_if_urls(the_content, vector_name):
     """
-    Extracts URLs and puts them in a queue for processing on PubSub
+    Extracts URLs and puts them in a queue for processing on PubSub,
+    unless they were ingested in the last URL_REFRESH_HOURS (default 24)
     """
     if contains_url(the_content):
         logging.info("Detected http://")
 
         urls = extract_urls(the_content)
+
+        refresh = datetime.timedelta(hours=float(os.getenv('URL_REFRESH_HOURS', 24)))
+        now = datetime.datetime.now(datetime.timezone.utc)
+        known = source_validators(vector_name, urls)
             
         for url in urls:
+            last_ingested = known.get(url, {}).get("last_ingested")
+            if last_ingested is not None and now - last_ingested < refresh:
+                logging.info(f"Not publishing {url}, it was ingested at {last_ingested}")
+                continue
             publish_text(url, vector_name)
 
 
-def publish_chunks(chunks: list[Document], vector_name: str):
+def batch_chunks(chunks, batch_size: int=None, max_bytes: int=None):
+    """
+    Packs chunks into JSON messages of up to batch_size chunks and max_bytes each.
+    Defaults come from CHUNK_BATCH_SIZE and CHUNK_BATCH_BYTES.  
+    A batch_size of 1 sends each chunk as its own Document JSON, as before batching.
+    """
+    batch_size = batch_size or int(os.getenv('CHUNK_BATCH_SIZE', 50))
+    # Pub/Sub allows 10MB, but push requests are base64 encoded so leave headroom
+    max_bytes = max_bytes or int(os.getenv('CHUNK_BATCH_BYTES', 1000000))
+
+    if batch_size <= 1:
+        for chunk in chunks:
+            yield chunk.json()
+        return
+
+    batch = []
+    batch_bytes = 0
+    for chunk in chunks:
+        chunk_str = json.dumps({"page_content": chunk.page_content, "metadata": chunk.metadata})
+        chunk_bytes = len(chunk_str.encode('utf-8'))
+        if batch and (len(batch) >= batch_size or batch_bytes + chunk_bytes > max_bytes):
+            yield '{"chunks": [' + ", ".join(batch) + ']}'
+            batch = []
+            batch_bytes = 0
+        batch.append(chunk_str)
+        batch_bytes += chunk_bytes
+    
+    if batch:
+        yield '{"chunks": [' + ", ".join(batch) + ']}'
+
+def publish_chunks(chunks, vector_name: str, batch_size: int=None, max_bytes: int=None):
+    """
+    Publishes chunks to embed_chunk_{vector_name} in batches. 
+    chunks can be a generator, each batch is sent as soon as it is full.
+    Returns the number of messages published.
+    """
     logging.info("Publishing chunks to embed_chunk")
     
-    pubsub_manager = PubSubManager(vector_name, pubsub_topic=f"embed_chunk_{vector_name}")
+    pubsub_manager = get_pubsub_manager(vector_name, f"embed_chunk_{vector_name}")
     
     sub_name = f"pubsub_chunk_to_store_{vector_name}"
 
@@ -345,15 +352,20 @@ def publish_chunks(chunks: list[Document], vector_name: str):
         pubsub_manager.create_subscription(sub_name,
                                            push_endpoint=f"/pubsub_chunk_to_store/{vector_name}")
         setup_database(vector_name)
-        
-    for chunk in chunks:
-        # Convert chunk to string, as Pub/Sub messages must be strings or bytes
-        chunk_str = chunk.json()
-        pubsub_manager.publish_message(chunk_str)
+    
+    num_messages = 0
+    for message in batch_chunks(chunks, batch_size=batch_size, max_bytes=max_bytes):
+        # Pub/Sub messages must be strings or bytes
+        pubsub_manager.publish_message(message)
+        num_messages += 1
+    
+    logging.info(f"Published {num_messages} chunk messages to embed_chunk_{vector_name}")
+
+    return num_messages
 
 def publish_text(text:str, vector_name: str):
     logging.info(f"Publishing text to app_to_pubsub_{vector_name}")
-    pubsub_manager = PubSubManager(vector_name, pubsub_topic=f"app_to_pubsub_{vector_name}")
+    pubsub_manager = get_pubsub_manager(vector_name, f"app_to_pubsub_{vector_name}")
     sub_name = f"pubsub_to_store_{vector_name}"
 
     sub_exists = pubsub_manager.subscription_exists(sub_name)
@@ -368,6 +380,9 @@ def publish_text(text:str, vector_name: str):
 def delete_source(source:str, vector_name:str):
     logging.info(f"Deleting source: {source} from {vector_name}")
     delete_row_from_source(source, vector_name)
+    invalidate_answers(vector_name)
+    if dedup_mode() != "off":
+        get_dedup_index(vector_name).remove_source(source)
     logging.info(f"Deleted source: {source} from {vector_name}")
 
 
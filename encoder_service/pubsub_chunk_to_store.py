@@ -1,24 +1,59 @@
 # imports
 import os, sys
-from langchain.embeddings import OpenAIEmbeddings
-from langchain.embeddings import VertexAIEmbeddings
 
 from langchain.docstore.document import Document
 import base64
 import json
 
 from langchain.vectorstores import SupabaseVectorStore
-from supabase import Client, create_client
+from supabase import Client
 from dotenv import load_dotenv
 from langchain.schema import Document
 import logging
-from my_llm.pubsub_manager import PubSubManager
+from my_llm.client_registry import llm_provider, get_embeddings, get_supabase_client
+from my_llm.answer_cache import invalidate_answers
+from .database import upsert_sources, merge_duplicate_sources
+from .dedup import dedup_mode, get_dedup_index, merge_targets, merge_rows
 
 load_dotenv()
 
+def message_to_documents(the_json: dict):
+    """
+    Turns a chunk message into Documents. 
+    Messages are either one Document {"page_content":..., "metadata":...} 
+    or a batch {"chunks": [{"page_content":..., "metadata":...}, ...]}
+    """
+    chunks = the_json.get("chunks", None)
+    if chunks is None:
+        chunks = [the_json]
+    
+    docs = []
+    for chunk in chunks:
+        page_content = chunk.get("page_content", None)
+        if page_content is None:
+            continue
+        docs.append(Document(page_content=page_content, metadata=chunk.get("metadata", None) or {}))
+    
+    return docs
+
+def source_rows(docs: list[Document]):
+    """Rows of (source, type, chunk_count, content_sha1, etag, last_modified) for the sources catalog, one per source in docs"""
+    sources = {}
+    for doc in docs:
+        source = doc.metadata.get("source", None)
+        if source is None:
+            continue
+        if source not in sources:
+            sources[source] = [source, doc.metadata.get("type", None), 0, doc.metadata.get("content_sha1", None),
+                               doc.metadata.get("etag", None), doc.metadata.get("last_modified", None)]
+        sources[source][2] += 1
+    
+    return [tuple(row) for row in sources.values()]
+
 def from_pubsub_to_supabase(data: dict, vector_name:str):
     """Triggered from a message on a Cloud Pub/Sub topic "embed_chunk" topic
-    Will only attempt to send one chunk to vectorstore.  For bigger documents use pubsub_to_store.py
+    Sends the chunk or batch of chunks in the message to the vectorstore, 
+    embedding them with one embed_documents call and inserting them in one request.
     Args:
          data JSON
     """
@@ -39,41 +74,50 @@ def from_pubsub_to_supabase(data: dict, vector_name:str):
     if not isinstance(the_json, dict):
         raise ValueError(f"Could not parse message_data from json to a dict: got {message_data} or type: {type(the_json)}")
 
-    page_content = the_json.get("page_content", None)
-    if page_content is None:
+    docs = message_to_documents(the_json)
+    if not docs:
         return "No page content"
-    
-    metadata = the_json.get("metadata", None)
-
-    doc = Document(page_content=page_content, metadata=metadata)
 
     logging.debug("Initiating Supabase store")
     # init embedding and vector store
-    supabase_url = os.getenv('SUPABASE_URL')
-    supabase_key = os.getenv('SUPABASE_KEY')
-
-    logging.info(f"Supabase URL: {supabase_url}")
-    llm_str = 'openai' if os.getenv('OPENAI_API_KEY', None) is not None else 'vertex'
+    llm_str = llm_provider()
     logging.info(f'Using embeddings: {llm_str}')
 
-    if llm_str == 'openai':
-        embeddings = OpenAIEmbeddings()
-    elif llm_str == 'vertex':
-        embeddings = VertexAIEmbeddings()
-    else:
-        raise NotImplementedError(f'No llm implemented for {llm_str}')
+    # re-uploaded chunks are not sent to the embedding API again
+    embeddings = get_embeddings(llm_str)
     
-    supabase: Client = create_client(supabase_url, supabase_key)
+    supabase: Client = get_supabase_client()
 
     # ensure the supabase sql function and table has been created before using this
     vector_store = SupabaseVectorStore(supabase, embeddings, 
                                        table_name=vector_name,
                                        query_name=f"match_documents_{vector_name}")
 
-    logging.debug("Adding single document to Supabase")
-    vector_store.add_documents([doc])
+    metadata = docs[0].metadata
+
+    # duplicates are dropped before they are embedded
+    mode = dedup_mode()
+    duplicates = []
+    if mode != "off":
+        dedup_index = get_dedup_index(vector_name)
+        docs, fingerprints, duplicates = dedup_index.filter(docs)
+
+    ids = []
+    if docs:
+        logging.debug(f"Adding {len(docs)} documents to Supabase")
+        ids = vector_store.add_documents(docs)
+        invalidate_answers(vector_name)
+
+        upsert_sources(vector_name, source_rows(docs))
+        if mode != "off":
+            dedup_index.add(ids, docs, fingerprints)
+
+    if duplicates and mode == "merge":
+        rows = merge_rows(merge_targets(duplicates, ids))
+        if rows:
+            merge_duplicate_sources(vector_name, rows)
 
-    logging.info(f"Added doc with metadata: {metadata}")
+    logging.info(f"Added {len(docs)} docs and {len(duplicates)} duplicates with metadata: {metadata}")
 
 
     return metadata
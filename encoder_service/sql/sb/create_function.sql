@@ -10,18 +10,33 @@ CREATE OR REPLACE FUNCTION match_documents_{vector_name}(query_embedding vector(
            AS $$
            # variable_conflict use_column
        BEGIN
+           -- how wide the approximate index searches, for this transaction only
+           PERFORM set_config('hnsw.ef_search', '{ef_search}', true);
+           PERFORM set_config('ivfflat.probes', '{probes}', true);
+
+           -- the inner ORDER BY distance LIMIT k is what lets the index be used,
+           -- the similarity threshold is applied to those top k afterwards
            RETURN query
            SELECT
-               id,
-               content,
-               metadata,
-               embedding,
-               1 -({vector_name}.embedding <=> query_embedding) AS similarity
-           FROM
-               {vector_name}
-           where 1 - ({vector_name}.embedding <=> query_embedding) > 0.6
-           ORDER BY
-               {vector_name}.embedding <=> query_embedding
-           LIMIT match_count;
+               nearest.id,
+               nearest.content,
+               nearest.metadata,
+               nearest.embedding,
+               nearest.similarity
+           FROM (
+               SELECT
+                   id,
+                   content,
+                   metadata,
+                   embedding,
+                   1 - ({vector_name}.embedding <=> query_embedding) AS similarity
+               FROM
+                   {vector_name}
+               ORDER BY
+                   {vector_name}.embedding <=> query_embedding
+               LIMIT match_count
+           ) AS nearest
+           WHERE nearest.similarity > 0.6
+           ORDER BY nearest.similarity DESC;
        END;
-       $$;
\ No newline at end of file
+       $$;
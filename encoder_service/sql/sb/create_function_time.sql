@@ -1,12 +1,6 @@
-CREATE OR REPLACE FUNCTION calculate_age_in_days(objectId text, eventTime text)
-    RETURNS float
-    LANGUAGE plpgsql
-    AS $$
-BEGIN
-    RETURN EXTRACT(EPOCH FROM NOW() - TO_TIMESTAMP(COALESCE(SUBSTRING(eventTime FROM 1 FOR 19), SUBSTRING(objectId FROM 14 FOR 13)), 'YYYY-MM-DD"T"HH24:MI:SS')) / (60*60*24);
-END;
-$$;
-
+-- Time weighted match function, needs create_time_columns.sql.
+-- Takes the nearest documents among the latest version of each object through the partial index on is_latest,
+-- then reranks those by similarity and age. 
 CREATE OR REPLACE FUNCTION match_documents_{vector_name}(query_embedding vector(1536), match_count int)
     RETURNS TABLE(
         id bigint,
@@ -18,27 +12,36 @@ CREATE OR REPLACE FUNCTION match_documents_{vector_name}(query_embedding vector(
     AS $$
     # variable_conflict use_column
 BEGIN
+    -- the index has to return enough candidates for the rerank, hnsw.ef_search is at most 1000
+    PERFORM set_config('hnsw.ef_search', LEAST(1000, GREATEST({ef_search}, match_count * {time_candidates}))::text, true);
+    PERFORM set_config('ivfflat.probes', '{probes}', true);
+
     RETURN query
-    WITH latest_documents AS (
-        SELECT *
-        FROM {vector_name}
-        WHERE (metadata->>'objectId', TO_TIMESTAMP(COALESCE(SUBSTRING(metadata->>'eventTime' FROM 1 FOR 19), SUBSTRING(metadata->>'objectId' FROM 14 FOR 13)), 'YYYY-MM-DD"T"HH24:MI:SS')) IN (
-            SELECT metadata->>'objectId', MAX(TO_TIMESTAMP(COALESCE(SUBSTRING(metadata->>'eventTime' FROM 1 FOR 19), SUBSTRING(metadata->>'objectId' FROM 14 FOR 13)), 'YYYY-MM-DD"T"HH24:MI:SS'))
-            FROM {vector_name}
-            GROUP BY metadata->>'objectId'
-        )
-    )
     SELECT
-        id,
-        content,
-        metadata,
-        embedding,
-        1 -(latest_documents.embedding <=> query_embedding) - calculate_age_in_days(metadata->>'objectId', metadata->>'eventTime') AS similarity
-    FROM
-        latest_documents
+        candidates.id,
+        candidates.content,
+        candidates.metadata,
+        candidates.embedding,
+        1 - candidates.distance - candidates.age_in_days AS similarity
+    FROM (
+        SELECT
+            id,
+            content,
+            metadata,
+            embedding,
+            event_time,
+            {vector_name}.embedding <=> query_embedding AS distance,
+            EXTRACT(EPOCH FROM NOW() - event_time) / (60*60*24) AS age_in_days
+        FROM
+            {vector_name}
+        WHERE is_latest
+        ORDER BY
+            {vector_name}.embedding <=> query_embedding
+        LIMIT match_count * {time_candidates}
+    ) AS candidates
     ORDER BY
-        2 * (1 -(latest_documents.embedding <=> query_embedding)) - calculate_age_in_days(metadata->>'objectId', metadata->>'eventTime') DESC,
-        TO_TIMESTAMP(COALESCE(SUBSTRING(metadata->>'eventTime' FROM 1 FOR 19), SUBSTRING(metadata->>'objectId' FROM 14 FOR 13)), 'YYYY-MM-DD"T"HH24:MI:SS') DESC
+        2 * (1 - candidates.distance) - candidates.age_in_days DESC,
+        candidates.event_time DESC
     LIMIT match_count;
 END;
 $$;
@@ -0,0 +1,4 @@
+-- Approximate nearest neighbour index for cosine distance (<=>), needs pgvector >= 0.5.0
+CREATE INDEX {concurrently} IF NOT EXISTS {vector_name}_embedding_idx ON {vector_name}
+    USING hnsw (embedding vector_cosine_ops)
+    WITH (m = {m}, ef_construction = {ef_construction});
@@ -0,0 +1,5 @@
+-- Approximate nearest neighbour index for cosine distance (<=>)
+-- build after the table has data: lists of rows/1000 up to 1M rows, sqrt(rows) above
+CREATE INDEX {concurrently} IF NOT EXISTS {vector_name}_embedding_idx ON {vector_name}
+    USING ivfflat (embedding vector_cosine_ops)
+    WITH (lists = {lists});
@@ -0,0 +1,3 @@
+CREATE INDEX {concurrently} IF NOT EXISTS {vector_name}_latest_embedding_idx ON {vector_name}
+    USING hnsw (embedding vector_cosine_ops) WITH (m = {m}, ef_construction = {ef_construction})
+    WHERE is_latest;
@@ -0,0 +1,3 @@
+CREATE INDEX {concurrently} IF NOT EXISTS {vector_name}_latest_embedding_idx ON {vector_name}
+    USING ivfflat (embedding vector_cosine_ops) WITH (lists = {lists})
+    WHERE is_latest;
@@ -0,0 +1,70 @@
+-- Catalog of the sources in {vector_name}, written at ingest, for listing and deleting sources without scanning the chunks.
+-- Safe to run again on an existing table: it adds the source column and backfills the catalog.
+CREATE TABLE IF NOT EXISTS {vector_name}_sources (
+    source text PRIMARY KEY,
+    type text,
+    chunk_count integer NOT NULL DEFAULT 0,
+    first_ingested timestamptz NOT NULL DEFAULT NOW(),
+    last_ingested timestamptz NOT NULL DEFAULT NOW(),
+    content_sha1 text
+);
+
+-- HTTP validators of url sources, so unchanged pages aren't fetched again
+ALTER TABLE {vector_name}_sources ADD COLUMN IF NOT EXISTS etag text;
+ALTER TABLE {vector_name}_sources ADD COLUMN IF NOT EXISTS last_modified text;
+
+CREATE INDEX IF NOT EXISTS {vector_name}_sources_last_ingested_idx ON {vector_name}_sources (last_ingested DESC);
+
+-- an indexed copy of metadata->>'source' on each chunk
+ALTER TABLE {vector_name} ADD COLUMN IF NOT EXISTS source text;
+
+CREATE OR REPLACE FUNCTION {vector_name}_set_source()
+    RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+BEGIN
+    NEW.source := COALESCE(NEW.source, NEW.metadata->>'source');
+    RETURN NEW;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS {vector_name}_set_source ON {vector_name};
+CREATE TRIGGER {vector_name}_set_source
+    BEFORE INSERT ON {vector_name}
+    FOR EACH ROW EXECUTE FUNCTION {vector_name}_set_source();
+
+UPDATE {vector_name}
+SET source = metadata->>'source'
+WHERE source IS NULL AND metadata->>'source' IS NOT NULL;
+
+CREATE INDEX IF NOT EXISTS {vector_name}_source_idx ON {vector_name} (source);
+
+-- deleting a source from the catalog deletes its chunks
+CREATE OR REPLACE FUNCTION {vector_name}_delete_source_chunks()
+    RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+BEGIN
+    DELETE FROM {vector_name} WHERE source = OLD.source;
+    RETURN OLD;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS {vector_name}_delete_source_chunks ON {vector_name}_sources;
+CREATE TRIGGER {vector_name}_delete_source_chunks
+    AFTER DELETE ON {vector_name}_sources
+    FOR EACH ROW EXECUTE FUNCTION {vector_name}_delete_source_chunks();
+
+-- sources ingested before the catalog existed
+INSERT INTO {vector_name}_sources (source, type, chunk_count, first_ingested, last_ingested, content_sha1)
+SELECT 
+    source, 
+    MAX(metadata->>'type'), 
+    COUNT(*), 
+    COALESCE(MIN(event_time), NOW()), 
+    COALESCE(MAX(event_time), NOW()),
+    MAX(metadata->>'content_sha1')
+FROM {vector_name}
+WHERE source IS NOT NULL
+GROUP BY source
+ON CONFLICT (source) DO NOTHING;
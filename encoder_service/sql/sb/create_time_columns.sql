@@ -0,0 +1,93 @@
+-- Typed recency columns for the time weighted match function.
+-- Safe to run again on an existing table: it adds the columns, backfills them and adds the triggers and indexes.
+
+-- The event time of a document: the eventTime of the Cloud Storage notification, 
+-- else the time in the objectId, else when it was inserted
+CREATE OR REPLACE FUNCTION document_event_time(metadata jsonb)
+    RETURNS timestamptz
+    LANGUAGE plpgsql
+    STABLE
+    AS $$
+BEGIN
+    BEGIN
+        RETURN COALESCE((metadata->>'eventTime')::timestamptz,
+                        TO_TIMESTAMP(SUBSTRING(metadata->>'objectId' FROM 14 FOR 13), 'YYYY-MM-DD"T"HH24:MI:SS'),
+                        NOW());
+    EXCEPTION WHEN others THEN
+        RETURN NOW();
+    END;
+END;
+$$;
+
+ALTER TABLE {vector_name} ADD COLUMN IF NOT EXISTS object_id text;
+ALTER TABLE {vector_name} ADD COLUMN IF NOT EXISTS event_time timestamptz;
+ALTER TABLE {vector_name} ADD COLUMN IF NOT EXISTS is_latest boolean NOT NULL DEFAULT true;
+
+-- fill the typed columns from metadata on insert, and only mark the row latest if nothing newer exists
+CREATE OR REPLACE FUNCTION {vector_name}_set_time_columns()
+    RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+BEGIN
+    NEW.object_id := COALESCE(NEW.object_id, NEW.metadata->>'objectId');
+    NEW.event_time := COALESCE(NEW.event_time, document_event_time(NEW.metadata));
+    NEW.is_latest := NEW.object_id IS NULL OR NOT EXISTS (
+        SELECT 1 FROM {vector_name} AS existing
+        WHERE existing.object_id = NEW.object_id 
+          AND existing.is_latest 
+          AND existing.event_time > NEW.event_time);
+    RETURN NEW;
+END;
+$$;
+
+-- once per insert statement, unmark older versions of the objects just inserted
+CREATE OR REPLACE FUNCTION {vector_name}_mark_superseded()
+    RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+BEGIN
+    UPDATE {vector_name} AS existing
+    SET is_latest = false
+    FROM (
+        SELECT object_id, MAX(event_time) AS event_time
+        FROM new_rows
+        WHERE object_id IS NOT NULL AND is_latest
+        GROUP BY object_id
+    ) AS inserted
+    WHERE existing.object_id = inserted.object_id
+      AND existing.is_latest
+      AND existing.event_time < inserted.event_time;
+    RETURN NULL;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS {vector_name}_set_time_columns ON {vector_name};
+CREATE TRIGGER {vector_name}_set_time_columns
+    BEFORE INSERT ON {vector_name}
+    FOR EACH ROW EXECUTE FUNCTION {vector_name}_set_time_columns();
+
+DROP TRIGGER IF EXISTS {vector_name}_mark_superseded ON {vector_name};
+CREATE TRIGGER {vector_name}_mark_superseded
+    AFTER INSERT ON {vector_name}
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION {vector_name}_mark_superseded();
+
+-- backfill rows inserted before the columns existed
+UPDATE {vector_name}
+SET object_id = metadata->>'objectId',
+    event_time = document_event_time(metadata)
+WHERE event_time IS NULL;
+
+UPDATE {vector_name} AS existing
+SET is_latest = (existing.event_time = newest.event_time)
+FROM (
+    SELECT object_id, MAX(event_time) AS event_time
+    FROM {vector_name}
+    WHERE object_id IS NOT NULL
+    GROUP BY object_id
+) AS newest
+WHERE existing.object_id = newest.object_id
+  AND existing.is_latest IS DISTINCT FROM (existing.event_time = newest.event_time);
+
+CREATE INDEX IF NOT EXISTS {vector_name}_object_id_idx ON {vector_name} (object_id, event_time DESC) WHERE is_latest;
+CREATE INDEX IF NOT EXISTS {vector_name}_event_time_idx ON {vector_name} (event_time DESC) WHERE is_latest;
@@ -1,2 +1,7 @@
+-- the catalog trigger also deletes the chunks, this catches chunks that never made it into the catalog
+WITH catalog AS (
+    DELETE FROM {vector_name}_sources
+    WHERE source = $1
+)
 DELETE FROM {vector_name}
-    WHERE metadata->>'source' = '{source_delete}'
\ No newline at end of file
+    WHERE source = $1
@@ -0,0 +1 @@
+DROP INDEX {concurrently} IF EXISTS {index_name};
@@ -0,0 +1,9 @@
+-- adds the sources of duplicate chunks to the metadata of the row they duplicate, once each
+UPDATE {vector_name} AS t
+SET metadata = jsonb_set(
+    COALESCE(t.metadata, '{{}}'::jsonb),
+    '{{duplicate_sources}}',
+    (SELECT COALESCE(jsonb_agg(DISTINCT s.value), '[]'::jsonb)
+     FROM jsonb_array_elements(COALESCE(t.metadata->'duplicate_sources', '[]'::jsonb) || d.sources::jsonb) AS s(value)))
+FROM (VALUES %s) AS d(id, sources)
+WHERE t.id = d.id::bigint;
@@ -0,0 +1 @@
+REINDEX INDEX {concurrently} {index_name};
@@ -1,3 +1,4 @@
-SELECT metadata->>'source' AS source
-FROM {vector_name}
-WHERE TO_TIMESTAMP(COALESCE(SUBSTRING(metadata->>'eventTime' FROM 1 FOR 19), SUBSTRING(metadata->>'objectId' FROM 14 FOR 13)), 'YYYY-MM-DD"T"HH24:MI:SS') > NOW() - INTERVAL '{time_period}';
+SELECT source, type, chunk_count, last_ingested
+FROM {vector_name}_sources
+WHERE last_ingested > NOW() - $1::interval
+ORDER BY last_ingested DESC;
@@ -0,0 +1,3 @@
+SELECT source, etag, last_modified, content_sha1, last_ingested
+FROM {vector_name}_sources
+WHERE source = ANY($1::text[]);
@@ -0,0 +1,9 @@
+INSERT INTO {vector_name}_sources (source, type, chunk_count, content_sha1, etag, last_modified)
+VALUES %s
+ON CONFLICT (source) DO UPDATE SET
+    type = COALESCE(EXCLUDED.type, {vector_name}_sources.type),
+    chunk_count = {vector_name}_sources.chunk_count + EXCLUDED.chunk_count,
+    content_sha1 = COALESCE(EXCLUDED.content_sha1, {vector_name}_sources.content_sha1),
+    etag = COALESCE(EXCLUDED.etag, {vector_name}_sources.etag),
+    last_modified = COALESCE(EXCLUDED.last_modified, {vector_name}_sources.last_modified),
+    last_ingested = NOW();
@@ -0,0 +1,174 @@
+import os
+import re
+import time
+import hashlib
+import logging
+import mimetypes
+import threading
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from my_llm.client_registry import registry
+
+URL_PATTERN = re.compile(r'http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\\(\\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+')
+
+# content types unstructured partitions better with the right extension
+_EXTENSIONS = {
+    "text/html": ".html",
+    "application/xhtml+xml": ".html",
+    "text/plain": ".txt",
+    "text/markdown": ".md",
+    "application/pdf": ".pdf",
+    "application/json": ".json",
+}
+
+def contains_url(text):
+    return URL_PATTERN.search(text) is not None
+
+def extract_urls(text):
+    """The URLs in text, once each in the order they appear"""
+    return list(dict.fromkeys(URL_PATTERN.findall(text)))
+
+def _setting(name, default, cast=int):
+    return cast(os.getenv(name, default))
+
+def get_session():
+    """
+    The pooled requests.Session used to fetch URLs, shared by the process.
+    URL_FETCH_POOL_SIZE connections are kept per host, with retries on connection errors and 5xx.
+    """
+    def factory():
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        pool_size = _setting('URL_FETCH_POOL_SIZE', 10)
+        retries = Retry(total=2, backoff_factor=0.5, status_forcelist=(502, 503, 504),
+                        allowed_methods=frozenset(["GET", "HEAD"]))
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retries)
+
+        session = requests.Session()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        session.headers["User-Agent"] = os.getenv('URL_FETCH_USER_AGENT', "langchain-github-encoder/1.0")
+        return session
+
+    return registry.get("http", "url_fetch", factory)
+
+_host_semaphores = {}
+_host_lock = threading.Lock()
+
+def _host_semaphore(url):
+    """Limits requests in flight to each host to URL_FETCH_PER_HOST"""
+    host = urlparse(url).netloc.lower()
+    with _host_lock:
+        semaphore = _host_semaphores.get(host)
+        if semaphore is None:
+            semaphore = _host_semaphores[host] = threading.BoundedSemaphore(_setting('URL_FETCH_PER_HOST', 2))
+        return semaphore
+
+def _file_name(url, content_type, number):
+    extension = _EXTENSIONS.get(content_type)
+    if extension is None:
+        extension = os.path.splitext(urlparse(url).path)[1].lower() or mimetypes.guess_extension(content_type or "") or ".html"
+    return f"url_{number}{extension}"
+
+class FetchResult:
+    """
+    What happened when fetching a URL.
+        status: fetched, not_modified (a 304 for our ETag/Last-Modified), unchanged (same sha1 as last time) or failed
+        path: the downloaded body if fetched
+    """
+    def __init__(self, url, status, path=None, content_type=None, etag=None, last_modified=None,
+                 content_sha1=None, error=None):
+        self.url = url
+        self.status = status
+        self.path = path
+        self.content_type = content_type
+        self.etag = etag
+        self.last_modified = last_modified
+        self.content_sha1 = content_sha1
+        self.error = error
+
+    def __repr__(self):
+        return f"FetchResult({self.url!r}, {self.status!r})"
+
+def fetch_url(url: str, directory: str, validators: dict=None, number: int=0):
+    """
+    Downloads url into directory, unless it hasn't changed since validators.
+        validators: the etag, last_modified and content_sha1 recorded when it was last ingested
+    The body is streamed to disk and abandoned past URL_FETCH_MAX_BYTES (default 20MB)
+    or URL_FETCH_MAX_SECONDS (default 60), each read waiting at most URL_FETCH_TIMEOUT (default 15) seconds.
+    """
+    validators = validators or {}
+    headers = {}
+    if validators.get("etag"):
+        headers["If-None-Match"] = validators["etag"]
+    if validators.get("last_modified"):
+        headers["If-Modified-Since"] = validators["last_modified"]
+
+    max_bytes = _setting('URL_FETCH_MAX_BYTES', 20 * 1024 * 1024)
+    max_seconds = _setting('URL_FETCH_MAX_SECONDS', 60, float)
+    timeout = _setting('URL_FETCH_TIMEOUT', 15, float)
+
+    with _host_semaphore(url):
+        start = time.monotonic()
+        try:
+            with get_session().get(url, headers=headers, stream=True, timeout=(timeout, timeout)) as response:
+                if response.status_code == 304:
+                    return FetchResult(url, "not_modified", etag=validators.get("etag"),
+                                       last_modified=validators.get("last_modified"))
+                response.raise_for_status()
+
+                length = response.headers.get("Content-Length")
+                if length and length.isdigit() and int(length) > max_bytes:
+                    raise ValueError(f"Content-Length {length} is over URL_FETCH_MAX_BYTES {max_bytes}")
+
+                content_type = response.headers.get("Content-Type", "").split(";")[0].strip().lower()
+                path = os.path.join(directory, _file_name(url, content_type, number))
+                sha1 = hashlib.sha1()
+                size = 0
+                with open(path, "wb") as f:
+                    for block in response.iter_content(chunk_size=64 * 1024):
+                        size += len(block)
+                        if size > max_bytes:
+                            raise ValueError(f"Body is over URL_FETCH_MAX_BYTES {max_bytes}")
+                        if time.monotonic() - start > max_seconds:
+                            raise TimeoutError(f"Took over URL_FETCH_MAX_SECONDS {max_seconds}")
+                        sha1.update(block)
+                        f.write(block)
+
+                result = FetchResult(url, "fetched", path=path, content_type=content_type,
+                                     etag=response.headers.get("ETag"),
+                                     last_modified=response.headers.get("Last-Modified"),
+                                     content_sha1=sha1.hexdigest())
+        except Exception as e:
+            logging.warning(f"Could not fetch {url}: {e}")
+            return FetchResult(url, "failed", error=str(e))
+
+    if validators.get("content_sha1") == result.content_sha1:
+        # servers without ETag or Last-Modified
+        os.remove(result.path)
+        result.status = "unchanged"
+        result.path = None
+
+    logging.info(f"Fetched {url}: {result.status} in {time.monotonic() - start:.1f}s")
+    return result
+
+def fetch_urls(urls, directory: str, validators: dict=None, workers: int=None):
+    """
+    Fetches urls concurrently, yielding each FetchResult as it completes.
+        validators: dict of url: validators for fetch_url
+        workers: threads, default URL_FETCH_WORKERS or 8. Each host still gets at most URL_FETCH_PER_HOST.
+    """
+    validators = validators or {}
+    urls = list(urls)
+    if not urls:
+        return
+
+    workers = workers or _setting('URL_FETCH_WORKERS', 8)
+    with ThreadPoolExecutor(max_workers=min(workers, len(urls))) as executor:
+        futures = [executor.submit(fetch_url, url, directory, validators.get(url), number)
+                   for number, url in enumerate(urls)]
+        for future in as_completed(futures):
+            yield future.result()
@@ -0,0 +1,108 @@
+import os
+import time
+import threading
+import logging
+
+import numpy as np
+
+def answer_cache_enabled():
+    """The answer cache is opt-in via ANSWER_CACHE=true"""
+    return os.getenv('ANSWER_CACHE', 'false').lower() in ('1', 'true')
+
+class _Index:
+    """Normalised question vectors for one namespace and embedding model, searched with one matrix product"""
+    def __init__(self, dim: int):
+        self.vectors = np.zeros((0, dim), dtype=np.float32)
+        self.entries = []
+
+    def search(self, vector):
+        if not self.entries:
+            return None, 0.0
+        scores = self.vectors @ vector
+        best = int(np.argmax(scores))
+        return best, float(scores[best])
+
+    def add(self, vector, entry, max_entries: int):
+        self.vectors = np.vstack([self.vectors, vector[np.newaxis, :]])
+        self.entries.append(entry)
+        if len(self.entries) > max_entries:
+            # drop the oldest
+            drop = len(self.entries) - max_entries
+            self.vectors = self.vectors[drop:]
+            self.entries = self.entries[drop:]
+
+    def remove(self, i: int):
+        self.vectors = np.delete(self.vectors, i, axis=0)
+        del self.entries[i]
+
+class AnswerCache:
+    """
+    Caches answers per namespace (e.g. vector_name) keyed by the embedding of the standalone question.
+    A question whose cosine similarity to a cached question is at least threshold gets the cached answer.
+        threshold: similarity needed for a hit, defaults to ANSWER_CACHE_THRESHOLD or 0.95
+        ttl: seconds an answer is kept, defaults to ANSWER_CACHE_TTL or 3600.
+             Bounds staleness when another process ingests into the same namespace.
+        max_entries: answers kept per namespace
+    """
+    def __init__(self, threshold: float=None, ttl: float=None, max_entries: int=1000):
+        self.threshold = threshold if threshold is not None else float(os.getenv('ANSWER_CACHE_THRESHOLD', 0.95))
+        self.ttl = ttl if ttl is not None else float(os.getenv('ANSWER_CACHE_TTL', 3600))
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._indexes = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _normalise(vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def lookup(self, namespace: str, model: str, vector):
+        """Returns the cached answer for the nearest question if it is similar enough, else None"""
+        vector = self._normalise(vector)
+        with self._lock:
+            index = self._indexes.get((namespace, model))
+            if index is None:
+                self.misses += 1
+                return None
+
+            best, score = index.search(vector)
+            if best is not None and score >= self.threshold:
+                added, answer = index.entries[best]
+                if time.monotonic() - added <= self.ttl:
+                    self.hits += 1
+                    logging.info(f"Answer cache hit for {namespace} with similarity {score:.3f}")
+                    return answer
+                index.remove(best)
+
+            self.misses += 1
+            return None
+
+    def add(self, namespace: str, model: str, vector, answer: dict):
+        vector = self._normalise(vector)
+        with self._lock:
+            index = self._indexes.get((namespace, model))
+            if index is None:
+                index = self._indexes[(namespace, model)] = _Index(len(vector))
+            index.add(vector, (time.monotonic(), answer), self.max_entries)
+
+    def invalidate(self, namespace: str=None):
+        """Drops all answers for namespace, or every namespace if None"""
+        with self._lock:
+            for key in list(self._indexes):
+                if namespace is None or key[0] == namespace:
+                    logging.info(f"Invalidating answer cache for {key[0]}")
+                    del self._indexes[key]
+
+    def stats(self):
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "entries": sum(len(index.entries) for index in self._indexes.values())}
+
+# shared by every namespace in the process so ingestion can invalidate it from anywhere
+answer_cache = AnswerCache()
+
+def invalidate_answers(namespace: str=None):
+    answer_cache.invalidate(namespace)
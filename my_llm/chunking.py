@@ -0,0 +1,92 @@
+import os
+import re
+import pathlib
+from functools import lru_cache
+
+from langchain.docstore.document import Document
+import langchain.text_splitter as text_splitter
+
+# any run of spaces, tabs and newlines becomes one space
+_WHITESPACE = re.compile(r"\s+")
+
+# (chunk size, overlap) in tokens per splitter kind, about the character sizes used before tokens:
+# langchain's 4000 characters with 200 overlap for python and markdown, 1024 characters for the rest
+DEFAULT_SIZES = {
+    "python": (1000, 50),
+    "markdown": (1000, 50),
+    "text": (256, 0),
+}
+
+def chunk_tokens(kind: str="text"):
+    """The size of a chunk in tokens: CHUNK_TOKENS if set, else the default for the kind of splitter"""
+    return int(os.getenv('CHUNK_TOKENS', DEFAULT_SIZES[kind][0]))
+
+def chunk_overlap(kind: str="text"):
+    """The overlap between chunks in tokens: CHUNK_OVERLAP_TOKENS if set, else the default for the kind of splitter"""
+    return int(os.getenv('CHUNK_OVERLAP_TOKENS', DEFAULT_SIZES[kind][1]))
+
+@lru_cache(maxsize=None)
+def get_encoding(name: str=None):
+    """The tiktoken encoding used to size chunks, loaded once per process. Defaults to CHUNK_ENCODING or cl100k_base."""
+    import tiktoken
+    return tiktoken.get_encoding(name or os.getenv('CHUNK_ENCODING', 'cl100k_base'))
+
+def token_length(text: str):
+    """Tokens in text, the length_function for the splitters"""
+    return len(get_encoding().encode(text, disallowed_special=()))
+
+def normalise_whitespace(text: str):
+    return _WHITESPACE.sub(" ", text)
+
+def splitter_kind(extension: str):
+    extension = (extension or "").lower()
+    if extension == ".py":
+        return "python"
+    if extension in (".md", ".markdown"):
+        return "markdown"
+    return "text"
+
+@lru_cache(maxsize=64)
+def _splitter(kind: str, size: int, overlap: int):
+    if kind == "python":
+        splitter_class = text_splitter.PythonCodeTextSplitter
+    elif kind == "markdown":
+        splitter_class = text_splitter.MarkdownTextSplitter
+    else:
+        splitter_class = text_splitter.RecursiveCharacterTextSplitter
+    return splitter_class(chunk_size=size, chunk_overlap=overlap, length_function=token_length)
+
+def get_splitter(extension: str, size: int=None, overlap: int=None):
+    """
+    The splitter for a file extension, sized in tokens. Splitters are made once and reused.
+        size: chunk size in tokens, default chunk_tokens()
+        overlap: overlap in tokens, default chunk_overlap()
+    """
+    kind = splitter_kind(extension)
+    return _splitter(kind,
+                     size if size is not None else chunk_tokens(kind),
+                     overlap if overlap is not None else chunk_overlap(kind))
+
+def iter_chunks(documents, extension: str=None, size: int=None, overlap: int=None, normalise: bool=False):
+    """
+    Yields Document chunks as each Document is split.
+        extension: picks the splitter, else the suffix of each Document's metadata["source"]
+        size, overlap: in tokens, see get_splitter
+        normalise: collapse whitespace in each chunk. Done after splitting so code and markdown split on their structure.
+    """
+    for document in documents:
+        doc_extension = extension
+        if doc_extension is None:
+            doc_extension = pathlib.Path(str(document.metadata.get("source", ""))).suffix
+        splitter = get_splitter(doc_extension, size=size, overlap=overlap)
+
+        for chunk in splitter.split_text(document.page_content):
+            if normalise:
+                chunk = normalise_whitespace(chunk).strip()
+                if not chunk:
+                    continue
+            yield Document(page_content=chunk, metadata=dict(document.metadata))
+
+def chunk_documents(documents, extension: str=None, size: int=None, overlap: int=None, normalise: bool=False):
+    """All the chunks of documents as a list, see iter_chunks"""
+    return list(iter_chunks(documents, extension=extension, size=size, overlap=overlap, normalise=normalise))
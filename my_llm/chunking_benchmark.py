@@ -0,0 +1,70 @@
+"""
+Compares my_llm.chunking with the character sized splitters it replaced.
+
+    python -m my_llm.chunking_benchmark README.md my_llm/*.py --repeat 5
+"""
+import sys
+import time
+import pathlib
+import argparse
+
+from langchain.docstore.document import Document
+import langchain.text_splitter as text_splitter
+
+from my_llm import chunking
+
+def choose_splitter(extension: str, chunk_size: int=1024, chunk_overlap: int=0):
+    # as it was, a new splitter per document
+    if extension == ".py":
+        return text_splitter.PythonCodeTextSplitter()
+    elif extension == ".md":
+        return text_splitter.MarkdownTextSplitter()
+
+    return text_splitter.RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+
+def remove_whitespace(page_content: str):
+    return page_content.replace("\n", " ").replace("\r", " ").replace("\t", " ").replace("  ", " ")
+
+def old_chunks(documents):
+    chunks = []
+    for document in documents:
+        splitter = choose_splitter(pathlib.Path(document.metadata["source"]).suffix)
+        for chunk in splitter.split_text(remove_whitespace(document.page_content)):
+            chunks.append(Document(page_content=chunk, metadata=document.metadata))
+    return chunks
+
+def new_chunks(documents):
+    return chunking.chunk_documents(documents, normalise=True)
+
+def run(name, func, documents, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        chunks = func(documents)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    tokens = [chunking.token_length(chunk.page_content) for chunk in chunks]
+    print(f"{name:<6} {best * 1000:>9.1f}ms {len(chunks):>7} chunks "
+          f"{sum(tokens):>9} tokens {sum(tokens) / max(len(chunks), 1):>7.1f} mean {max(tokens, default=0):>6} max")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark document chunking")
+    parser.add_argument("files", nargs="+", help="files to chunk")
+    parser.add_argument("--repeat", type=int, default=3, help="runs of each, the best is shown")
+    args = parser.parse_args(argv)
+
+    documents = []
+    for file in args.files:
+        text = pathlib.Path(file).read_text(encoding="utf-8", errors="replace")
+        documents.append(Document(page_content=text, metadata={"source": file}))
+    print(f"{len(documents)} files, {sum(len(doc.page_content) for doc in documents)} characters")
+
+    # load the encoding before timing
+    chunking.token_length("warm up")
+
+    run("old", old_chunks, documents, args.repeat)
+    run("new", new_chunks, documents, args.repeat)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,136 @@
+import os
+import time
+import threading
+import logging
+
+from my_llm.embedding_cache import cached_embeddings
+from my_llm.pubsub_manager import PubSubManager
+
+class ClientRegistry:
+    """
+    Thread-safe registry of long lived clients, created on first use and reused until their ttl expires.
+        ttl: seconds before a client is recreated, None to keep clients for the life of the process
+    """
+    def __init__(self, ttl: float=None):
+        self.ttl = ttl
+        self._clients = {}
+        self._lock = threading.Lock()
+        self._key_locks = {}
+
+    def get(self, kind: str, key, factory, ttl: float=None):
+        """
+        Returns the client registered under (kind, key), calling factory() to create it if missing or expired
+        """
+        ttl = ttl if ttl is not None else self.ttl
+        registry_key = (kind, key)
+
+        entry = self._clients.get(registry_key)
+        if entry is not None and not self._expired(entry, ttl):
+            return entry[0]
+
+        with self._lock:
+            key_lock = self._key_locks.setdefault(registry_key, threading.Lock())
+
+        # only one thread builds a given client, others wait for it
+        with key_lock:
+            entry = self._clients.get(registry_key)
+            if entry is not None and not self._expired(entry, ttl):
+                return entry[0]
+
+            logging.info(f"Creating {kind} client for {key}")
+            client = factory()
+            self._clients[registry_key] = (client, time.monotonic())
+            return client
+
+    @staticmethod
+    def _expired(entry, ttl):
+        return ttl is not None and time.monotonic() - entry[1] > ttl
+
+    def invalidate(self, kind: str=None, key=None):
+        """Drops matching clients so they are recreated on next use. No arguments drops everything."""
+        with self._lock:
+            for registry_key in list(self._clients):
+                if kind is not None and registry_key[0] != kind:
+                    continue
+                if key is not None and registry_key[1] != key:
+                    continue
+                self._clients.pop(registry_key, None)
+
+    def invalidate_where(self, kind: str, predicate):
+        """Drops clients of kind whose key matches predicate(key)"""
+        with self._lock:
+            for registry_key in list(self._clients):
+                if registry_key[0] == kind and predicate(registry_key[1]):
+                    self._clients.pop(registry_key, None)
+
+    def clients(self, kind: str=None):
+        return [client for (k, _), (client, _) in list(self._clients.items()) if kind is None or k == kind]
+
+registry = ClientRegistry(ttl=float(os.getenv('CLIENT_TTL', 3600)))
+
+def llm_provider():
+    """'openai' if an OPENAI_API_KEY is set, else 'vertex'"""
+    return 'openai' if os.getenv('OPENAI_API_KEY', None) is not None else 'vertex'
+
+# provider libraries are imported in the factories so only the ones in use need installing
+def get_embeddings(provider: str=None):
+    provider = provider or llm_provider()
+
+    def factory():
+        if provider == 'openai':
+            from langchain.embeddings import OpenAIEmbeddings
+            return cached_embeddings(OpenAIEmbeddings())
+        elif provider == 'vertex':
+            from langchain.embeddings import VertexAIEmbeddings
+            return cached_embeddings(VertexAIEmbeddings())
+        raise NotImplementedError(f'No embeddings implemented for {provider}')
+
+    return registry.get("embeddings", provider, factory)
+
+def get_llm(provider: str=None, temperature: float=0):
+    provider = provider or llm_provider()
+
+    def factory():
+        if provider == 'openai':
+            from langchain.llms import OpenAI
+            return OpenAI(temperature=temperature)
+        elif provider == 'vertex':
+            from langchain.llms import VertexAI
+            return VertexAI(temperature=temperature)
+        raise NotImplementedError(f'No llm implemented for {provider}')
+
+    return registry.get("llm", (provider, temperature), factory)
+
+def get_supabase_client():
+    supabase_url = os.getenv('SUPABASE_URL')
+    supabase_key = os.getenv('SUPABASE_KEY')
+
+    def factory():
+        from supabase import create_client
+        logging.info(f"Supabase URL: {supabase_url}")
+        return create_client(supabase_url, supabase_key)
+
+    return registry.get("supabase", supabase_url, factory)
+
+def get_storage_client():
+
+    def factory():
+        from google.cloud import storage
+        return storage.Client()
+
+    return registry.get("storage", None, factory)
+
+def get_pubsub_manager(vector_name: str, pubsub_topic: str):
+
+    def factory():
+        return PubSubManager(vector_name, pubsub_topic=pubsub_topic)
+
+    return registry.get("pubsub", (vector_name, pubsub_topic), factory)
+
+def get_http_session():
+
+    def factory():
+        import requests
+        return requests.Session()
+
+    return registry.get("http", None, factory)
@@ -0,0 +1,197 @@
+import os
+import json
+import hashlib
+import sqlite3
+import threading
+from array import array
+from collections import OrderedDict
+from typing import List
+
+from langchain.embeddings.base import Embeddings
+
+import logging
+
+logging.basicConfig(level=logging.INFO)
+
+def default_cache_path():
+    """
+    Where the persistent embedding cache lives: EMBEDDING_CACHE if set, else under MESSAGE_HISTORY.
+    None if neither is set, so only the in-memory cache is used - the SQLite file would grow without limit
+    in the temp directory, which is in memory on Cloud Run
+    """
+    if os.getenv('EMBEDDING_CACHE'):
+        return os.getenv('EMBEDDING_CACHE')
+
+    if os.getenv('MESSAGE_HISTORY'):
+        return os.path.join(os.getenv('MESSAGE_HISTORY'), "embedding_cache.sqlite")
+
+    return None
+
+def cached_embeddings(embedding, cache_path: str=None):
+    """Wraps embedding in a CachedEmbeddings using the default persistent cache"""
+    if isinstance(embedding, CachedEmbeddings):
+        return embedding
+
+    return CachedEmbeddings(embedding, cache_path=cache_path or default_cache_path())
+
+def embedding_model_name(embedding):
+    """A string identifying the model behind an Embeddings object, used in the cache key"""
+    for attr in ("model", "model_name", "deployment"):
+        name = getattr(embedding, attr, None)
+        if name:
+            return f"{type(embedding).__name__}:{name}"
+
+    return type(embedding).__name__
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Wraps an Embeddings object e.g. OpenAIEmbeddings() or VertexAIEmbeddings() so that
+    the same text is only ever embedded once per model.
+        embedding: The Embeddings object that is called on a cache miss
+        cache_path: A SQLite file for the persistent cache, None to only cache in memory
+        max_memory_items: How many vectors are kept in the in-memory LRU
+    """
+    def __init__(self, embedding, cache_path: str=None, max_memory_items: int=10000):
+        self.embedding = embedding
+        self.model_name = embedding_model_name(embedding)
+        self.max_memory_items = max_memory_items
+        self.cache_path = cache_path
+        self.hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+
+        if self.cache_path:
+            self._db = self._open_db(self.cache_path)
+
+    @staticmethod
+    def _open_db(cache_path):
+        dirname = os.path.dirname(cache_path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        db = sqlite3.connect(cache_path, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("""CREATE TABLE IF NOT EXISTS embeddings (
+                        model TEXT NOT NULL,
+                        text_sha1 TEXT NOT NULL,
+                        vector BLOB NOT NULL,
+                        PRIMARY KEY (model, text_sha1))""")
+        db.commit()
+        logging.info(f"Using embedding cache at {cache_path}")
+        return db
+
+    @staticmethod
+    def _float32(vector):
+        """Rounds a vector as it is stored, so a text gets the same vector from the API, the LRU or SQLite"""
+        return array('f', vector).tolist()
+
+    @staticmethod
+    def _hash(text: str):
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+    def _memory_get(self, key):
+        vector = self._memory.get(key)
+        if vector is not None:
+            self._memory.move_to_end(key)
+        return vector
+
+    def _memory_put(self, key, vector):
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_items:
+            self._memory.popitem(last=False)
+
+    def _lookup(self, keys):
+        """Returns a dict of key: vector for all keys found in either cache tier"""
+        found = {}
+        missing = []
+        for key in keys:
+            vector = self._memory_get(key)
+            if vector is not None:
+                found[key] = vector
+            else:
+                missing.append(key)
+
+        if self._db is not None and missing:
+            # sqlite has a limit on host parameters so look up in slices
+            for i in range(0, len(missing), 500):
+                part = missing[i:i+500]
+                placeholders = ",".join("?" * len(part))
+                rows = self._db.execute(
+                    f"SELECT text_sha1, vector FROM embeddings WHERE model = ? AND text_sha1 IN ({placeholders})",
+                    [self.model_name, *part]).fetchall()
+                for key, blob in rows:
+                    vector = array('f', blob).tolist()
+                    found[key] = vector
+                    self._memory_put(key, vector)
+
+        return found
+
+    def _store(self, new_vectors: dict):
+        for key, vector in new_vectors.items():
+            self._memory_put(key, vector)
+
+        if self._db is not None and new_vectors:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, text_sha1, vector) VALUES (?, ?, ?)",
+                [(self.model_name, key, array('f', vector).tobytes()) for key, vector in new_vectors.items()])
+            self._db.commit()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys = [self._hash(text) for text in texts]
+
+        with self._lock:
+            found = self._lookup(keys)
+
+        # embed each missing text once, even if it appears several times in texts
+        to_embed = {}
+        for key, text in zip(keys, texts):
+            if key not in found and key not in to_embed:
+                to_embed[key] = text
+
+        misses = sum(1 for key in keys if key not in found)
+        with self._lock:
+            self.hits += len(texts) - misses
+            self.misses += misses
+
+        if to_embed:
+            logging.debug(f"Embedding {len(to_embed)} of {len(texts)} texts not found in cache")
+            vectors = self.embedding.embed_documents(list(to_embed.values()))
+            new_vectors = {key: self._float32(vector) for key, vector in zip(to_embed.keys(), vectors)}
+            with self._lock:
+                self._store(new_vectors)
+            found.update(new_vectors)
+
+        return [found[key] for key in keys]
+
+    def embed_query(self, text: str) -> List[float]:
+        key = self._hash(text)
+
+        with self._lock:
+            vector = self._lookup([key]).get(key)
+            if vector is not None:
+                self.hits += 1
+                return vector
+            self.misses += 1
+
+        vector = self._float32(self.embedding.embed_query(text))
+        with self._lock:
+            self._store({key: vector})
+
+        return vector
+
+    def stats(self):
+        """Returns cache hit/miss counters"""
+        total = self.hits + self.misses
+        return {
+            "model": self.model_name,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "memory_items": len(self._memory)
+        }
+
+    def __repr__(self):
+        return f"CachedEmbeddings({json.dumps(self.stats())})"
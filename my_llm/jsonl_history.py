@@ -0,0 +1,173 @@
+import os
+import logging
+from array import array
+from datetime import datetime
+
+try:
+    # optional, a faster JSON decoder
+    import orjson
+    _loads = orjson.loads
+except ImportError:
+    import json
+    _loads = json.loads
+
+def parse_timestamp(value):
+    """Parses the isoformat timestamps written by PubSubChatMessageHistory, falling back to dateutil for anything else"""
+    if isinstance(value, datetime) or value is None:
+        return value
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        from dateutil.parser import parse
+        return parse(value)
+
+def parse_line(line):
+    """Parses one JSON line of memory.json into the TimedChatMessage fields"""
+    data = _loads(line)
+    return {"content": data.get("content", ""),
+            "role": data.get("role", ""),
+            "timestamp": parse_timestamp(data.get("timestamp", None)),
+            "metadata": data.get("metadata", None) or {},
+            "system_string": data.get("system_string", "")}
+
+def tail_lines(path: str, n: int, block_size: int=65536):
+    """
+    Returns the last n non-empty lines of path as bytes, oldest first,
+    reading backwards from the end in blocks rather than through the whole file
+    """
+    if n <= 0:
+        return []
+
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        position = f.tell()
+        data = b""
+        while position > 0:
+            read_size = min(block_size, position)
+            position -= read_size
+            f.seek(position)
+            data = f.read(read_size) + data
+            # the first line is only partly read until we reach the start of the file
+            if sum(1 for line in data.split(b"\n")[1:] if line.strip()) >= n:
+                break
+
+    lines = data.split(b"\n")
+    if position > 0:
+        lines = lines[1:]
+
+    return [line for line in lines if line.strip()][-n:]
+
+class OffsetIndex:
+    """
+    A sidecar file of the byte offset of each message line in a JSON lines file,
+    so any range of messages can be read with one seek.
+    It is appended to when messages are written, and catches up with lines written without it.
+        path: the JSON lines file, the index is path + '.idx'
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.index_path = path + '.idx'
+        self.offsets = array('q')
+        self._loaded = False
+
+    def _load(self):
+        self.offsets = array('q')
+        if os.path.isfile(self.index_path):
+            with open(self.index_path, 'rb') as f:
+                self.offsets.frombytes(f.read())
+        self._loaded = True
+
+    def _scan(self, start: int, skip_first: bool):
+        """Offsets of the non-empty lines from byte start to the end of the file"""
+        offsets = array('q')
+        with open(self.path, 'rb') as f:
+            f.seek(start)
+            if skip_first:
+                f.readline()
+            position = f.tell()
+            for line in f:
+                if line.strip():
+                    offsets.append(position)
+                position += len(line)
+        return offsets
+
+    def sync(self):
+        """Brings the index up to date with the file, rebuilding it if the file was truncated"""
+        if not self._loaded:
+            self._load()
+
+        size = os.path.getsize(self.path) if os.path.isfile(self.path) else 0
+        if self.offsets and self.offsets[-1] >= size:
+            logging.info(f"Rebuilding stale message index {self.index_path}")
+            self.offsets = array('q')
+
+        if self.offsets:
+            new_offsets = self._scan(self.offsets[-1], skip_first=True)
+        else:
+            new_offsets = self._scan(0, skip_first=False) if size else array('q')
+            self._save(truncate=True)
+
+        if new_offsets:
+            self.append(new_offsets)
+
+    def _save(self, truncate: bool=False, offsets=None):
+        mode = 'wb' if truncate else 'ab'
+        with open(self.index_path, mode) as f:
+            (offsets if offsets is not None else self.offsets).tofile(f)
+
+    def append(self, offsets):
+        """Records the offsets of lines just appended to the file"""
+        if not self._loaded:
+            self._load()
+        offsets = array('q', offsets)
+        self.offsets.extend(offsets)
+        self._save(offsets=offsets)
+
+    def remove(self):
+        self.offsets = array('q')
+        if os.path.isfile(self.index_path):
+            os.remove(self.index_path)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def read_lines(self, start: int=0, stop: int=None):
+        """The lines of messages start to stop, like a slice, read in one seek"""
+        start, stop, _ = slice(start, stop).indices(len(self.offsets))
+        if start >= stop:
+            return []
+
+        with open(self.path, 'rb') as f:
+            f.seek(self.offsets[start])
+            if stop < len(self.offsets):
+                data = f.read(self.offsets[stop] - self.offsets[start])
+            else:
+                data = f.read()
+
+        return [line for line in data.split(b"\n") if line.strip()]
+
+def read_messages(path: str, n: int=None, start: int=None, use_index: bool=True):
+    """
+    Reads messages from a JSON lines file as dicts of TimedChatMessage fields, oldest first.
+        n: the last n messages, or n messages from start. None for all of them.
+        start: index of the first message to read, needs the offset index
+        use_index: use (and create) the sidecar offset index, else seek backwards from the end for the last n
+    """
+    if not os.path.isfile(path):
+        return []
+
+    if use_index:
+        index = OffsetIndex(path)
+        index.sync()
+        if start is None:
+            start = max(len(index) - n, 0) if n else 0
+        lines = index.read_lines(start, start + n if n else None)
+    elif start is not None:
+        raise ValueError("start needs use_index=True")
+    elif n:
+        lines = tail_lines(path, n)
+    else:
+        with open(path, 'rb') as f:
+            lines = [line for line in f if line.strip()]
+
+    return [parse_line(line) for line in lines]
@@ -1,6 +1,6 @@
 import os, json
 
-from langchain.schema import BaseChatMessageHistory
+from langchain.schema import BaseChatMessageHistory, HumanMessage, AIMessage
 from langchain.memory import ConversationTokenBufferMemory
 from langchain.llms import OpenAI
 
@@ -14,34 +14,54 @@ from langchain.docstore.document import Document
 from langchain.embeddings.openai import OpenAIEmbeddings
 
 from datetime import datetime
-from dateutil.parser import parse
 
 from my_llm.pubsub_manager import PubSubManager
 from my_llm.vectorstore import MessageVectorStore
 from my_llm.timed_chat_message import TimedChatMessage
+from my_llm.message_router import MessageRouter
+from my_llm.embedding_cache import cached_embeddings
+from my_llm.answer_cache import answer_cache, answer_cache_enabled
+from my_llm.jsonl_history import OffsetIndex, read_messages
+from my_llm.message_store import MessageStore, to_epoch
+from my_llm.token_window import TokenWindow
 
 import logging
 
 logging.basicConfig(level=logging.INFO)
 
 class PubSubChatMessageHistory(BaseChatMessageHistory):
-
+    """
+    Chat message history that is written to disk, PubSub and a Chroma vectorstore.
+        memory_namespace: Governs where messages are stored
+        pubsub_topic: The PubSub topic messages are published to
+        bucket_name: if specified saves and loads vectorstore to GCP as well as locally: gs://name-of-bucket
+        embedding: The Embedding used by the vectorstore e.g. OpenAIEmbeddings(), wrapped in a CachedEmbeddings
+        async_routing: if True messages are routed in batches on a background thread
+          instead of blocking add_user_message/add_ai_message. Call flush() to wait for them.
+    """
     def __init__(self, 
                  memory_namespace: str, 
                  pubsub_topic: str = None, 
                  bucket_name: str = None,
-                 embedding = None):
+                 embedding = None,
+                 async_routing: bool = False):
         super().__init__()
         self.memory_namespace = memory_namespace
-        self.messages = []
+        # shared with the vectorstore manager, so cleared in place rather than replaced
+        self.messages = MessageStore()
         self.mem_path = None
+        self.offset_index = None
+        self.token_window = None
+        self.token_window_model = None
+        self.summary_checkpoint = None
         self.pubsub_manager = PubSubManager(memory_namespace, pubsub_topic=pubsub_topic)
-        self.embedding = embedding if embedding is not None else OpenAIEmbeddings()
+        self.embedding = cached_embeddings(embedding if embedding is not None else OpenAIEmbeddings())
         self.vectorstore_manager = MessageVectorStore(
             memory_namespace, 
             messages = self.messages, 
-            embedding=OpenAIEmbeddings(),
+            embedding=self.embedding,
             bucket_name=bucket_name)
+        self.router = MessageRouter(self._route_batch) if async_routing else None
     
     def set_bucket(self, bucket_name):
         if self.vectorstore_manager:
@@ -74,47 +94,90 @@ class PubSubChatMessageHistory(BaseChatMessageHistory):
         raise TypeError("Object of type datetime is not JSON serializable")
     
     def _write_to_disk(self, data, verbose:bool =False):
+        self._write_many_to_disk([data], verbose=verbose)
+
+    def _write_many_to_disk(self, timed_messages, verbose:bool =False):
         filepath = self.get_mem_path()
         if not filepath:
             return None
         
         os.makedirs(os.path.dirname(filepath), exist_ok=True)
 
-        data = data.dict()
+        lines = [(message.to_json() + '\n').encode('utf-8') for message in timed_messages]
 
-        # Append the new data as a JSON line
+        # Append the new data as JSON lines
         if verbose:
-            print(f"Writing to {filepath} with data")
-        with open(filepath, 'a') as f:
-            json.dump(data, f, default=self._datetime_converter)
-            f.write('\n')
+            print(f"Writing {len(lines)} messages to {filepath}")
+        index = self._get_offset_index()
+        with open(filepath, 'ab') as f:
+            offset = f.tell()
+            f.write(b"".join(lines))
+
+        # record where each line starts so load_chat_history can seek to any message
+        offsets = []
+        for line in lines:
+            offsets.append(offset)
+            offset += len(line)
+        index.append(offsets)
+
+    def _get_offset_index(self):
+        if self.offset_index is None:
+            self.offset_index = OffsetIndex(self.get_mem_path())
+            if os.path.isfile(self.get_mem_path()):
+                self.offset_index.sync()
+        return self.offset_index
 
     def _route_message(self, timed_message, verbose: bool=False):
 
         logging.debug('_route_message')
-        metadata = timed_message.metadata if timed_message.metadata is not None else {}
-        metadata["role"] = timed_message.role
-        metadata["timestamp"] = str(timed_message.timestamp)
-        metadata["embedding"] = self.embedding.embed_query(timed_message.content) if self.embedding is not None else ""
-        doc = Document(page_content=timed_message.content, metadata=metadata)
+        if self.router:
+            self.router.put((timed_message, verbose))
+            return
+        
+        self._route_messages([timed_message], verbose=verbose)
+
+    def _route_batch(self, batch):
+        # batch is a list of (timed_message, verbose) tuples queued by _route_message
+        verbose = any(v for _, v in batch)
+        self._route_messages([timed_message for timed_message, _ in batch], verbose=verbose)
+
+    def _route_messages(self, timed_messages, verbose: bool=False):
+
+        logging.debug(f'_route_messages: {len(timed_messages)} messages')
 
         # write to disk
         if self.memory_namespace:
-            logging.debug("_route_message: write to disk")
-            self._write_to_disk(timed_message, verbose=verbose)
+            logging.debug("_route_messages: write to disk")
+            self._write_many_to_disk(timed_messages, verbose=verbose)
         
         # Publish to Google Pub/Sub
         if self.pubsub_manager:
-            logging.debug("_route_message: pubsub")
-            self.pubsub_manager.publish_message(timed_message, verbose=verbose)
+            logging.debug("_route_messages: pubsub")
+            for timed_message in timed_messages:
+                self.pubsub_manager.publish_message(timed_message.to_json(), verbose=verbose)
 
         # save to vectorstore
         if self.vectorstore_manager:
-            logging.debug("_route_message: vectorstore")
-            metadata.pop("embedding")
-            doc = Document(page_content=timed_message.content, metadata=metadata)
-            self.save_vectorstore_memory([doc], verbose=verbose)
-            self.vectorstore_manager.messages.append(timed_message)
+            logging.debug("_route_messages: vectorstore")
+            docs = []
+            for timed_message in timed_messages:
+                metadata = timed_message.metadata
+                metadata["role"] = timed_message.role
+                metadata["timestamp"] = str(timed_message.timestamp)
+                docs.append(Document(page_content=timed_message.content, metadata=metadata))
+            self.save_vectorstore_memory(docs, verbose=verbose)
+
+    def flush(self, timeout: float=None):
+        """Waits for any messages queued for async routing to be written"""
+        if self.router:
+            return self.router.flush(timeout)
+        return True
+
+    def close(self):
+        """Routes any queued messages and stops the async routing thread"""
+        if self.router:
+            self.router.shutdown()
+            self.router = None
     
 
     def save_vectorstore_memory(self, docs, verbose=False):
@@ -124,6 +187,13 @@ class PubSubChatMessageHistory(BaseChatMessageHistory):
         logging.debug("Calling vectorstore_manager.save_vectorstore_memory")
         self.vectorstore_manager.save_vectorstore_memory(docs, verbose=verbose)
 
+    def delete_vectorstore_source(self, source: str):
+        if not self.vectorstore_manager:
+            print("No vectorstore found to delete from")
+            return
+        self.flush()
+        self.vectorstore_manager.delete_source_documents(source)
+
     def load_vectorstore_memory(self, verbose=False):
         if not self.vectorstore_manager:
             print("No vectorstore found to load")
@@ -132,31 +202,33 @@ class PubSubChatMessageHistory(BaseChatMessageHistory):
         return self.vectorstore_manager.load_vectorstore_memory(verbose=verbose)
 
     def add_user_message(self, message, metadata: dict=None, verbose=False):
-        timed_message = TimedChatMessage(content=message, role="user", metadata=metadata)
+        timed_message = self.messages.add(message, "user", metadata=metadata)
         self._route_message(timed_message, verbose=verbose)
 
-        self.messages.append(timed_message)
-
     def add_ai_message(self, message, metadata: dict=None, verbose=False):
-        timed_message = TimedChatMessage(content=message, role="ai", metadata=metadata)
+        timed_message = self.messages.add(message, "ai", metadata=metadata)
         self._route_message(timed_message, verbose=verbose)
 
-        self.messages.append(timed_message)
-
     def add_system_message(self, message, metadata:dict=None, verbose=False):
-        timed_message = TimedChatMessage(content=message, role="system", metadata=metadata)
+        timed_message = self.messages.add(message, "system", metadata=metadata)
         self._route_message(timed_message, verbose=verbose)
-
-        self.messages.append(timed_message)
     
     def clear(self):
+        self.flush()
         if self.memory_namespace:
             mem_path = self.get_mem_path()
             if mem_path and os.path.isfile(mem_path):
                 with open(self.get_mem_path(), 'w') as f:
                     f.write("\n")
+                OffsetIndex(mem_path).remove()
+                self.offset_index = None
+                summary_path = self.get_summary_path()
+                if os.path.isfile(summary_path):
+                    os.remove(summary_path)
                 print("Cleared memory")
-        self.messages = []
+        self.messages.clear()
+        self.token_window = None
+        self.summary_checkpoint = None
         
         # remove any vectorstore
         if self.vectorstore_manager:
@@ -178,46 +250,45 @@ class PubSubChatMessageHistory(BaseChatMessageHistory):
             i += 1
             print(message)
 
-    def _load_newline_json(self, mem_path, n):
-        with open(mem_path, 'r') as f:
-            i = 0
-            for line in f:
-                line = line.strip()  # Remove any leading/trailing whitespace
-                if line:  # Only process non-empty lines
-                    if n and n<=i:
-                        break
-                    i += 1
-                    message_data = json.loads(line)
-                    message_data['timestamp'] = parse(message_data['timestamp'])
-                expected_keys = {'timestamp', 'user', 'message'}  # Add expected keys here
-                metadata = {k: v for k, v in message_data.items() if k not in expected_keys}
-                if metadata:
-                    message_data['metadata'] = metadata
-
-                # Remove unexpected keys from message_data before passing to TimedChatMessage
-                for key in metadata:
-                    message_data.pop(key, None)
-
-                timed_message = TimedChatMessage(**message_data)
-                self.messages.append(timed_message)
-        print('Loaded')
-
-    def load_chat_history(self, n: int =None):
+    def _load_newline_json(self, mem_path, n=None, start=None):
+        for message_data in read_messages(mem_path, n=n, start=start):
+            self.messages.add(**message_data)
+        print(f'Loaded {len(self.messages)} messages')
+
+    def load_chat_history(self, n: int =None, start: int =None):
+        """
+        Loads messages from disk into self.messages.
+            n: load the most recent n messages, or n messages from start. None loads them all.
+            start: index of the first message to load
+        """
         if self.memory_namespace:
             mem_path = self.get_mem_path()
             if mem_path and os.path.isfile(mem_path):
                 print(f'Loading chat history from {mem_path}')
-                self._load_newline_json(mem_path, n)
+                self._load_newline_json(mem_path, n=n, start=start)
             else:
                 print("Chat history file does not exist.")
         else:
             print("Memory namespace not set.")
     
+    def _get_token_window(self, llm):
+        # token counts are cached per model, so a new llm gets a new window
+        model = getattr(llm, "model_name", type(llm).__name__)
+        if self.token_window is None or self.token_window_model != model:
+            self.token_window = TokenWindow(self.messages, llm.get_num_tokens)
+            self.token_window_model = model
+        return self.token_window
+
     def apply_buffer_to_memory(self, 
                                n = None,
                                max_token_limit: int =3000,
                                llm=OpenAI(),
                                memory_key: str ='history'):
+        """
+        A ConversationTokenBufferMemory holding the most recent user and ai messages that fit in max_token_limit tokens.
+        Token counts are kept between calls, so only messages added since the last call are counted.
+            n: at most the n most recent messages
+        """
 
         short_term_memory = ConversationTokenBufferMemory(
             llm=llm, 
@@ -225,47 +296,128 @@ class PubSubChatMessageHistory(BaseChatMessageHistory):
             memory_key=memory_key,
             return_messages=True)
 
-        # Load messages from TimedChatMessageHistory into ConversationTokenBufferMemory
-        short_term_memory = self._switch_memory(short_term_memory, n = n)
+        start = self._get_token_window(llm).start(max_token_limit, n=n)
+
+        # Load the window of messages straight into ConversationTokenBufferMemory
+        for message in self.messages[start:]:
+            if message.role == "user":
+                short_term_memory.chat_memory.add_user_message(message.content)
+            elif message.role == "ai":
+                short_term_memory.chat_memory.add_ai_message(message.content)
 
         return short_term_memory
     
+    def get_summary_path(self):
+        mem_path = self.get_mem_path()
+        if not mem_path:
+            return None
+        return os.path.join(os.path.dirname(mem_path), "summary_checkpoint.json")
+
+    def load_summary_checkpoint(self):
+        """
+        The last rolling summary and how many messages it covers: 
+        {"summary": str, "message_count": int, "timestamp": epoch of the last message summarised}
+        """
+        if self.summary_checkpoint is None:
+            self.summary_checkpoint = {"summary": "", "message_count": 0, "timestamp": None}
+            summary_path = self.get_summary_path()
+            if summary_path and os.path.isfile(summary_path):
+                with open(summary_path, 'r') as f:
+                    self.summary_checkpoint = json.load(f)
+
+        return self.summary_checkpoint
+
+    def _save_summary_checkpoint(self, checkpoint):
+        self.summary_checkpoint = checkpoint
+        summary_path = self.get_summary_path()
+        if not summary_path:
+            return
+        tmp_path = summary_path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(checkpoint, f)
+        os.replace(tmp_path, summary_path)
+
+    def _messages_since(self, message_count):
+        """Messages after the first message_count, from memory.json if there is one as self.messages may only hold the latest"""
+        mem_path = self.get_mem_path()
+        if mem_path and os.path.isfile(mem_path):
+            self.flush()
+            index = self._get_offset_index()
+            index.sync()
+            if len(index) < message_count:
+                return None, len(index)
+            return read_messages(mem_path, start=message_count), len(index)
+
+        if len(self.messages) < message_count:
+            return None, len(self.messages)
+        return self.messages[message_count:], len(self.messages)
+
     def apply_summarise_to_memory(self, 
                                   n = None,
                                   max_token_limit: int =3000,
                                   llm=OpenAI()):
+        """
+        Updates the rolling summary of the conversation with the messages added since the last summary.
+        The summary and how far it got are checkpointed to summary_checkpoint.json next to memory.json.
+            n: summarise at most n new messages this time, the rest are left for the next call
+            max_token_limit: new messages are folded into the summary in chunks of about this many tokens
+        """
+        checkpoint = self.load_summary_checkpoint()
+        new_messages, message_count = self._messages_since(checkpoint["message_count"])
+        if new_messages is None:
+            logging.info("Message history is shorter than the summary checkpoint, summarising from the start")
+            checkpoint = {"summary": "", "message_count": 0, "timestamp": None}
+            new_messages, message_count = self._messages_since(0)
+
+        if n:
+            new_messages = new_messages[:n]
+            message_count = checkpoint["message_count"] + len(new_messages)
+
+        if not new_messages:
+            return checkpoint["summary"]
 
         summary_memory = ConversationSummaryBufferMemory(
             llm=llm, 
             max_token_limit=max_token_limit)
         
-        summary_memory = self._switch_memory(summary_memory, n=n)
-        
-        messages = summary_memory.chat_memory.messages
-        
-        summary = summary_memory.predict_new_summary(messages, "")
-
-        self.add_ai_message(summary, metadata={"task": "summary"})
+        summary = checkpoint["summary"]
+        chunk = []
+        chunk_tokens = 0
+        for message in new_messages:
+            role, content, metadata = self._message_fields(message)
+            # earlier summaries are already in the summary
+            if metadata.get("task") == "summary" or role not in ("user", "ai"):
+                continue
+            tokens = llm.get_num_tokens(content)
+            if chunk and chunk_tokens + tokens > max_token_limit:
+                summary = summary_memory.predict_new_summary(chunk, summary)
+                chunk, chunk_tokens = [], 0
+            chunk.append(HumanMessage(content=content) if role == "user" else AIMessage(content=content))
+            chunk_tokens += tokens
+
+        if chunk:
+            summary = summary_memory.predict_new_summary(chunk, summary)
+
+        last_timestamp = self._message_fields(new_messages[-1], timestamp=True)
+        changed = summary != checkpoint["summary"]
+        self._save_summary_checkpoint({"summary": summary, 
+                                       "message_count": message_count, 
+                                       "timestamp": last_timestamp})
+        if changed:
+            self.add_ai_message(summary, metadata={"task": "summary"})
 
         return summary
-    
-    def _switch_memory(self, memory, n = None):
-        i = 0
-        for message in self.messages:
-            if n and i >= n:
-                break
-            i += 1
-            #print(message.content)
-            if message.role == "user":
-                memory.save_context({"input": message.content}, 
-                                    {"output": ""})
-            elif message.role == "ai":
-                memory.save_context({"input": ""}, 
-                                    {"output": message.content})
-        
-        return memory
-    
 
+    @staticmethod
+    def _message_fields(message, timestamp=False):
+        # messages are dicts when read from memory.json, MessageViews when from self.messages
+        if isinstance(message, dict):
+            if timestamp:
+                return to_epoch(message["timestamp"])
+            return message["role"], message["content"], message["metadata"]
+        if timestamp:
+            return message.epoch
+        return message.role, message.content, message.metadata
 
     @staticmethod
     def _get_chat_history(inputs) -> str:
@@ -291,10 +443,23 @@ Here is the chat history for this conversation between you (labelled AI) and me
                         verbose=False,
                         chat_history=None):
         
+        # make sure recent messages are searchable
+        self.flush()
+
+        # answers depend on the chat history too, so only cache questions asked without one
+        use_cache = answer_cache_enabled() and not chat_history
+        if use_cache:
+            question_vector = self.embedding.embed_query(question)
+            cached = answer_cache.lookup(self.memory_namespace, self.embedding.model_name, question_vector)
+            if cached is not None:
+                self.add_user_message(question, metadata={"task": "QnA"}, verbose=verbose)
+                self.add_ai_message(cached["result"], metadata=cached["metadata"], verbose=verbose)
+                return {"query": question, 
+                        "result": cached["result"], 
+                        "source_documents": cached["source_documents"],
+                        "cached": True}
+
         db = self.vectorstore_manager.load_vectorstore_memory()
-        docs = db.similarity_search(question)
-        if len(docs) == 0:
-            logging.info(f"No documents found similar to your question: {question}")
 
         history = None
         if chat_history:
@@ -331,6 +496,12 @@ Here is the chat history for this conversation between you (labelled AI) and me
             if history:
                 metadata["history"] = history
 
+        if use_cache:
+            answer_cache.add(self.memory_namespace, self.embedding.model_name, question_vector,
+                             {"result": answer, 
+                              "source_documents": result.get('source_documents'),
+                              "metadata": metadata})
+
         self.add_user_message(question, metadata={"task": "QnA"}, verbose=verbose)
         self.add_ai_message(answer, metadata=metadata, verbose=verbose)
 
@@ -0,0 +1,142 @@
+import atexit
+import queue
+import threading
+import time
+import logging
+
+logging.basicConfig(level=logging.INFO)
+
+_STOP = object()
+
+class MessageRouter:
+    """
+    Routes messages on a background thread, coalescing them into batches.
+        route_batch: function called with a list of queued items, e.g. PubSubChatMessageHistory._route_messages
+        max_queue_size: how many messages can wait before put() blocks the caller
+        batch_size: the most messages sent to route_batch in one call
+        flush_interval: seconds to wait for more messages before sending a partial batch
+        retries: how many times a failed batch is retried before its messages are routed one by one
+        retry_backoff: seconds before the first retry, doubling each time
+    """
+    def __init__(self, route_batch, max_queue_size: int=1000, batch_size: int=50, flush_interval: float=0.5,
+                 retries: int=2, retry_backoff: float=1.0):
+        self.route_batch = route_batch
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self.closed = False
+        self._lock = threading.Lock()
+
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+        # drain anything still queued when the interpreter exits
+        atexit.register(self.shutdown)
+
+    def put(self, item):
+        """Queues an item for routing, blocking if the queue is full"""
+        # under the lock so nothing can be queued behind the _STOP marker, where it would never be routed
+        with self._lock:
+            if self.closed:
+                raise RuntimeError("MessageRouter has been shut down")
+            self.queue.put(item)
+
+    def flush(self, timeout: float=None):
+        """
+        Blocks until every message queued so far has been routed.
+        Returns False if the timeout was reached first.
+        """
+        if timeout is None:
+            self.queue.join()
+            return True
+
+        done = threading.Event()
+        def wait():
+            self.queue.join()
+            done.set()
+        threading.Thread(target=wait, daemon=True).start()
+
+        return done.wait(timeout)
+
+    def shutdown(self, timeout: float=None):
+        """Routes all queued messages then stops the background thread"""
+        with self._lock:
+            if self.closed:
+                return
+            self.closed = True
+            logging.debug("MessageRouter shutting down")
+            self.queue.put(_STOP)
+
+        self.worker.join(timeout)
+        atexit.unregister(self.shutdown)
+
+    def _next_batch(self):
+        item = self.queue.get()
+        if item is _STOP:
+            return [], True
+
+        batch = [item]
+        stop = False
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self.queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is _STOP:
+                stop = True
+                break
+            batch.append(item)
+
+        return batch, stop
+
+    def _route(self, batch):
+        """
+        Routes a batch, retrying it with backoff if it fails.
+        If it still fails the messages are routed one at a time, so one bad message doesn't lose the rest,
+        and only those that fail again are logged and dropped.
+        """
+        backoff = self.retry_backoff
+        for attempt in range(self.retries + 1):
+            try:
+                self.route_batch(batch)
+                return
+            except Exception as e:
+                logging.warning(f"MessageRouter failed to route {len(batch)} messages (attempt {attempt + 1}): {e}")
+            if attempt < self.retries:
+                time.sleep(backoff)
+                backoff *= 2
+
+        if len(batch) == 1:
+            logging.error(f"MessageRouter dropped a message it could not route: {batch[0]}")
+            return
+
+        failed = 0
+        for item in batch:
+            try:
+                self.route_batch([item])
+            except Exception as e:
+                failed += 1
+                logging.error(f"MessageRouter dropped a message it could not route: {item}: {e}", exc_info=True)
+        if failed:
+            logging.error(f"MessageRouter dropped {failed} of {len(batch)} messages")
+
+    def _run(self):
+        while True:
+            batch, stop = self._next_batch()
+            if batch:
+                logging.debug(f"MessageRouter routing batch of {len(batch)} messages")
+                try:
+                    self._route(batch)
+                finally:
+                    for _ in batch:
+                        self.queue.task_done()
+            if stop:
+                # the _STOP marker itself
+                self.queue.task_done()
+                break
@@ -0,0 +1,154 @@
+import json
+from array import array
+from datetime import datetime, timezone
+
+def to_epoch(timestamp):
+    """Seconds since the epoch, treating naive datetimes as UTC like datetime.utcnow()"""
+    if timestamp is None:
+        return datetime.now(timezone.utc).timestamp()
+    if isinstance(timestamp, (int, float)):
+        return float(timestamp)
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return timestamp.timestamp()
+
+class MessageView:
+    """
+    One message in a MessageStore, read on access.
+    Has the content, role, timestamp and metadata attributes of a TimedChatMessage,
+    use to_message() where a real TimedChatMessage is needed.
+    metadata is decoded into a new dict on each access, so changing it does not change the message.
+    """
+    __slots__ = ('_store', '_i')
+
+    def __init__(self, store, i: int):
+        self._store = store
+        self._i = i
+
+    @property
+    def content(self):
+        return self._store._contents[self._i]
+
+    @property
+    def role(self):
+        return self._store._roles.values[self._store._role_ids[self._i]]
+
+    @property
+    def timestamp(self):
+        # naive UTC, as TimedChatMessage uses datetime.utcnow()
+        return datetime.fromtimestamp(self._store._timestamps[self._i], tz=timezone.utc).replace(tzinfo=None)
+
+    @property
+    def epoch(self):
+        return self._store._timestamps[self._i]
+
+    @property
+    def metadata(self):
+        return json.loads(self._store._metadata.values[self._store._metadata_ids[self._i]])
+
+    @property
+    def system_string(self):
+        return self._store._systems.values[self._store._system_ids[self._i]]
+
+    def to_dict(self):
+        """The fields written to memory.json and Pub/Sub"""
+        return {"content": self.content,
+                "role": self.role,
+                "timestamp": self.timestamp.isoformat(),
+                "metadata": self.metadata}
+
+    def to_json(self):
+        return json.dumps(self.to_dict())
+
+    def to_message(self):
+        from my_llm.timed_chat_message import TimedChatMessage
+        return TimedChatMessage(content=self.content, role=self.role,
+                                timestamp=self.timestamp, metadata=self.metadata)
+
+    def __repr__(self):
+        return f"MessageView(role={self.role!r}, timestamp={self.timestamp.isoformat()}, content={self.content!r})"
+
+class _Interned:
+    """A table of distinct values, each stored once and referred to by its position"""
+    def __init__(self):
+        self.values = []
+        self._ids = {}
+
+    def id(self, value):
+        i = self._ids.get(value)
+        if i is None:
+            i = self._ids[value] = len(self.values)
+            self.values.append(value)
+        return i
+
+class MessageStore:
+    """
+    A compact list of chat messages. Each field is kept in its own column:
+    roles, system info and metadata are interned and timestamps are epoch floats.
+    Indexing returns a MessageView, appending takes a TimedChatMessage, a ChatMessage or a MessageView.
+    """
+    def __init__(self, messages=None):
+        self._contents = []
+        self._role_ids = array('B')
+        self._timestamps = array('d')
+        self._metadata_ids = array('I')
+        self._system_ids = array('H')
+        self._roles = _Interned()
+        self._metadata = _Interned()
+        self._systems = _Interned()
+        if messages:
+            self.extend(messages)
+
+    def add(self, content: str, role: str, timestamp=None, metadata: dict=None, system_string: str=None):
+        """Adds a message from its fields and returns its MessageView"""
+        if system_string is None:
+            from my_llm.timed_chat_message import get_system_info
+            system_string = get_system_info()
+
+        self._contents.append(content)
+        self._role_ids.append(self._roles.id(role))
+        self._timestamps.append(to_epoch(timestamp))
+        self._metadata_ids.append(self._metadata.id(json.dumps(metadata or {}, sort_keys=True, default=str)))
+        self._system_ids.append(self._systems.id(system_string))
+
+        return MessageView(self, len(self._contents) - 1)
+
+    def append(self, message):
+        self.add(message.content, message.role,
+                 timestamp=getattr(message, "timestamp", None),
+                 metadata=getattr(message, "metadata", None),
+                 system_string=getattr(message, "system_string", None))
+
+    def extend(self, messages):
+        for message in messages:
+            self.append(message)
+
+    def clear(self):
+        self.__init__()
+
+    def __len__(self):
+        return len(self._contents)
+
+    def __bool__(self):
+        return len(self._contents) > 0
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [MessageView(self, j) for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("message index out of range")
+        return MessageView(self, i)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield MessageView(self, i)
+
+    def __reversed__(self):
+        for i in range(len(self) - 1, -1, -1):
+            yield MessageView(self, i)
+
+    def to_messages(self):
+        """TimedChatMessages for APIs that need pydantic objects"""
+        return [view.to_message() for view in self]
@@ -5,13 +5,110 @@ from google.auth import default
 
 import json
 import os
+import time
 import logging
+import threading
+from functools import lru_cache
+from concurrent import futures
 
 logging.basicConfig(level=logging.INFO)
 
+@lru_cache(maxsize=None)
+def default_project_id():
+    """The project ID from the default Google Cloud settings or the environment variable, looked up once"""
+    try:
+        _, project_id = default()
+    except Exception as e:
+        logging.info(f"No default Google Cloud credentials: {e}")
+        project_id = None
+    return project_id or os.environ.get('GOOGLE_CLOUD_PROJECT')
+
+_clients_lock = threading.Lock()
+_publisher = None
+_subscriber = None
+
+def get_publisher():
+    """
+    The PublisherClient shared by every PubSubManager in the process. It batches messages per topic.
+    Batches are sent at PUBSUB_BATCH_MESSAGES (default 100) messages, PUBSUB_BATCH_BYTES (default 1MB) 
+    or after PUBSUB_BATCH_LATENCY (default 0.05) seconds. Publishing blocks once PUBSUB_MAX_IN_FLIGHT 
+    (default 1000) messages or PUBSUB_MAX_IN_FLIGHT_BYTES (default 100MB) are waiting to be sent.
+    """
+    global _publisher
+    with _clients_lock:
+        if _publisher is None:
+            batch_settings = pubsub_v1.types.BatchSettings(
+                max_messages=int(os.getenv('PUBSUB_BATCH_MESSAGES', 100)),
+                max_bytes=int(os.getenv('PUBSUB_BATCH_BYTES', 1000000)),
+                max_latency=float(os.getenv('PUBSUB_BATCH_LATENCY', 0.05)),
+            )
+            flow_control = pubsub_v1.types.PublishFlowControl(
+                message_limit=int(os.getenv('PUBSUB_MAX_IN_FLIGHT', 1000)),
+                byte_limit=int(os.getenv('PUBSUB_MAX_IN_FLIGHT_BYTES', 100 * 1024 * 1024)),
+                limit_exceeded_behavior=pubsub_v1.types.LimitExceededBehavior.BLOCK,
+            )
+            _publisher = pubsub_v1.PublisherClient(
+                batch_settings=batch_settings,
+                publisher_options=pubsub_v1.types.PublisherOptions(flow_control=flow_control))
+        return _publisher
+
+def get_subscriber():
+    global _subscriber
+    with _clients_lock:
+        if _subscriber is None:
+            _subscriber = pubsub_v1.SubscriberClient()
+        return _subscriber
+
+class _KnownNames:
+    """Topics and subscriptions known to exist, so they are only looked up once per ttl seconds"""
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._expires = {}
+        self._lock = threading.Lock()
+
+    def __contains__(self, name):
+        with self._lock:
+            expires = self._expires.get(name)
+            if expires is None:
+                return False
+            if expires < time.monotonic():
+                del self._expires[name]
+                return False
+            return True
+
+    def add(self, name):
+        with self._lock:
+            self._expires[name] = time.monotonic() + self.ttl
+
+    def discard(self, name):
+        with self._lock:
+            self._expires.pop(name, None)
+
+known_topics = _KnownNames(float(os.getenv('PUBSUB_METADATA_TTL', 3600)))
+known_subscriptions = _KnownNames(float(os.getenv('PUBSUB_METADATA_TTL', 3600)))
+
+# publish futures not yet resolved, across every PubSubManager
+_in_flight = set()
+_in_flight_lock = threading.Lock()
+
+def flush(timeout: float=None):
+    """Waits for messages published so far to be sent, returns False if some were still pending at timeout"""
+    with _in_flight_lock:
+        pending = list(_in_flight)
+    if not pending:
+        return True
+    logging.info(f"Waiting for {len(pending)} Pub/Sub messages to be sent")
+    _, not_done = futures.wait(pending, timeout=timeout)
+    if not_done:
+        logging.warning(f"{len(not_done)} Pub/Sub messages still pending after {timeout}s")
+    return not not_done
+
 class PubSubManager:
     """
-    Creates a new PubSub topic is necessary and sends pubsub messages to it
+    Creates a new PubSub topic is necessary and sends pubsub messages to it.
+    Managers share one batching PublisherClient and SubscriberClient, and existing
+    topics and subscriptions are cached for PUBSUB_METADATA_TTL seconds.
+    Messages are published in the background, call flush() to wait for them.
     """
     def __init__(self, memory_namespace: str, pubsub_topic: str=None, project_id: str=None, verbose:bool=False):
         self.project_id = project_id
@@ -20,16 +117,14 @@ class PubSubManager:
         self.verbose = verbose
         self.memory_namespace = memory_namespace
 
-        # Get the project ID from the default Google Cloud settings or the environment variable
-        _, project_id = default()
-        self.project_id = project_id or os.environ.get('GOOGLE_CLOUD_PROJECT')
+        self.project_id = project_id or default_project_id()
 
         if self.project_id:
             logging.info(f"Project ID: {self.project_id}")
             # Create the Pub/Sub topic based on the project ID and memory_namespace
-            self.publisher = pubsub_v1.PublisherClient()
-            self.pubsub_topic = f"projects/{self.project_id}/topics/{pubsub_topic}" or \
-                                f"projects/{self.project_id}/topics/chat-messages-{memory_namespace}"
+            self.publisher = get_publisher()
+            topic_name = pubsub_topic or f"chat-messages-{memory_namespace}"
+            self.pubsub_topic = f"projects/{self.project_id}/topics/{topic_name}"
             self._create_pubsub_topic_if_not_exists()
 
         else:
@@ -38,32 +133,42 @@ class PubSubManager:
 
     def _create_pubsub_topic_if_not_exists(self):
         """Creates the Pub/Sub topic if it doesn't already exist."""
+        if self.pubsub_topic in known_topics:
+            return
         try:
             # Check if the topic exists
             self.publisher.get_topic(request={"topic": self.pubsub_topic})
         except NotFound:
             # If the topic does not exist, create it
-            self.publisher.create_topic(request={"name": self.pubsub_topic})
+            try:
+                self.publisher.create_topic(request={"name": self.pubsub_topic})
+            except AlreadyExists:
+                pass
             logging.info(f"Created Pub/Sub topic: {self.pubsub_topic}")
             if self.verbose:
                 print(f"Created Pub/Sub topic: {self.pubsub_topic}")
+        known_topics.add(self.pubsub_topic)
     
     def subscription_exists(self, subscription_name:str):
 
         full_subscription_name = f"projects/{self.project_id}/subscriptions/{subscription_name}"
-        # Create a subscriber client
-        subscriber = pubsub_v1.SubscriberClient()
+        if full_subscription_name in known_subscriptions:
+            return True
+
+        subscriber = get_subscriber()
 
         logging.info(f"Checking subscription exists: {full_subscription_name}")
         
         # Check if the subscription already exists
         try:
-            subscriber.get_subscription(full_subscription_name)
+            subscriber.get_subscription(request={"subscription": full_subscription_name})
             logging.info(f"Subscription {full_subscription_name} already exists.")
+            known_subscriptions.add(full_subscription_name)
             return True
         except NotFound:
             return False
         except AlreadyExists:
+            known_subscriptions.add(full_subscription_name)
             return True
         except Exception as e:
             logging.error(f"Failed to get subscription: {e}")
@@ -92,18 +197,18 @@ class PubSubManager:
                         logging.info("push_endpoint must start with / e.g. /pubsub_to_sink")
                         return
 
-            # Create a subscriber client
-            subscriber = pubsub_v1.SubscriberClient()
+            subscriber = get_subscriber()
             
             # Create a push configuration
             push_config = pubsub_v1.types.PushConfig()
             push_config.push_endpoint = push_endpoint
 
+            full_subscription_name = f"projects/{self.project_id}/subscriptions/{subscription_name}"
+
             # Check if the subscription already exists
             exists = self.subscription_exists(subscription_name)
 
             if not exists:
-                full_subscription_name = f"projects/{self.project_id}/subscriptions/{subscription_name}"
                 logging.info(f"Creating subscription {full_subscription_name}")
                 try:
                     subscriber.create_subscription(name=full_subscription_name, 
@@ -113,6 +218,9 @@ class PubSubManager:
                     logging.info(f"Created push subscription: {full_subscription_name}")
                     if self.verbose:
                         print(f"Created push subscription: {full_subscription_name}")
+                    known_subscriptions.add(full_subscription_name)
+                except AlreadyExists:
+                    known_subscriptions.add(full_subscription_name)
                 except Exception as e:
                     logging.error(f"Failed to create push subscription: {e}")
                     if self.verbose:
@@ -122,12 +230,18 @@ class PubSubManager:
 
     @staticmethod
     def _callback(future):
+        with _in_flight_lock:
+            _in_flight.discard(future)
         try:
             message_id = future.result()
             logging.info(f"Published message with ID: {message_id}")
         except Exception as e:
             logging.error(f"Failed to publish message: {e}")
 
+    def flush(self, timeout: float=None):
+        """Waits for published messages to be sent"""
+        return flush(timeout)
+
     def publish_message(self, message:str, verbose=False):
         """Publishes the given data to Google Pub/Sub."""
 
@@ -141,5 +255,8 @@ class PubSubManager:
             message_bytes = message.encode('utf-8')
             attr = "namespace:" + str(self.memory_namespace)
             future = self.publisher.publish(self.pubsub_topic, message_bytes, attrs=attr)
+            with _in_flight_lock:
+                _in_flight.add(future)
             future.add_done_callback(self._callback)
+            return future
 
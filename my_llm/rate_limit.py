@@ -0,0 +1,74 @@
+import time
+import random
+import threading
+import logging
+
+class TokenBucket:
+    """
+    A token bucket that refills continuously at rate_per_minute.
+        rate_per_minute: how many tokens are added per minute
+        capacity: the most tokens the bucket can hold, defaults to rate_per_minute
+    """
+    def __init__(self, rate_per_minute: float, capacity: float=None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity if capacity is not None else rate_per_minute
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, amount: float=1):
+        """Blocks until amount tokens are available then takes them"""
+        # a request bigger than the bucket would never be let through
+        amount = min(amount, self.capacity)
+        while True:
+            with self._lock:
+                self._refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                wait = (amount - self.tokens) / self.rate
+            time.sleep(wait)
+
+class RateLimiter:
+    """
+    Limits requests per minute and tokens per minute, e.g. for an LLM API.
+    A limit of None means no limit.
+    """
+    def __init__(self, requests_per_minute: float=None, tokens_per_minute: float=None):
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+
+    def acquire(self, tokens: int=0):
+        if self.requests is not None:
+            self.requests.acquire(1)
+        if self.tokens is not None and tokens:
+            self.tokens.acquire(tokens)
+
+def is_rate_limit_error(e: Exception):
+    """True if the exception is a HTTP 429 from OpenAI, Vertex or requests"""
+    if type(e).__name__ in ("RateLimitError", "ResourceExhausted", "TooManyRequests"):
+        return True
+    for attr in ("http_status", "status_code", "code"):
+        if getattr(e, attr, None) == 429:
+            return True
+    response = getattr(e, "response", None)
+    return getattr(response, "status_code", None) == 429
+
+def call_with_backoff(func, *args, max_retries: int=5, base_delay: float=1.0, max_delay: float=60.0, **kwargs):
+    """Calls func, retrying with exponential backoff and jitter when it is rate limited"""
+    attempt = 0
+    while True:
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            if not is_rate_limit_error(e) or attempt >= max_retries:
+                raise
+            delay = min(max_delay, base_delay * 2 ** attempt) * (0.5 + random.random() / 2)
+            attempt += 1
+            logging.info(f"Rate limited, retry {attempt} of {max_retries} in {delay:.1f}s: {e}")
+            time.sleep(delay)
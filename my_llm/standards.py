@@ -2,6 +2,7 @@ import openai
 import os
 import re
 import sys
+import tempfile
 
 # Add parent directory to sys.path
 parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
@@ -20,9 +21,15 @@ from .langchain_class import PubSubChatMessageHistory
 # Set up OpenAI API
 openai.api_key  = os.environ["OPENAI_API_KEY"]
 
-def init_memory(memory_namespace):
-    memory = PubSubChatMessageHistory(memory_namespace)
-    memory.load_chat_history()
+def init_memory(memory_namespace, async_routing: bool=False, n: int=None):
+    """
+    Loads the most recent n messages of memory_namespace, defaulting to MEMORY_LOAD_MESSAGES or 1000. 
+    0 loads the whole history.
+    """
+    if n is None:
+        n = int(os.getenv('MEMORY_LOAD_MESSAGES', 1000))
+    memory = PubSubChatMessageHistory(memory_namespace, async_routing=async_routing)
+    memory.load_chat_history(n=n or None)
     
     return memory
 
@@ -114,13 +121,35 @@ def request_code(prompt, chat, memory, verbose=False):
     return(code)
 
 
+# read once, as os.umask can only be read by setting it, which isn't thread safe
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
 # Save generated code to a file, make the folder if needed
 def save_to_file(filename, content, type="w"):
     dirname = os.path.dirname(filename)
     if dirname != "":
         os.makedirs(dirname, exist_ok=True)
-    with open(filename, type) as file:
-        file.write(content)
+    if type != "w":
+        with open(filename, type) as file:
+            file.write(content)
+        return
+
+    # overwrites via a temp file so an interrupted write never leaves a truncated file
+    fd, tmp_path = tempfile.mkstemp(dir=dirname or ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as file:
+            file.write(content)
+        # mkstemp files are 0600, give it the mode open() would have
+        try:
+            mode = os.stat(filename).st_mode & 0o777
+        except FileNotFoundError:
+            mode = 0o666 & ~_UMASK
+        os.chmod(tmp_path, mode)
+        os.replace(tmp_path, filename)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
 
 def new_vector_db(path, source_chunks, embedding=OpenAIEmbeddings()):
     # Define the path of the repository and Chroma DB
@@ -5,8 +5,17 @@ import getpass
 import platform
 import sys
 from datetime import datetime
+from functools import lru_cache
 from pydantic import Field
 
+@lru_cache(maxsize=None)
+def get_system_info():
+    """The user, OS and python version - the same for every message so only looked up once"""
+    user = getpass.getuser()
+    os_name = str(platform.uname())
+    python_version = sys.version
+
+    return f"{user} : {os_name} : {python_version}"
 
 class TimedChatMessage(ChatMessage):
     """A ChatMessage that has a timestamp and metadata field added to it"""
@@ -22,12 +31,7 @@ class TimedChatMessage(ChatMessage):
         super().__init__(content=content, role=role, **kwargs)
 
     def _get_system_info(self):
-        user = getpass.getuser()
-        os_name = str(platform.uname())
-        python_version = sys.version
-
-        info = f"{user} : {os_name} : {python_version}"
-        return info
+        return get_system_info()
 
     def to_dict(self) -> Dict[str, Any]:
             base_dict = super().dict()
@@ -0,0 +1,52 @@
+from array import array
+from bisect import bisect_left
+
+# the prefixes get_buffer_string gives each role in a ConversationChain prompt
+ROLE_PREFIXES = {"user": "Human", "ai": "AI"}
+
+class TokenWindow:
+    """
+    Finds the most recent messages that fit in a token budget without replaying the history.
+    Each message is counted once, the first time the window is asked for after it was added,
+    and running totals give the start of the window with a binary search.
+        messages: the MessageStore (or list) of messages, only appended to or cleared
+        count_tokens: function returning the tokens in a string e.g. llm.get_num_tokens
+    Only user and ai messages count towards the budget, as only they go into the memory.
+    """
+    def __init__(self, messages, count_tokens):
+        self.messages = messages
+        self.count_tokens = count_tokens
+        # cumulative[i] is the tokens of messages[:i]
+        self.cumulative = array('Q', [0])
+
+    def _count(self, message):
+        prefix = ROLE_PREFIXES.get(message.role)
+        if prefix is None:
+            return 0
+        return self.count_tokens(f"{prefix}: {message.content}")
+
+    def update(self):
+        """Counts the messages added since the last call"""
+        counted = len(self.cumulative) - 1
+        if len(self.messages) < counted:
+            # the messages were cleared
+            self.cumulative = array('Q', [0])
+            counted = 0
+        total = self.cumulative[-1]
+        for message in self.messages[counted:]:
+            total += self._count(message)
+            self.cumulative.append(total)
+
+    def start(self, max_token_limit: int, n: int=None):
+        """The index of the first message of the newest messages totalling at most max_token_limit tokens, and at most n messages"""
+        self.update()
+        total = self.cumulative[-1]
+        start = bisect_left(self.cumulative, total - max_token_limit)
+        if n:
+            start = max(start, len(self.cumulative) - 1 - n)
+        return start
+
+    def tokens(self, start: int=0):
+        """Tokens of the messages from start to the end"""
+        self.update()
+        return self.cumulative[-1] - self.cumulative[start]
@@ -1,10 +1,15 @@
 import os
+import json
+import base64
+import hashlib
 import shutil
 import atexit
+import tarfile
+import tempfile
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 
 from langchain.docstore.document import Document
-from langchain.text_splitter import CharacterTextSplitter
 
 from langchain.vectorstores import Chroma
 
@@ -12,6 +17,9 @@ from google.api_core.exceptions import NotFound
 
 from google.cloud import storage
 
+from my_llm.answer_cache import invalidate_answers
+from my_llm.chunking import chunk_documents
+
 import logging
 import traceback
 import time
@@ -22,6 +30,7 @@ logging.basicConfig(level=logging.INFO)
 class MessageVectorStore:
     """
     Creates a VectorStore and stores messages within it.
+    When a bucket is set, changed files are uploaded to GCS every 5 minutes and at exit.
         memory_namespace: Governs where vectordata is stored
         messages: Messages sent to this VectorStore
         embedding: The Embedding that is used within this VectorStore e.g. OpenAIEmbeddings()
@@ -36,6 +45,12 @@ class MessageVectorStore:
         self.bucket_client = None
         self.sync_started = False
         self.autosave_gcs = False
+        # set when the vectorstore changes, cleared once it is uploaded
+        self.dirty = False
+        self._sync_lock = threading.Lock()
+        self.sync_workers = int(os.getenv('GCS_SYNC_WORKERS', 8))
+        # upload and download one .tar.gz instead of the files of the directory
+        self.snapshot_mode = os.getenv('VECTORSTORE_SNAPSHOT', 'false').lower() in ('1', 'true')
 
         if self.bucket_name:
             self._get_set_bucket_client(self.bucket_name)
@@ -62,6 +77,7 @@ class MessageVectorStore:
         Clears the vectorstore directory.
         """
         dir_path = self.get_mem_vectorstore()
+        invalidate_answers(self.memory_namespace)
 
         if dir_path and dir_path.is_dir():
             try:
@@ -78,6 +94,11 @@ class MessageVectorStore:
 
         source_chunks = self._get_source_chunks(documents)
         ids = vector_db.add_documents(source_chunks)
+        self.dirty = True
+
+        # QnA messages record answers, anything else may change them
+        if any(chunk.metadata.get("task") != "QnA" for chunk in source_chunks):
+            invalidate_answers(self.memory_namespace)
 
         logging.info(f'Saved {len(ids)} documents to vectorstore:')
         for chunk in source_chunks:
@@ -86,12 +107,25 @@ class MessageVectorStore:
 
         return ids
 
+    def delete_source_documents(self, source: str):
+        """
+        Deletes all documents whose metadata 'source' matches source
+        """
+        vector_db = self.load_vectorstore_memory()
+        if vector_db is None:
+            return
+
+        logging.info(f"Deleting documents with source {source} from vectorstore")
+        vector_db._collection.delete(where={"source": source})
+        self.dirty = True
+        invalidate_answers(self.memory_namespace)
+
     def start_periodic_sync(self, sync_interval):
         logging.info("Starting periodic sync")
         def periodic_sync():
             while True:
                 time.sleep(sync_interval)
-                if self.bucket_name:
+                if self.bucket_name and self.dirty:
                     self.save_vectorstore_gcs(self.bucket_name)
 
         sync_thread = threading.Thread(target=periodic_sync, daemon=True)
@@ -218,31 +252,138 @@ class MessageVectorStore:
             return
 
         os.makedirs(local_dir, exist_ok=True)
-        self._download_directory(self.bucket_client, directory_path, local_dir)
+        if self.snapshot_mode and self._snapshot_blob(directory_path).exists():
+            self._download_snapshot(self._snapshot_blob(directory_path), local_dir)
+        else:
+            self._download_directory(self.bucket_client, directory_path, local_dir)
 
         self.auto_save_vectorstore_gcs(bucket_name)
 
+    @staticmethod
+    def _md5(filepath):
+        """base64 md5 of a file, as in the md5_hash of a GCS blob"""
+        md5 = hashlib.md5()
+        with open(filepath, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                md5.update(block)
+        return base64.b64encode(md5.digest()).decode('utf-8')
+
+    def _sync_manifest_path(self, local_dir):
+        return f"{str(local_dir).rstrip(os.sep)}.gcs_manifest.json"
+
+    def _load_sync_manifest(self, local_dir):
+        """{relative path: {"mtime", "size", "md5"}} of the files as they were last synced with GCS"""
+        manifest_path = self._sync_manifest_path(local_dir)
+        if not os.path.isfile(manifest_path):
+            return {}
+        with open(manifest_path, "r") as f:
+            return json.load(f)
+
+    def _save_sync_manifest(self, local_dir, manifest):
+        manifest_path = self._sync_manifest_path(local_dir)
+        tmp_path = manifest_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, manifest_path)
+
+    def _local_files(self, local_dir, manifest):
+        """The manifest entries of the files now in local_dir, only hashing files whose mtime or size changed"""
+        files = {}
+        for root, dirs, filenames in os.walk(local_dir):
+            for filename in filenames:
+                local_filepath = os.path.join(root, filename)
+                relpath = os.path.relpath(local_filepath, local_dir)
+                stat = os.stat(local_filepath)
+                entry = manifest.get(relpath)
+                if entry and entry["mtime"] == stat.st_mtime and entry["size"] == stat.st_size:
+                    files[relpath] = entry
+                else:
+                    files[relpath] = {"mtime": stat.st_mtime, "size": stat.st_size, "md5": self._md5(local_filepath)}
+        return files
+
     def _download_directory(self, bucket, prefix, local_dir):
         """
-        Download a directory and its contents from GCS bucket to a local directory.
+        Download a directory and its contents from GCS bucket to a local directory, 
+        in parallel and skipping files that are already the same locally.
         """
-        for blob in bucket.list_blobs(prefix=prefix):
-            local_filepath = os.path.join(local_dir, os.path.relpath(blob.name, prefix))
+        manifest = self._load_sync_manifest(local_dir)
+        local_files = self._local_files(local_dir, manifest)
+
+        def download(blob, local_filepath):
             os.makedirs(os.path.dirname(local_filepath), exist_ok=True)
-            with open(local_filepath, "wb") as local_file:
-                blob.download_to_file(local_file)
+            blob.download_to_filename(local_filepath)
+            return local_filepath
+
+        jobs = []
+        for blob in bucket.list_blobs(prefix=prefix + "/"):
+            relpath = os.path.relpath(blob.name, prefix)
+            local = local_files.get(relpath)
+            if local is not None and local["md5"] == blob.md5_hash:
+                continue
+            jobs.append((blob, os.path.join(local_dir, relpath)))
+
+        logging.info(f"Downloading {len(jobs)} files from gs://{bucket.name}/{prefix} with {self.sync_workers} workers")
+        with ThreadPoolExecutor(max_workers=self.sync_workers) as executor:
+            for local_filepath in executor.map(lambda job: download(*job), jobs):
+                logging.debug(f"Downloaded {local_filepath}")
+
+        self._save_sync_manifest(local_dir, self._local_files(local_dir, local_files))
 
     def _upload_directory(self, bucket, prefix, local_dir):
         """
-        Upload a local directory and its contents to a GCS bucket.
+        Upload the files of a local directory that changed since the last sync to a GCS bucket, in parallel.
+        Files deleted locally are deleted from the bucket.
         """
-        for root, dirs, files in os.walk(local_dir):
-            for file in files:
-                local_filepath = os.path.join(root, file)
-                remote_filepath = os.path.join(prefix, os.path.relpath(local_filepath, local_dir))
-                blob = storage.Blob(remote_filepath, bucket)
-                with open(local_filepath, "rb") as local_file:
-                    blob.upload_from_file(local_file)
+        manifest = self._load_sync_manifest(local_dir)
+        local_files = self._local_files(local_dir, manifest)
+
+        changed = [relpath for relpath, entry in local_files.items() 
+                   if manifest.get(relpath, {}).get("md5") != entry["md5"]]
+        deleted = [relpath for relpath in manifest if relpath not in local_files]
+
+        def upload(relpath):
+            blob = storage.Blob(f"{prefix}/{relpath}", bucket)
+            blob.upload_from_filename(os.path.join(local_dir, relpath))
+            return relpath
+
+        def delete(relpath):
+            try:
+                storage.Blob(f"{prefix}/{relpath}", bucket).delete()
+            except NotFound:
+                pass
+            return relpath
+
+        logging.info(f"Uploading {len(changed)} changed files and deleting {len(deleted)} from gs://{bucket.name}/{prefix}")
+        with ThreadPoolExecutor(max_workers=self.sync_workers) as executor:
+            for relpath in executor.map(upload, changed):
+                logging.debug(f"Uploaded {relpath}")
+            for relpath in executor.map(delete, deleted):
+                logging.debug(f"Deleted {relpath}")
+
+        self._save_sync_manifest(local_dir, local_files)
+
+    def _snapshot_blob(self, prefix):
+        return storage.Blob(f"{prefix}.tar.gz", self.bucket_client)
+
+    def _upload_snapshot(self, blob, local_dir):
+        """Uploads local_dir as one compressed archive"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            archive = os.path.join(temp_dir, "snapshot.tar.gz")
+            with tarfile.open(archive, "w:gz") as tar:
+                tar.add(local_dir, arcname=".")
+            blob.upload_from_filename(archive)
+        logging.info(f"Uploaded snapshot of {local_dir} to gs://{blob.bucket.name}/{blob.name}")
+
+    def _download_snapshot(self, blob, local_dir):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            archive = os.path.join(temp_dir, "snapshot.tar.gz")
+            blob.download_to_filename(archive)
+            with tarfile.open(archive, "r:gz") as tar:
+                if hasattr(tarfile, "data_filter"):
+                    tar.extractall(local_dir, filter="data")
+                else:
+                    tar.extractall(local_dir)
+        logging.info(f"Restored {local_dir} from snapshot gs://{blob.bucket.name}/{blob.name}")
 
     def save_vectorstore_gcs(self, bucket_name):
     
@@ -254,13 +395,31 @@ class MessageVectorStore:
             logging.info("No local directory specified for vectorstore")
             return
 
-        logging.info(f"Saving local {local_dir} vectorstore to GCS bucket {bucket_name} / {directory_path}")
-        
         self._get_set_bucket_client(bucket_name)
 
-        if self.bucket_client:
-            logging.debug(f"Uploading files")
-            self._upload_directory(self.bucket_client, directory_path, local_dir)
+        if not self.bucket_client:
+            return
+
+        # the periodic sync and atexit can overlap
+        with self._sync_lock:
+            if not self.dirty:
+                logging.debug("Vectorstore unchanged since last upload")
+                return
+            
+            logging.info(f"Saving local {local_dir} vectorstore to GCS bucket {bucket_name} / {directory_path}")
+            # clear first so changes made during the upload are caught next time
+            self.dirty = False
+            try:
+                # chroma only writes its files on persist
+                if self.vector_db is not None:
+                    self.vector_db.persist()
+                if self.snapshot_mode:
+                    self._upload_snapshot(self._snapshot_blob(directory_path), local_dir)
+                else:
+                    self._upload_directory(self.bucket_client, directory_path, local_dir)
+            except Exception:
+                self.dirty = True
+                raise
             logging.info(f"Upload complete")
 
     def auto_save_vectorstore_gcs(self, bucket_name):
@@ -284,9 +443,10 @@ class MessageVectorStore:
         logging.info(what_we_are_doing)
 
         # we need a few messages to init the db
+        # the same text for every namespace so the embeddings come from the cache
         init_docs = []
         for i in range(5):
-            doc = Document(page_content=what_we_are_doing+str(i), metadata={'task': 'chromadb_init'})
+            doc = Document(page_content=f"Creating Chroma DB {i}", metadata={'task': 'chromadb_init'})
             init_docs.append(doc)
 
         vector_db = Chroma.from_documents(init_docs, 
@@ -294,6 +454,7 @@ class MessageVectorStore:
                                           persist_directory=str(db_path))
         self.vector_db = vector_db
         vector_db.persist()
+        self.dirty = True
 
         if self.bucket_name:
             self.auto_save_vectorstore_gcs(self.bucket_name)
@@ -301,20 +462,11 @@ class MessageVectorStore:
         return vector_db
 
     def _get_source_chunks(self, documents=None):
-        source_chunks = []
-
         if documents is None:
             documents = self._get_memory_documents()
-        # Create a CharacterTextSplitter object for splitting the text
-        splitter = CharacterTextSplitter(separator=" ", 
-                                         chunk_size=2048, 
-                                         chunk_overlap=0)
-        for source in documents:
-            for chunk in splitter.split_text(source.page_content):
-                source_chunks.append(Document(page_content=chunk, 
-                                              metadata=source.metadata))
-
-        return source_chunks
+
+        # 512 tokens is about the 2048 characters this used to split at
+        return chunk_documents(documents, extension=".txt", size=512, overlap=0)
     
     def _get_memory_documents(self):
         docs = []
@@ -0,0 +1,117 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from langchain.schema import HumanMessage
+from langchain.callbacks import get_openai_callback
+
+from my_llm import standards as my_llm
+from my_llm.rate_limit import RateLimiter, call_with_backoff, is_rate_limit_error
+
+import logging
+
+# errors no other file will get past either, so the rest of the run is cancelled
+FATAL_ERRORS = ("AuthenticationError", "PermissionError", "PermissionDenied", "Unauthenticated", "APIConnectionError")
+
+def is_fatal_error(e: Exception):
+    return is_rate_limit_error(e) or type(e).__name__ in FATAL_ERRORS
+
+class ParallelSummariser:
+    """
+    Summarises file chunks concurrently. Each chunk is sent to the LLM on its own,
+    without replaying chat memory, as summaries are independent per file.
+        chat: the chat model e.g. ChatOpenAI()
+        workers: how many LLM requests run at once
+        requests_per_minute, tokens_per_minute: rate limits for the LLM API, None for no limit
+        max_retries: retries with backoff when the API returns a 429
+        completion_tokens: expected tokens per summary, counted against tokens_per_minute
+    """
+    def __init__(self, chat, workers: int=4,
+                 requests_per_minute: int=None,
+                 tokens_per_minute: int=None,
+                 max_retries: int=5,
+                 completion_tokens: int=500):
+        self.chat = chat
+        self.workers = workers
+        self.rate_limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+        self.max_retries = max_retries
+        self.completion_tokens = completion_tokens
+        # summary file names that failed in the last summarise_files
+        self.failed = []
+        self._totals_lock = threading.Lock()
+
+    def _count_tokens(self, text):
+        try:
+            return self.chat.get_num_tokens(text)
+        except Exception:
+            return len(text) // 4
+
+    def _request(self, prompt: str):
+        with get_openai_callback() as cb:
+            output = self.chat([HumanMessage(content=prompt)]).content
+        with self._totals_lock:
+            my_llm.totals["total_tokens"] += cb.total_tokens
+            my_llm.totals["prompt_tokens"] += cb.prompt_tokens
+            my_llm.totals["completion_tokens"] += cb.completion_tokens
+            my_llm.totals["successful_requests"] += cb.successful_requests
+            my_llm.totals["total_cost"] += cb.total_cost
+        return output
+
+    def summarise_chunk(self, prompt: str):
+        tokens = self._count_tokens(prompt) + self.completion_tokens
+
+        def attempt():
+            # each retry after a 429 counts against the limits too
+            self.rate_limiter.acquire(tokens)
+            return self._request(prompt)
+
+        return call_with_backoff(attempt, max_retries=self.max_retries)
+
+    def summarise_files(self, jobs, memory=None, verbose=False):
+        """
+        Summarises files in parallel and writes each summary once all its chunks are done.
+            jobs: list of (summary_file_name, [chunk prompts]) from read_repo.prepare_summary
+            memory: if given, each prompt and summary is added to it in file order
+        Yields each summary_file_name that was written, in the order of jobs.
+        A file whose summary fails is logged, skipped and added to self.failed. Rate limits that outlast the retries
+        and authentication errors cancel the requests not yet started and are raised.
+        """
+        self.failed = []
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = [[executor.submit(self.summarise_chunk, prompt) for prompt in prompts]
+                       for _, prompts in jobs]
+
+            def cancel(file_futures):
+                for future in file_futures:
+                    future.cancel()
+
+            try:
+                for (new_file_name, prompts), file_futures in zip(jobs, futures):
+                    summaries = []
+                    try:
+                        for i, future in enumerate(file_futures):
+                            summaries.append(future.result())
+                            logging.info(f"Summarised chunk {i} of {len(prompts)} for {new_file_name}")
+                    except Exception as e:
+                        if is_fatal_error(e):
+                            raise
+                        logging.error(f"Could not summarise {new_file_name}, skipping it: {e}")
+                        self.failed.append(new_file_name)
+                        cancel(file_futures)
+                        continue
+
+                    if memory is not None:
+                        for prompt, summary in zip(prompts, summaries):
+                            memory.add_user_message(prompt, metadata={'task':'summarise_chunk'})
+                            memory.add_ai_message(summary, metadata={'task':'summarise_chunk'})
+
+                    my_llm.save_to_file(new_file_name, "".join(summary + '\n\n' for summary in summaries))
+                    if verbose:
+                        print(f"Wrote summary {new_file_name}")
+                        print(f"Usage: {my_llm.totals}")
+
+                    yield new_file_name
+            except BaseException:
+                # don't pay for requests whose results would be thrown away
+                for file_futures in futures:
+                    cancel(file_futures)
+                raise
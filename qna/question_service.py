@@ -1,61 +1,87 @@
 import os, logging, sys
 
 from langchain.vectorstores import SupabaseVectorStore
-from langchain.embeddings import OpenAIEmbeddings
-from langchain.llms import OpenAI
-
-from langchain.llms import VertexAI
-from langchain.embeddings import VertexAIEmbeddings
 
 #https://python.langchain.com/en/latest/modules/chains/index_examples/chat_vector_db.html
 from langchain.chains import ConversationalRetrievalChain
+from langchain.chains.conversational_retrieval.base import _get_chat_history
 
-from supabase import Client, create_client
+from supabase import Client
+from my_llm.client_registry import registry, llm_provider, get_llm, get_embeddings, get_supabase_client
+from my_llm.answer_cache import answer_cache, answer_cache_enabled
 from dotenv import load_dotenv
 
 load_dotenv()
 
-def qna(question: str, vector_name: str, chat_history=None):
-
-    llm = None
-    embeddings = None
-    llm_str = 'openai' if os.getenv('OPENAI_API_KEY', None) is not None else 'vertex'
-    logging.info(f'Using embeddings: {llm_str}')
-
-    if llm_str == 'openai':
-        llm = OpenAI(temperature=0)
-        embeddings = OpenAIEmbeddings()
-    elif llm_str == 'vertex':
-        llm = VertexAI(temperature=0)
-        embeddings = VertexAIEmbeddings()
-    else:
-        raise NotImplementedError(f'No llm implemented for {llm_str}')
-
-    logging.info(f"Initiating Supabase store: {vector_name}")
-    # init embedding and vector store
-    supabase_url = os.getenv('SUPABASE_URL')
-    supabase_key = os.getenv('SUPABASE_KEY')
-
-    logging.info(f"Supabase URL: {supabase_url} vector_name: {vector_name}")
-    
-    supabase: Client = create_client(supabase_url, supabase_key)
-
-    vectorstore = SupabaseVectorStore(supabase, 
-                                      embeddings, 
-                                      table_name=vector_name,
-                                      query_name=f'match_documents_{vector_name}')
-
-    logging.info(f"vectorstore.table_name {vectorstore.table_name}")
-
-    retriever = vectorstore.as_retriever(search_kwargs=dict(k=4))
-
-    qa = ConversationalRetrievalChain.from_llm(llm, 
-                                               retriever=retriever, 
-                                               return_source_documents=True,
-                                               verbose=True,
-                                               output_key='answer',
-                                               max_tokens_limit=3500)
-
-    result = qa({"question": question, "chat_history": chat_history})
-    
-    return result
\ No newline at end of file
+def _verbose():
+    # printing whole prompts is slow and noisy, so only when debugging
+    return os.getenv('QNA_VERBOSE', 'false').lower() in ('1', 'true')
+
+def get_chain(vector_name: str, provider: str=None, k: int=4, max_tokens_limit: int=3500):
+    """
+    Returns a ConversationalRetrievalChain for vector_name, built once and reused for every question.
+    Cached per (vector_name, provider, k, max_tokens_limit) until invalidate_chain() or the registry ttl.
+    """
+    llm_str = provider or llm_provider()
+
+    def factory():
+        logging.info(f'Using embeddings: {llm_str}')
+
+        llm = get_llm(llm_str)
+        embeddings = get_embeddings(llm_str)
+
+        logging.info(f"Initiating Supabase store: {vector_name}")
+        # init embedding and vector store
+        supabase: Client = get_supabase_client()
+
+        vectorstore = SupabaseVectorStore(supabase, 
+                                          embeddings, 
+                                          table_name=vector_name,
+                                          query_name=f'match_documents_{vector_name}')
+
+        logging.info(f"vectorstore.table_name {vectorstore.table_name}")
+
+        retriever = vectorstore.as_retriever(search_kwargs=dict(k=k))
+
+        return ConversationalRetrievalChain.from_llm(llm, 
+                                                     retriever=retriever, 
+                                                     return_source_documents=True,
+                                                     verbose=_verbose(),
+                                                     output_key='answer',
+                                                     max_tokens_limit=max_tokens_limit)
+
+    return registry.get("qna_chain", (vector_name, llm_str, k, max_tokens_limit), factory)
+
+def invalidate_chain(vector_name: str=None):
+    """Drops cached chains for vector_name, or all chains if None, so they are rebuilt on the next question"""
+    registry.invalidate_where("qna_chain", lambda key: vector_name is None or key[0] == vector_name)
+
+def qna(question: str, vector_name: str, chat_history=None, k: int=4, max_tokens_limit: int=3500):
+
+    llm_str = llm_provider()
+    qa = get_chain(vector_name, provider=llm_str, k=k, max_tokens_limit=max_tokens_limit)
+
+    if not answer_cache_enabled():
+        return qa({"question": question, "chat_history": chat_history or []})
+
+    # condense the question with the chat history ourselves so the standalone question can be looked up
+    standalone = question
+    if chat_history:
+        get_chat_history = qa.get_chat_history or _get_chat_history
+        standalone = qa.question_generator.run(question=question, 
+                                               chat_history=get_chat_history(chat_history))
+        logging.info(f"Standalone question: {standalone}")
+
+    embeddings = get_embeddings(llm_str)
+    vector = embeddings.embed_query(standalone)
+    cached = answer_cache.lookup(vector_name, llm_str, vector)
+    if cached is not None:
+        return dict(cached, question=question, chat_history=chat_history, cached=True)
+
+    # an empty chat history stops the chain condensing the question again
+    result = qa({"question": standalone, "chat_history": []})
+    answer_cache.add(vector_name, llm_str, vector, 
+                     {"answer": result["answer"], 
+                      "source_documents": result.get("source_documents")})
+
+    return dict(result, question=question, chat_history=chat_history)
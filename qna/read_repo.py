@@ -8,10 +8,12 @@ sys.path.append(parent_dir)
 import pathlib
 
 from langchain.docstore.document import Document
-import langchain.text_splitter as text_splitter
 from langchain.chat_models import ChatOpenAI
 from my_llm import standards as my_llm
 from my_llm.langchain_class import PubSubChatMessageHistory
+from my_llm.chunking import iter_chunks, chunk_documents
+from qna.repo_manifest import RepoManifest
+from qna.parallel_summary import ParallelSummariser
 from langchain import PromptTemplate
 from langchain.document_loaders.unstructured import UnstructuredFileLoader
 
@@ -25,56 +27,87 @@ CODE_EXTENSIONS = [".py", ".js", ".java", ".c", ".cpp", ".cc", ".cxx", ".hpp",
                    ".bash", ".r", ".m", ".sql", ".html", ".css", ".xml", ".json",
                      ".yaml", ".yml"]
 
-# Get Markdown documents from a repository
-def get_repo_docs(repo_path, extension, memory, ignore=None, resummarise=False, verbose=False):
-    repo = pathlib.Path(repo_path)
+def list_repo_files(repo_path, extension, ignore=None):
+    """Returns the absolute paths of files in repo_path matching the comma separated extensions"""
+    repo = pathlib.Path(repo_path).resolve()
 
-    ignore_path = ""
+    ignore_path = None
     if ignore is not None:
         ignore_path = repo / ignore
         if not ignore_path.is_dir():
             print("WARNING: --ignore must be a directory")
         
         print('Ignoring %s' % ignore_path)
-    
-    exts = extension.split(",")
-    for ext in exts:
-        the_glob = f"**/*{ext}"
-        matched_files = list(repo.glob(the_glob))
-        num_matched_files = len(matched_files)
-        print(f"Number of matched {ext} files: {num_matched_files}")
-
-        # Generate summary md files
-        if ext!=".md":
-            k = 0
-            for non_md_file in repo.glob(the_glob):
-                k += 1
-                if str(non_md_file).startswith(str(ignore_path)):
-                      continue
-                generate_summary(non_md_file, memory, resummarise=resummarise, verbose=verbose)
-                if verbose:
-                    print(f"Generated summary for a {ext} file: {k} of {num_matched_files} done.")
-                              
-		# Iterate over all files in the repo (including subdirectories)
-        print(f"Reading {ext} files")
-        i = 0
-        j = 0
-        for md_file in repo.glob(the_glob):
-
-            if str(md_file).startswith(str(ignore_path)):
-                j += 1
+
+    files = []
+    for ext in extension.split(","):
+        matched_files = [a_file for a_file in repo.glob(f"**/*{ext}") if a_file.is_file()]
+        print(f"Number of matched {ext} files: {len(matched_files)}")
+        for a_file in matched_files:
+            if ignore_path is not None and str(a_file).startswith(str(ignore_path)):
                 continue
-            
-            i += 1
-			# Read the content of the file
-            yield read_file_to_document(md_file)
-            
-            if verbose:
-                print(f"Read {i} files so far and ignored {j}: total: {num_matched_files}")
+            files.append(a_file)
+
+    return files
+
+# Get Markdown documents from a repository
+def get_repo_docs(repo_path, extension, memory, ignore=None, resummarise=False, verbose=False, 
+                  manifest=None, full_reindex=False, summary_config: dict=None):
+    """
+    Yields a list of Documents for each file in the repo that needs (re)indexing.
+    summary_config is passed to generate_summaries e.g. {'workers': 4}.
+    If a RepoManifest is passed only added or changed files are read, and the vectors of 
+    changed or deleted files are removed from memory's vectorstore. 
+    """
+    repo = pathlib.Path(repo_path).resolve()
+
+    # Generate summary md files - resummarise code that changed since the last reindex
+    code_files = [a_file for a_file in list_repo_files(repo, extension, ignore) if a_file.suffix != ".md"]
+    failed = generate_summaries(code_files, memory, 
+                       resummarise=resummarise, 
+                       verbose=verbose, 
+                       manifest=manifest, 
+                       **(summary_config or {}))
+
+    # list again to pick up any new summary files
+    files = list_repo_files(repo, extension, ignore)
+
+    if manifest is None:
+        to_read = [str(a_file) for a_file in files]
+        states = {}
+    else:
+        changes = manifest.diff(files, root=repo, extensions=extension.split(","))
+        states = changes["states"]
+        if full_reindex:
+            changes["changed"].extend(changes["unchanged"])
+            changes["unchanged"] = []
+        print(f"Reindex: {len(changes['added'])} added, {len(changes['changed'])} changed, "
+              f"{len(changes['deleted'])} deleted, {len(changes['unchanged'])} unchanged files")
+        
+        for source in changes["changed"] + changes["deleted"]:
+            memory.delete_vectorstore_source(source)
+        for source in changes["deleted"]:
+            manifest.remove(source)
+
+        to_read = changes["added"] + changes["changed"]
+
+    # Read the content of the files that need indexing
+    num_to_read = len(to_read)
+    for i, a_file in enumerate(to_read, start=1):
+        metadata = {"source": a_file}
+        if a_file in states:
+            metadata["file_sha1"] = states[a_file]["sha1"]
+
+        yield read_file_to_document(a_file, metadata=metadata)
+
+        # code whose summary failed stays changed in the manifest, so its summary is retried next time
+        if manifest is not None and a_file not in failed:
+            manifest.update(a_file, states[a_file])
         
-        print(f"Read {i} and ignored {j} {ext} files.")
+        if verbose:
+            print(f"Read {i} of {num_to_read} files")
         
-    print("Read all files")
+    print(f"Read all {num_to_read} files")
 
 def read_file_to_document(md_file, split=False, metadata: dict = None):
     try:
@@ -152,8 +185,11 @@ The text to summarise is here:
     )
 
 # Function to summarise code from the OpenAI API     
-def generate_summary(a_file: pathlib.Path, memory, resummarise: bool=False, verbose: bool=False):
-    
+def prepare_summary(a_file: pathlib.Path, resummarise: bool=False, verbose: bool=False):
+    """
+    Works out if a_file needs a summary.
+    Returns None to skip, else a tuple of the summary file name and the prompt for each chunk
+    """
     if a_file.is_dir():
         raise ValueError(f"a_file must not be a directory: {a_file}")
     
@@ -161,19 +197,21 @@ def generate_summary(a_file: pathlib.Path, memory, resummarise: bool=False, verb
     if os.path.isfile(new_file_name) and not resummarise:
          if verbose:
             print(f"Skipping generating summary as found existing code summary file: {new_file_name}")
-         return
+         return None
+    
+    # an existing summary is kept until the new one is complete, see my_llm.save_to_file
 
     try:
         with open(a_file, "r") as file:
             file_text = file.read()
     except Exception as e:
         print(f"Error generating summary: {str(e)}")
-        return
+        return None
     
     if len(file_text) < 10:
         if verbose:
             print(f"Skipping generation as not enough information.  Got: {file_text}")
-        return
+        return None
 
     document = Document(page_content=file_text, metadata = {"source": os.path.abspath(a_file)})
     source_chunks = chunk_doc_to_docs([document], a_file.suffix)  
@@ -191,46 +229,106 @@ def generate_summary(a_file: pathlib.Path, memory, resummarise: bool=False, verb
         print("================================================")
         prompt = text_prompt()
 
-    num_chunks = len(source_chunks)
+    return new_file_name, [prompt.format(txt=chunk.page_content) for chunk in source_chunks]
+
+# Function to summarise code from the OpenAI API     
+def generate_summary(a_file: pathlib.Path, memory, resummarise: bool=False, verbose: bool=False):
+    
+    job = prepare_summary(a_file, resummarise=resummarise, verbose=verbose)
+    if job is None:
+        return
+    new_file_name, prompts = job
+
+    num_chunks = len(prompts)
     i=0
-    for chunk in source_chunks:
+    summaries = []
+    for prompt in prompts:
         logging.info(f"Summarising chunk {i} of {num_chunks} of {a_file}")
         i += 1
         summary = my_llm.request_llm(
-            prompt.format(txt=chunk.page_content), 
+            prompt, 
             chat, 
             memory,
             metadata={'task':'summarise_chunk'})
+        summaries.append(summary + '\n\n')
     
-        my_llm.save_to_file(new_file_name, summary + '\n\n', type = "a")
+    # written in one go once every chunk is summarised, so a failure leaves the old summary in place
+    my_llm.save_to_file(new_file_name, "".join(summaries))
     
     return pathlib.Path(new_file_name)
+
+def generate_summaries(code_files, memory, resummarise=False, verbose=False, manifest=None, 
+                       workers: int=1, requests_per_minute: int=None, tokens_per_minute: int=None):
+    """
+    Generates summary md files for code_files, resummarising code that changed since the last reindex.
+    With more than one worker the chunks are summarised concurrently by a ParallelSummariser.
+    Returns the set of code files (as str) whose summary failed.
+    """
+    num_code_files = len(code_files)
+    jobs = []
+    code_file_for = {}
+    for k, code_file in enumerate(code_files, start=1):
+        changed = manifest is not None and manifest.content_changed(code_file)
+        if workers <= 1:
+            generate_summary(code_file, memory, resummarise=resummarise or changed, verbose=verbose)
+            if verbose:
+                print(f"Generated summary for {code_file}: {k} of {num_code_files} done.")
+            continue
+
+        job = prepare_summary(code_file, resummarise=resummarise or changed, verbose=verbose)
+        if job is not None:
+            jobs.append(job)
+            code_file_for[str(job[0])] = str(code_file)
     
+    if jobs:
+        summariser = ParallelSummariser(chat, 
+                                        workers=workers, 
+                                        requests_per_minute=requests_per_minute,
+                                        tokens_per_minute=tokens_per_minute)
+        for k, new_file_name in enumerate(summariser.summarise_files(jobs, memory=memory, verbose=verbose), start=1):
+            if verbose:
+                print(f"Generated summary {new_file_name}: {k} of {len(jobs)} done.")
+
+        if summariser.failed:
+            print(f"WARNING: could not summarise {len(summariser.failed)} files, they will be retried next reindex")
+        return {code_file_for[str(new_file_name)] for new_file_name in summariser.failed}
+
+    return set()
+
 # Get source chunks from a repository
-def get_source_docs(repo_path, extension, memory, ignore, resummarise, verbose):
+def get_source_docs(repo_path, extension, memory, ignore, resummarise, verbose, manifest=None, full_reindex=False,
+                    summary_config: dict=None):
     source_chunks = []
 
-    for source in get_repo_docs(repo_path, 
-                                extension=extension, 
-                                memory=memory, 
-                                ignore=ignore, 
-                                resummarise=resummarise,
-                                verbose=verbose):
+    for docs in get_repo_docs(repo_path, 
+                              extension=extension, 
+                              memory=memory, 
+                              ignore=ignore, 
+                              resummarise=resummarise,
+                              verbose=verbose,
+                              manifest=manifest,
+                              full_reindex=full_reindex,
+                              summary_config=summary_config):
         
-        splitter = choose_splitter(extension)
-        for chunk in splitter.split_text(source.page_content):
-            source_chunks.append(Document(page_content=chunk, metadata=source.metadata))
+        # the splitter is chosen by each document's source extension
+        source_chunks.extend(iter_chunks(docs))
 
     return source_chunks
 
-def choose_splitter(extension: str, chunk_size: int=1024, chunk_overlap:int=0):
-    if extension == ".py":
-        return text_splitter.PythonCodeTextSplitter()
-    elif extension == ".md":
-        return text_splitter.MarkdownTextSplitter()
-    
-    return text_splitter.RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+def get_manifest_path(memory):
+    """
+    The reindex manifest sits inside the Chroma directory, so it is synced to and restored from GCS with it.
+    Otherwise a restored vectorstore has no manifest, and every file would be added to it again.
+    """
+    db_path = memory.vectorstore_manager.get_mem_vectorstore()
+    manifest_path = db_path / "reindex_manifest.json"
+
+    # it used to sit next to the Chroma directory
+    old_path = db_path.with_name(db_path.name + ".manifest.json")
+    if old_path.is_file() and db_path.is_dir() and not manifest_path.exists():
+        os.replace(old_path, manifest_path)
 
+    return manifest_path
 
 def setup_memory(config):
 
@@ -241,17 +339,30 @@ def setup_memory(config):
         memory.load_vectorstore_memory()
 
     if config['reindex']:
-		# Create a new Chroma DB
+		# Update the Chroma DB with files changed since the last reindex
         exts = '.md,.py'
         if config['ext']:
             exts = config['ext']
+        manifest = RepoManifest(get_manifest_path(memory))
         source_chunks = get_source_docs(config['repo'], 
                                         extension=exts, 
                                         memory=memory, 
                                         ignore=config['ignore'], 
                                         resummarise=config['resummarise'],
-                                        verbose=config['verbose'])
-        memory.save_vectorstore_memory(source_chunks, verbose=config['verbose'])
+                                        verbose=config['verbose'],
+                                        manifest=manifest,
+                                        full_reindex=config.get('full_reindex', False),
+                                        summary_config={
+                                            'workers': config.get('workers') or 1,
+                                            'requests_per_minute': config.get('rpm'),
+                                            'tokens_per_minute': config.get('tpm')
+                                        })
+        if source_chunks:
+            memory.save_vectorstore_memory(source_chunks, verbose=config['verbose'])
+        manifest.save()
+        # the manifest is in the vectorstore directory, so upload it along with it
+        memory.vectorstore_manager.dirty = True
+        print(f"Embedding cache: {memory.embedding.stats()}")
 
     return memory 
 
@@ -357,16 +468,8 @@ def summarise_single_file(filename: str, bucket_name, verbose=False):
     return output_content
 
 def chunk_doc_to_docs(documents: list, extension: str = ".md"):
-    """Turns a Document object into a list of many Document chunks"""
-    for document in documents:
-        source_chunks = []
-        splitter = choose_splitter(extension)
-        for chunk in splitter.split_text(document.page_content):
-            source_chunks.append(Document(page_content=chunk, metadata=document.metadata))
-
-        return source_chunks  
-    
-    
+    """Turns a list of Documents into a list of many Document chunks"""
+    return chunk_documents(documents, extension=extension)
 
 def main(config):
 
@@ -409,6 +512,12 @@ if __name__ == "__main__":
     parser.add_argument("--ext", help="Comma separated list of file extensions to include. Defaults to '.md,.py'")
     parser.add_argument("--ignore", help="Directory to ignore file imports from. Defaults to 'env/'")
     parser.add_argument("--resummarise", action="store_true", help="Recreate the code.md files describing the code")
+    parser.add_argument("--workers", type=int, default=1, 
+                        help="How many LLM requests to run at once when generating summaries")
+    parser.add_argument("--rpm", type=int, default=3000, help="LLM requests per minute limit when --workers > 1")
+    parser.add_argument("--tpm", type=int, default=80000, help="LLM tokens per minute limit when --workers > 1")
+    parser.add_argument("--full-reindex", action="store_true", 
+                        help="With --reindex, re-embed every file instead of only those changed since the last reindex")
     parser.add_argument("--verbose", action="store_true", help="Include metadata such as sources in replies")
     parser.add_argument("--bucket", help="A Google Cloud Storage bucket name e.g. ga://your-bucket-name")
     args = parser.parse_args()
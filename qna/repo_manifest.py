@@ -0,0 +1,106 @@
+import os
+import json
+import hashlib
+import logging
+
+def compute_sha1_from_file(file_path):
+    sha1 = hashlib.sha1()
+    with open(file_path, "rb") as file:
+        for block in iter(lambda: file.read(1024 * 1024), b""):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+class RepoManifest:
+    """
+    Records the sha1, mtime and size of every indexed file so a reindex only touches what changed.
+        manifest_path: JSON file the manifest is stored in, usually next to the Chroma directory
+    """
+    def __init__(self, manifest_path):
+        self.manifest_path = str(manifest_path)
+        self.files = {}
+        # (path, mtime, size) -> sha1 hashed this run, so a file is only hashed once per reindex
+        self._hashed = {}
+        self.load()
+
+    def load(self):
+        if os.path.isfile(self.manifest_path):
+            with open(self.manifest_path, 'r') as f:
+                self.files = json.load(f)
+            logging.info(f"Loaded reindex manifest with {len(self.files)} files from {self.manifest_path}")
+        return self.files
+
+    def save(self):
+        dirname = os.path.dirname(self.manifest_path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        tmp_path = self.manifest_path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.files, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.manifest_path)
+
+    @staticmethod
+    def _stat(file_path):
+        stat = os.stat(file_path)
+        return stat.st_mtime, stat.st_size
+
+    def file_state(self, file_path):
+        """Returns the manifest entry the file would have now, hashing only if mtime or size moved"""
+        key = str(file_path)
+        mtime, size = self._stat(key)
+        entry = self.files.get(key)
+        if entry and entry["mtime"] == mtime and entry["size"] == size:
+            return entry
+
+        sha1 = self._hashed.get((key, mtime, size))
+        if sha1 is None:
+            sha1 = self._hashed[(key, mtime, size)] = compute_sha1_from_file(key)
+        return {"sha1": sha1, "mtime": mtime, "size": size}
+
+    def content_changed(self, file_path):
+        """True if the file is in the manifest and its content has changed since"""
+        entry = self.files.get(str(file_path))
+        if entry is None:
+            return False
+        return self.file_state(file_path)["sha1"] != entry["sha1"]
+
+    def diff(self, file_paths, root=None, extensions=None):
+        """
+        Compares file_paths to the manifest.
+        Deleted files are manifest entries under root with one of extensions that are no longer in file_paths.
+        Returns dict of 'added', 'changed', 'deleted' and 'unchanged' lists plus 'states', the new manifest entries
+        """
+        result = {"added": [], "changed": [], "deleted": [], "unchanged": [], "states": {}}
+        seen = set()
+        for file_path in file_paths:
+            key = str(file_path)
+            seen.add(key)
+            state = self.file_state(key)
+            result["states"][key] = state
+            entry = self.files.get(key)
+            if entry is None:
+                result["added"].append(key)
+            elif entry["sha1"] != state["sha1"]:
+                result["changed"].append(key)
+            else:
+                result["unchanged"].append(key)
+
+        # with the separator, so /repo doesn't also match files in /repo-other
+        root = os.path.join(str(root), "") if root is not None else None
+        extensions = tuple(extensions) if extensions else None
+        for key in self.files:
+            if key in seen:
+                continue
+            if root is not None and not key.startswith(root):
+                continue
+            if extensions is not None and not key.endswith(extensions):
+                continue
+            result["deleted"].append(key)
+
+        return result
+
+    def update(self, file_path, state=None):
+        key = str(file_path)
+        self.files[key] = state if state is not None else self.file_state(key)
+
+    def remove(self, file_path):
+        self.files.pop(str(file_path), None)
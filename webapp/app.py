@@ -1,6 +1,7 @@
-import sys, os, requests
+import sys, os
 import tempfile
 import datetime
+import time
 
 parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 sys.path.append(parent_dir)
@@ -12,6 +13,9 @@ from encoder_service import publish_to_pubsub_embed
 from encoder_service import pubsub_chunk_to_store as pb
 import logging
 import bot_help
+import route_limits
+from my_llm.client_registry import get_http_session
+from my_llm import pubsub_manager
 
 app = Flask(__name__)
 
@@ -37,6 +41,7 @@ def process_files():
 app_chat_history = []
 
 @app.route('/process_input', methods=['POST'])
+@route_limits.qna_limit
 def process_input():
     # json input
     data = request.get_json()
@@ -62,6 +67,7 @@ def process_input():
 
 
 @app.route('/discord/<vector_name>/message', methods=['POST'])
+@route_limits.qna_limit
 def discord_message(vector_name):
     data = request.get_json()
     user_input = data['content'].strip()  # Extract user input from the payload
@@ -109,7 +115,8 @@ def discord_message(vector_name):
         if rows is None:
             result = {"result": "No sources were found"}
         else:
-            msg = "\n".join([f"{row}" for row in rows])
+            msg = "\n".join([f"{source} - {source_type}, {chunks} chunks, {last_ingested:%Y-%m-%d %H:%M}" 
+                             for source, source_type, chunks, last_ingested in rows])
             result = {"result": f"*sources:*\n{msg}"}
 
         return jsonify(result)
@@ -149,7 +156,7 @@ def discord_files(vector_name):
             file_url = attachment['url']
             file_name = attachment['filename']
             safe_file_name = os.path.join(temp_dir, file_name)
-            response = requests.get(file_url)
+            response = get_http_session().get(file_url)
             
             open(safe_file_name, 'wb').write(response.content)
 
@@ -168,6 +175,7 @@ def discord_files(vector_name):
 
 # can only take up to 10 minutes to ack
 @app.route('/pubsub_chunk_to_store/<vector_name>', methods=['POST'])
+@route_limits.chunk_limit
 def pubsub_chunk_to_store(vector_name):
     """
     Final PubSub destination for each chunk that sends data to Supabase vectorstore"""
@@ -180,6 +188,7 @@ def pubsub_chunk_to_store(vector_name):
 
 
 @app.route('/pubsub_to_store/<vector_name>', methods=['POST'])
+@route_limits.ingest_limit
 def pubsub_to_store(vector_name):
     """
     splits up text or gs:// file into chunks and sends to pubsub topic 
@@ -237,11 +246,29 @@ def slack():
                 'Content-Type': 'application/json',
                 'Authorization': f'Bearer {os.environ["SLACK_BOT_TOKEN"]}'
             }
-            requests.post(slack_api_url, headers=headers, json=response_payload)
+            get_http_session().post(slack_api_url, headers=headers, json=response_payload)
     
     return '', 204
 
+def shutdown(timeout: float=None):
+    """
+    Called when the server stops: waits for in-flight requests and Pub/Sub messages to finish.
+    timeout is for the whole shutdown, as Cloud Run kills the container 10 seconds after SIGTERM.
+    """
+    logging.info("Shutting down app")
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    def remaining():
+        return max(0, deadline - time.monotonic()) if deadline is not None else None
+
+    route_limits.wait_for_in_flight(remaining())
+    # send any Pub/Sub messages still batched in the publisher
+    pubsub_manager.flush(remaining())
+
 if __name__ == "__main__":
+    # development server only, in production use gunicorn --config webapp/gunicorn.conf.py app:app
     import os
-    app.run(host="0.0.0.0", port=int(os.environ.get("PORT", 8080)), debug=True)
+    app.run(host="0.0.0.0", 
+            port=int(os.environ.get("PORT", 8080)), 
+            debug=os.getenv('FLASK_DEBUG', 'true').lower() in ('1', 'true'),
+            threaded=True)
 
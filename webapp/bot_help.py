@@ -3,7 +3,7 @@ from encoder_service import publish_to_pubsub_embed
 import logging
 import base64
 import json
-import requests
+from my_llm.client_registry import get_http_session
 
 def discord_webhook(message_data):
     webhook_url = os.getenv('DISCORD_URL', None)  # replace with your webhook url
@@ -24,7 +24,7 @@ def discord_webhook(message_data):
     data = message_data
 
     logging.info(f'Sending discord this data: {data}')
-    response = requests.post(webhook_url, json=data,
+    response = get_http_session().post(webhook_url, json=data,
                             headers={'Content-Type': 'application/json'})
     logging.info(f'Sent data to discord: {response}')
     
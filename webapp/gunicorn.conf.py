@@ -0,0 +1,33 @@
+# Production server config for the Flask app in webapp/app.py
+#   gunicorn --config webapp/gunicorn.conf.py app:app
+import os
+import multiprocessing
+
+chdir = os.path.dirname(os.path.abspath(__file__))
+bind = f"0.0.0.0:{os.getenv('PORT', 8080)}"
+
+# threads suit the I/O bound routes (LLM, Supabase, Pub/Sub calls)
+# add workers for CPU heavy file parsing when the instance has more than one CPU
+worker_class = "gthread"
+workers = int(os.getenv('WEB_CONCURRENCY', 1))
+threads = int(os.getenv('GUNICORN_THREADS', max(8, 4 * multiprocessing.cpu_count())))
+
+# Pub/Sub push subscriptions wait up to 600 seconds for an ack
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 600))
+# Cloud Run sends SIGTERM then waits 10 seconds before SIGKILL
+graceful_timeout = int(os.getenv('GRACEFUL_TIMEOUT', 9))
+keepalive = 5
+
+accesslog = "-"
+loglevel = os.getenv('LOG_LEVEL', 'info')
+
+def worker_int(worker):
+    worker.log.info("Worker interrupted, finishing in-flight requests")
+
+def worker_exit(server, worker):
+    # requests are already drained by the gthread worker, this flushes background work they queued
+    try:
+        from app import shutdown
+        shutdown(timeout=graceful_timeout)
+    except Exception as e:
+        worker.log.warning(f"Error during shutdown: {e}")
@@ -0,0 +1,67 @@
+import os
+import time
+import threading
+import logging
+from functools import wraps
+
+from flask import jsonify
+
+class RouteLimit:
+    """
+    Caps how many requests a group of routes can run at once, so a slow group can't use up every worker thread.
+        name: the group name, used in logs
+        limit: how many requests of this group can run at once
+        wait: seconds a request waits for a free slot before it is rejected
+        status: HTTP status returned when rejected - Pub/Sub push redelivers on 429/503
+    """
+    def __init__(self, name: str, limit: int, wait: float=0, status: int=429):
+        self.name = name
+        self.limit = limit
+        self.wait = wait
+        self.status = status
+        self.semaphore = threading.BoundedSemaphore(limit)
+        self.in_flight = 0
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+
+    def __call__(self, func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not self.semaphore.acquire(timeout=self.wait):
+                logging.info(f"Route limit {self.name} of {self.limit} reached, returning {self.status}")
+                response = jsonify({'status': 'Busy', 'route_limit': self.name})
+                return response, self.status, {'Retry-After': '10'}
+            with self._lock:
+                self.in_flight += 1
+            try:
+                return func(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self.in_flight -= 1
+                    self._idle.notify_all()
+                self.semaphore.release()
+
+        return wrapper
+
+    def wait_idle(self, timeout: float=None):
+        """Blocks until no requests of this group are running, returns False on timeout"""
+        with self._lock:
+            return self._idle.wait_for(lambda: self.in_flight == 0, timeout)
+
+def _env_int(name, default):
+    return int(os.getenv(name, default))
+
+# question answering: waits a while as a person is waiting on the answer
+qna_limit = RouteLimit("qna", _env_int('QNA_CONCURRENCY', 6), wait=30, status=503)
+# parsing files and urls into chunks: slow and CPU heavy, Pub/Sub will redeliver
+ingest_limit = RouteLimit("ingest", _env_int('INGEST_CONCURRENCY', 1), wait=1)
+# embedding and storing chunks
+chunk_limit = RouteLimit("chunk", _env_int('CHUNK_CONCURRENCY', 4), wait=5)
+
+def wait_for_in_flight(timeout: float=None):
+    """Used at shutdown to let running requests, e.g. Pub/Sub pushes, finish. timeout is for all the groups together."""
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    for limit in (qna_limit, ingest_limit, chunk_limit):
+        remaining = max(0, deadline - time.monotonic()) if deadline is not None else None
+        if not limit.wait_idle(remaining):
+            logging.warning(f"Shutting down with {limit.in_flight} {limit.name} requests still running")